@@ -4,14 +4,27 @@ Receives HTTP requests to open Viber, look up a number, capture the Viber window
 """
 from __future__ import annotations
 
+import abc
 import io
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
+import sqlite3
+import string
 import sys
+import threading
 import time
+import atexit
 import base64
+import hashlib
 import uuid
 import webbrowser
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 
 # Load .env so OPENAI_API_KEY etc. are set (agent dir first, then cwd; override so .env wins)
 def _load_env():
@@ -25,33 +38,96 @@ def _load_env():
 
 _load_env()
 
-# OCR debug logs: use a dedicated handler so they always show in the terminal
-log = logging.getLogger("viber_agent.ocr")
-log.setLevel(logging.DEBUG)
-_h = logging.StreamHandler(sys.stderr)
-_h.setFormatter(logging.Formatter("%(asctime)s [OCR] %(message)s"))
-log.addHandler(_h)
-log.propagate = False
 
-from flask import Flask, request, jsonify, Response, send_file
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller: when the console can't keep up, records are dropped and counted."""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+
+# All diagnostics go through one bounded queue; a single listener thread writes them to the console, so request
+# threads never wait on a slow Windows console / RDP session. "[viber-agent]" lines: alog; OCR debug lines: log.
+LOG_QUEUE_MAX = int(os.environ.get("LOG_QUEUE_MAX", "10000"))
+_log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+_console = logging.StreamHandler(sys.stdout)
+_console.setFormatter(logging.Formatter("%(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _console)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+
+# Current request trace per thread (see _Trace); read by the log filter below
+_trace_local = threading.local()
+
+
+def _trace_prefix(record: logging.LogRecord) -> bool:
+    """Tag the record with the current request's short trace id (set on the calling thread, before queueing)."""
+    trace = getattr(_trace_local, "trace", None)
+    record.trace = "[%s] " % trace.id[:8] if trace is not None else ""
+    return True
+
+
+def _queued_logger(name: str, fmt: str, level: int) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    handler = _DroppingQueueHandler(_log_queue)
+    handler.addFilter(_trace_prefix)
+    handler.setFormatter(logging.Formatter(fmt))
+    logger.addHandler(handler)
+    logger.propagate = False
+    return logger
+
+
+alog = _queued_logger("viber_agent", "[viber-agent] %(trace)s%(message)s", logging.INFO)
+# OCR debug logs: use a dedicated logger so they always show in the terminal
+log = _queued_logger("viber_agent.ocr", "%(asctime)s [OCR] %(trace)s%(message)s", logging.DEBUG)
+
+from flask import Flask, request, jsonify, Response, send_file, g
 
 # Screenshot: mss (screen grab) + optional PrintWindow (window buffer, works when RDP disconnected)
 try:
     import mss
-    import mss.tools
     HAS_MSS = True
 except ImportError:
     HAS_MSS = False
 
+PW_DEFAULT = 0
+PW_RENDERFULLCONTENT = 2
 try:
     import ctypes
     from ctypes import wintypes
     _user32 = ctypes.windll.user32
+    _gdi32 = ctypes.windll.gdi32
     _PrintWindow = _user32.PrintWindow
     _PrintWindow.argtypes = [wintypes.HWND, wintypes.HDC, wintypes.UINT]
     _PrintWindow.restype = wintypes.BOOL
-    PW_DEFAULT = 0
-    PW_RENDERFULLCONTENT = 2
+
+    class _BITMAPINFOHEADER(ctypes.Structure):
+        _fields_ = [
+            ("biSize", wintypes.DWORD), ("biWidth", wintypes.LONG), ("biHeight", wintypes.LONG),
+            ("biPlanes", wintypes.WORD), ("biBitCount", wintypes.WORD), ("biCompression", wintypes.DWORD),
+            ("biSizeImage", wintypes.DWORD), ("biXPelsPerMeter", wintypes.LONG), ("biYPelsPerMeter", wintypes.LONG),
+            ("biClrUsed", wintypes.DWORD), ("biClrImportant", wintypes.DWORD),
+        ]
+
+    _gdi32.CreateCompatibleDC.argtypes = [wintypes.HDC]
+    _gdi32.CreateCompatibleDC.restype = wintypes.HDC
+    _gdi32.CreateDIBSection.argtypes = [
+        wintypes.HDC, ctypes.POINTER(_BITMAPINFOHEADER), wintypes.UINT, ctypes.POINTER(ctypes.c_void_p),
+        wintypes.HANDLE, wintypes.DWORD,
+    ]
+    _gdi32.CreateDIBSection.restype = wintypes.HBITMAP
+    _gdi32.SelectObject.argtypes = [wintypes.HDC, wintypes.HGDIOBJ]
+    _gdi32.SelectObject.restype = wintypes.HGDIOBJ
+    _gdi32.DeleteObject.argtypes = [wintypes.HGDIOBJ]
+    _gdi32.DeleteDC.argtypes = [wintypes.HDC]
     HAS_PRINTWINDOW = True
 except Exception:
     HAS_PRINTWINDOW = False
@@ -67,13 +143,26 @@ except ImportError:
     findwindows = None  # type: ignore
     _keyboard_send_keys = None
 
-# OCR: GPT Vision only (set OPENAI_API_KEY)
+# OCR: GPT Vision (set OPENAI_API_KEY) and/or local Tesseract (pip install pytesseract + Tesseract with "bul" data)
 try:
+    import openai
     from openai import OpenAI
     HAS_OPENAI = True
 except ImportError:
     HAS_OPENAI = False
 
+try:
+    import httpx
+except ImportError:
+    httpx = None  # type: ignore
+
+try:
+    import pytesseract
+    HAS_TESSERACT_PY = True
+except ImportError:
+    pytesseract = None  # type: ignore
+    HAS_TESSERACT_PY = False
+
 
 def _has_gpt_ocr() -> bool:
     return bool(HAS_OPENAI and _get_openai_key())
@@ -86,28 +175,49 @@ def _cors(resp):
     """Allow the Next.js app (different origin) to call this API."""
     resp.headers["Access-Control-Allow-Origin"] = "*"
     resp.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, X-API-Key, Authorization"
+    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, X-API-Key, Authorization, Idempotency-Key"
     return resp
 
 
 @app.before_request
 def _require_api_key():
-    """If AGENT_API_KEY is set, require X-API-Key or Authorization: Bearer for protected routes."""
-    if not AGENT_API_KEY:
-        return None
+    """
+    If AGENT_API_KEY / AGENT_API_KEYS are set, require X-API-Key or Authorization: Bearer for protected routes.
+    The key selects the caller's tenant (g.tenant); POSTs beyond the key's requests-per-minute get 429 + Retry-After.
+    """
+    g.tenant = _ANONYMOUS_TENANT
     if request.method == "OPTIONS" or request.path in ("/health", "/api", "/api/v1", "/openapi.json", "/docs"):
         return None
-    key = request.headers.get("X-API-Key", "").strip()
-    if not key and request.headers.get("Authorization", "").startswith("Bearer "):
-        key = request.headers.get("Authorization", "").replace("Bearer ", "", 1).strip()
-    if key != AGENT_API_KEY:
-        return jsonify(error="Unauthorized"), 401
+    if _tenants.enabled:
+        key = request.headers.get("X-API-Key", "").strip()
+        if not key and request.headers.get("Authorization", "").startswith("Bearer "):
+            key = request.headers.get("Authorization", "").replace("Bearer ", "", 1).strip()
+        tenant = _tenants.by_key(key)
+        if tenant is None:
+            return jsonify(error="Unauthorized"), 401
+        g.tenant = tenant.name
+    if request.method == "POST":
+        retry_after = _tenants.hit(g.tenant)
+        if retry_after:
+            resp = jsonify(error="Rate limit of this API key reached, retry in %ds" % retry_after, retry_after=retry_after)
+            resp.status_code = 429
+            resp.headers["Retry-After"] = str(retry_after)
+            return resp
+    return None
 
 
 @app.route("/check-number", methods=["OPTIONS"])
 @app.route("/check-number-base64", methods=["OPTIONS"])
 @app.route("/send-message", methods=["OPTIONS"])
-def _cors_preflight():
+@app.route("/check-numbers", methods=["OPTIONS"])
+@app.route("/jobs", methods=["OPTIONS"])
+@app.route("/jobs/<job_id>", methods=["OPTIONS"])
+@app.route("/images/<image_id>", methods=["OPTIONS"])
+@app.route("/usage", methods=["OPTIONS"])
+@app.route("/campaigns", methods=["OPTIONS"])
+@app.route("/campaigns/<campaign_id>", methods=["OPTIONS"])
+@app.route("/campaigns/<campaign_id>/<action>", methods=["OPTIONS"])
+def _cors_preflight(**_kwargs):
     return "", 204
 
 
@@ -124,15 +234,19 @@ OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "").strip()
 
 # Optional: require X-API-Key header for agent endpoints. Set AGENT_API_KEY on agent and in Vercel (for proxy).
 AGENT_API_KEY = os.environ.get("AGENT_API_KEY", "").strip()
+# Optional: several keys sharing the desktop fairly, comma-separated name:key[:weight[:rpm[:daily_usd]]].
+# weight = share of desktop time when keys compete, rpm = POSTs per minute, daily_usd = GPT OCR spend per day
+# (empty or 0 = unlimited). AGENT_API_KEY, if also set, is the key "default" (weight 1, no limits).
+AGENT_API_KEYS = os.environ.get("AGENT_API_KEYS", "").strip()
 
 API_VERSION = "1.0"
 
 if HAS_OPENAI:
     if OPENAI_API_KEY:
-        print("[viber-agent] OPENAI_API_KEY: set", flush=True)
+        alog.info("OPENAI_API_KEY: set")
     else:
         _env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
-        print("[viber-agent] OPENAI_API_KEY: not set (add to %s)" % _env_path, flush=True)
+        alog.info("OPENAI_API_KEY: not set (add to %s)", _env_path)
 
 
 def _get_openai_key() -> str:
@@ -146,7 +260,65 @@ WINDOW_POLL_INTERVAL = 0.10  # between poll attempts (smaller = find window soon
 CONNECT_TIMEOUT = float(os.environ.get("CONNECT_TIMEOUT", "0.25"))  # fail fast when Viber not ready
 RETRY_EXTRA_WAIT = 1.0  # before retry if window not found
 SKIP_FIX_NAME = os.environ.get("SKIP_FIX_NAME", "0").strip().lower() in ("1", "true", "yes")  # skip GPT fix-name call to save ~0.8s
-MESSAGE_INPUT_WAIT = 2.0  # after chat opens, before typing (so input is focused)
+# after the chat opens, before typing, when the panel cannot be probed (or the input focus, without UIA)
+MESSAGE_INPUT_WAIT = float(os.environ.get("MESSAGE_INPUT_WAIT", "2.0"))
+SEND_READY_TIMEOUT = float(os.environ.get("SEND_READY_TIMEOUT", "5.0"))  # max wait: input enabled / text applied
+SEND_CONFIRM_TIMEOUT = float(os.environ.get("SEND_CONFIRM_TIMEOUT", "3.0"))  # max wait: message shows in the chat
+# Desktop driver: "windows" (real Viber) or "sim" (simulated window/panel/OCR fixtures, runs anywhere; see bench.py)
+VIBER_DRIVER = os.environ.get("VIBER_DRIVER", "windows").strip().lower()
+_AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SIM_WINDOW_DELAY = float(os.environ.get("SIM_WINDOW_DELAY", "0.8"))  # window appears after the first link
+SIM_PANEL_DELAY = float(os.environ.get("SIM_PANEL_DELAY", "0.4"))  # panel renders after each link
+SIM_SEND_DELAY = float(os.environ.get("SIM_SEND_DELAY", "0.3"))
+SIM_FAILURE_RATE = float(os.environ.get("SIM_FAILURE_RATE", "0"))  # 0..1, window lookups and sends
+SIM_UIA_NAME = os.environ.get("SIM_UIA_NAME", "").strip()  # non-empty = name exposed via UIA (no OCR)
+SIM_WINDOW_IMAGE = os.environ.get("SIM_WINDOW_IMAGE") or os.path.join(_AGENT_DIR, "screenshot.png")
+SIM_PANEL_IMAGE = os.environ.get("SIM_PANEL_IMAGE") or os.path.join(_AGENT_DIR, "contact_panel.png")
+SIM_SEED = int(os.environ.get("SIM_SEED", "0"))
+# Session mode: keep the Viber window open between lookups and switch chats in place via viber://chat.
+# The window is closed only when it looks unhealthy or the session is older than VIBER_SESSION_MAX_AGE.
+VIBER_SESSION = os.environ.get("VIBER_SESSION", "1").strip().lower() in ("1", "true", "yes")
+VIBER_SESSION_MAX_AGE = float(os.environ.get("VIBER_SESSION_MAX_AGE", "3600"))  # seconds before a fresh reconnect
+VIBER_SESSION_MAX_FAILURES = int(os.environ.get("VIBER_SESSION_MAX_FAILURES", "2"))  # consecutive bad captures -> restart
+
+# Desktop worker: one thread owns the Viber window; HTTP threads enqueue jobs and wait (or poll /jobs/<id>)
+SYNC_JOB_TIMEOUT = float(os.environ.get("SYNC_JOB_TIMEOUT", "120"))  # max wait for sync endpoints before 504
+JOB_HISTORY_MAX = int(os.environ.get("JOB_HISTORY_MAX", "1000"))  # finished jobs kept for GET /jobs/<id>
+JOB_RESULT_TTL = float(os.environ.get("JOB_RESULT_TTL", "600"))  # seconds a finished job stays queryable
+# Idempotency-Key of a send -> its job, kept apart from the job history so a big batch cannot evict it
+IDEMPOTENCY_KEY_TTL = float(os.environ.get("IDEMPOTENCY_KEY_TTL", "86400"))
+IDEMPOTENCY_KEY_MAX = int(os.environ.get("IDEMPOTENCY_KEY_MAX", "10000"))
+DEFAULT_COUNTRY_CODE = "".join(
+    c for c in os.environ.get("DEFAULT_COUNTRY_CODE", "359") if c.isdigit()
+)  # national numbers (leading 0) are keyed as this country's; empty = keep as typed
+# Admission control: desktop jobs wait in one queue per priority class (interactive before bulk); a full class
+# answers 429 + Retry-After instead of piling up. Per request: "priority" and "deadline_ms" (drop if not started by then).
+_PRIORITIES = ("interactive", "bulk")
+QUEUE_MAX_INTERACTIVE = int(os.environ.get("QUEUE_MAX_INTERACTIVE", "20"))
+QUEUE_MAX_BULK = int(os.environ.get("QUEUE_MAX_BULK", "1000"))
+BATCH_MAX_NUMBERS = int(os.environ.get("BATCH_MAX_NUMBERS", "1000"))  # max numbers per POST /check-numbers
+BATCH_TIMEOUT = float(os.environ.get("BATCH_TIMEOUT", "3600"))  # max seconds a /check-numbers stream waits in total
+# Campaigns (POST /campaigns): messages wait in a SQLite outbox and are sent as bulk jobs at a steady rate
+CAMPAIGN_DB = os.environ.get("CAMPAIGN_DB", "").strip() or os.path.join(_AGENT_DIR, "campaigns.sqlite3")  # "off" = disabled
+CAMPAIGN_RATE_PER_MIN = float(os.environ.get("CAMPAIGN_RATE_PER_MIN", "6"))  # default messages per minute per campaign
+CAMPAIGN_MAX_RECIPIENTS = int(os.environ.get("CAMPAIGN_MAX_RECIPIENTS", "10000"))
+CAMPAIGN_MAX_ATTEMPTS = int(os.environ.get("CAMPAIGN_MAX_ATTEMPTS", "3"))  # per message, for sends that returned an error
+CAMPAIGN_RETRY_DELAY = float(os.environ.get("CAMPAIGN_RETRY_DELAY", "60"))  # seconds before the first retry (doubles)
+# OCR runs on a thread pool so the desktop worker can open the next chat while GPT Vision is still answering
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", "4"))
+OCR_MAX_PENDING = int(os.environ.get("OCR_MAX_PENDING", "8"))  # captured panels waiting for OCR; desktop blocks beyond
+
+# Lookup cache: repeat numbers are answered from memory/SQLite instead of Viber + GPT Vision
+LOOKUP_CACHE_TTL = float(os.environ.get("LOOKUP_CACHE_TTL", str(7 * 24 * 3600)))  # seconds a found name stays valid
+LOOKUP_CACHE_NEGATIVE_TTL = float(os.environ.get("LOOKUP_CACHE_NEGATIVE_TTL", "3600"))  # shorter for "no name found"
+LOOKUP_CACHE_MAX_ITEMS = int(os.environ.get("LOOKUP_CACHE_MAX_ITEMS", "500"))  # in-memory LRU bound
+LOOKUP_CACHE_DISK_MAX_ITEMS = int(os.environ.get("LOOKUP_CACHE_DISK_MAX_ITEMS", "100000"))
+# SQLite file for the disk tier; set to "off" to keep the cache in memory only
+LOOKUP_CACHE_DB = os.environ.get("LOOKUP_CACHE_DB", "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "lookup_cache.sqlite3"
+)
+LOOKUP_CACHE_DEFAULT = os.environ.get("LOOKUP_CACHE_DEFAULT", "prefer").strip().lower()  # bypass | prefer | only
+_CACHE_MODES = ("bypass", "prefer", "only")
 
 # Panel crop: RIGHT side. Skip PANEL_TOP + PANEL_STRIP_TOP from window top (removes white bar), then 290×280.
 PANEL_TOP = int(os.environ.get("PANEL_TOP", "40"))
@@ -155,9 +327,82 @@ PANEL_WIDTH = int(os.environ.get("PANEL_WIDTH", "290"))
 PANEL_HEIGHT = int(os.environ.get("PANEL_HEIGHT", "250"))
 PANEL_LEFT = os.environ.get("PANEL_LEFT", "0").strip().lower() in ("1", "true", "yes")  # 0 = right side (default), 1 = left
 PANEL_USE_FULL_WIDTH = os.environ.get("PANEL_USE_FULL_WIDTH", "0").strip().lower() in ("1", "true", "yes")
-# If PrintWindow panel PNG is smaller than this, treat as likely blank and fall back to mss
-PANEL_MIN_BYTES = 20_000
+# If the PrintWindow panel's pixel stddev (0-255) is below this, treat it as blank and fall back to mss
+PANEL_MIN_STDDEV = float(os.environ.get("PANEL_MIN_STDDEV", "6.0"))
+# Output image encoding (per request: "image_format": "png" | "webp" | "jpeg")
+_IMAGE_FORMATS = ("png", "webp", "jpeg")
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "png").strip().lower().replace("jpg", "jpeg")
+if IMAGE_FORMAT not in _IMAGE_FORMATS:
+    IMAGE_FORMAT = "png"
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", "1"))  # 0-9; 1 = fast, slightly larger
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))  # webp / jpeg
+# Window sizes whose PrintWindow DC + bitmap are kept for reuse (the Viber window rarely changes size)
+CAPTURE_CACHE_SIZES = max(1, int(os.environ.get("CAPTURE_CACHE_SIZES", "2")))
+# Captured images are kept by content hash and served from GET /images/<id>; lookup JSON carries the URLs.
+# Inline base64 in the JSON only per request ("inline_images": true) or with IMAGE_INLINE=1.
+IMAGE_STORE_MAX_MB = float(os.environ.get("IMAGE_STORE_MAX_MB", "64"))
+IMAGE_CACHE_MAX_AGE = int(os.environ.get("IMAGE_CACHE_MAX_AGE", "86400"))  # seconds, Cache-Control for /images
+IMAGE_INLINE = os.environ.get("IMAGE_INLINE", "0").strip().lower() in ("1", "true", "yes")
 DEBUG_SAVE_PANEL = os.environ.get("DEBUG_SAVE_PANEL", "").strip().lower() in ("1", "true", "yes")
+# Last captures are kept in memory for GET /debug/last-captures; writing last_panel.* / last_window.* is opt-in
+LAST_CAPTURES_MAX = int(os.environ.get("LAST_CAPTURES_MAX", "10"))
+SAVE_LAST_CAPTURE = os.environ.get("SAVE_LAST_CAPTURE", "0").strip().lower() in ("1", "true", "yes")
+
+# Panel readiness: instead of fixed INITIAL_WAIT + PANEL_LOAD_WAIT, poll tiny grayscale frames of the panel and
+# capture once they are stable, not blank and different from the previous contact's panel (or at the deadline).
+PANEL_READY_DETECT = os.environ.get("PANEL_READY_DETECT", "1").strip().lower() in ("1", "true", "yes")
+PANEL_READY_TIMEOUT = float(os.environ.get("PANEL_READY_TIMEOUT", "3.0"))  # hard deadline after window found
+PANEL_READY_POLL = float(os.environ.get("PANEL_READY_POLL", "0.05"))  # between probe frames
+PANEL_READY_STABLE_FRAMES = int(os.environ.get("PANEL_READY_STABLE_FRAMES", "2"))  # consecutive matching frames
+PANEL_READY_DIFF = float(os.environ.get("PANEL_READY_DIFF", "3.0"))  # mean abs pixel diff (0-255) = "changed"
+PANEL_READY_MIN_STDDEV = float(os.environ.get("PANEL_READY_MIN_STDDEV", "4.0"))  # below = blank panel
+PANEL_READY_THUMB = (48, 40)  # probe frame size (w, h)
+
+# OCR backends tried in order until one returns a plausible name with enough confidence (unavailable ones are skipped).
+# "local" = Tesseract on this PC (no network), "gpt" = GPT Vision. Per request: "ocr": "gpt" or "local,gpt".
+OCR_CHAIN = os.environ.get("OCR_CHAIN", "local,gpt")
+OCR_LOCAL_MIN_CONFIDENCE = float(os.environ.get("OCR_LOCAL_MIN_CONFIDENCE", "0.75"))  # 0..1, below -> next backend
+OCR_TESSERACT_LANG = os.environ.get("OCR_TESSERACT_LANG", "bul+eng")
+OCR_TESSERACT_CMD = os.environ.get("OCR_TESSERACT_CMD", "").strip()  # e.g. C:\Program Files\Tesseract-OCR\tesseract.exe
+# OCR'd names are fixed locally (Latin/Cyrillic homoglyphs, transliteration, dictionary); GPT fix-name is only asked
+# when the local result scores below NAME_FIX_MIN_SCORE (0..1)
+NAME_DICT_PATH = os.environ.get("NAME_DICT_PATH", "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "bg_names.txt"
+)
+NAME_FIX_MIN_SCORE = float(os.environ.get("NAME_FIX_MIN_SCORE", "0.8"))
+
+# Name source: "auto" = read the contact name from the UI Automation tree, OCR the panel only if it is not there;
+# "uia" = UIA only (never OCR); "ocr" = always OCR the screenshot. Per request: "source": "...".
+LOOKUP_SOURCE = os.environ.get("LOOKUP_SOURCE", "auto").strip().lower()
+_LOOKUP_SOURCES = ("auto", "uia", "ocr")
+UIA_NAME_MAX_DEPTH = int(os.environ.get("UIA_NAME_MAX_DEPTH", "14"))  # traversal depth bound below the window
+UIA_NAME_MAX_NODES = int(os.environ.get("UIA_NAME_MAX_NODES", "1500"))  # traversal size bound
+UIA_NAME_AUTO_ID = os.environ.get("UIA_NAME_AUTO_ID", "").strip()  # optional: automation_id substring of the name Text
+UIA_NAME_GIVE_UP = int(os.environ.get("UIA_NAME_GIVE_UP", "5"))  # misses before UIA is skipped (if it never worked)
+# Send path: the message Edit and Send button are located once per traversal and their child-index paths cached
+UIA_SEND_TIMEOUT = float(os.environ.get("UIA_SEND_TIMEOUT", "5.0"))  # max wait for the chat controls to exist
+UIA_SEND_POLL = float(os.environ.get("UIA_SEND_POLL", "0.1"))  # between traversals while they don't
+UIA_SEND_MAX_DEPTH = int(os.environ.get("UIA_SEND_MAX_DEPTH", "20"))
+UIA_SEND_MAX_NODES = int(os.environ.get("UIA_SEND_MAX_NODES", "3000"))
+
+# OpenAI client: one shared client (keep-alive pool), per-call deadline, retries with jittered backoff on 429/5xx,
+# and a token bucket that keeps us under the account's RPM/TPM (tightened by x-ratelimit-* response headers)
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "20"))  # seconds per call, retries included
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "3"))
+OPENAI_RETRY_BASE = float(os.environ.get("OPENAI_RETRY_BASE", "0.5"))  # first backoff (s), doubles per retry
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "8"))
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", "500"))  # requests per minute for this key
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", "200000"))  # tokens per minute for this key
+
+# Vision request shaping: the cheap pass sends only the name region, downscaled + grayscale, at "low" detail
+# (flat 85 image tokens). If it returns a name that fails _is_plausible_person_name, the cascade escalates to
+# OPENAI_OCR_ESCALATE_MODEL with the full panel at high detail.
+OCR_VISION_DETAIL = os.environ.get("OCR_VISION_DETAIL", "low").strip().lower()  # low | high | auto
+OCR_NAME_CROP = os.environ.get("OCR_NAME_CROP", "0,0.35,1,1")  # panel fractions left,top,right,bottom for cheap pass
+OCR_VISION_MAX_SIDE = int(os.environ.get("OCR_VISION_MAX_SIDE", "512"))  # px; low detail is 512x512 anyway
+OCR_VISION_GRAYSCALE = os.environ.get("OCR_VISION_GRAYSCALE", "1").strip().lower() in ("1", "true", "yes")
+OCR_CASCADE = os.environ.get("OCR_CASCADE", "1").strip().lower() in ("1", "true", "yes")
+OPENAI_OCR_ESCALATE_MODEL = os.environ.get("OPENAI_OCR_ESCALATE_MODEL", "gpt-4o")
 
 # Approximate OpenAI pricing USD per 1M tokens (for cost log)
 _OPENAI_PRICE_PER_1M = {
@@ -166,11 +411,222 @@ _OPENAI_PRICE_PER_1M = {
 }
 
 
-def _log_step(step_name: str, elapsed: float, extra: str = "") -> None:
-    msg = f"[viber-agent] {step_name}: {elapsed:.2f}s"
+# Latency buckets (seconds) for the stage histograms: sub-second UI steps up to full lookups with slow OCR
+METRICS_BUCKETS = tuple(
+    float(b) for b in os.environ.get("METRICS_BUCKETS", "0.05,0.1,0.25,0.5,1,2,3,5,8,13,20,30,60").split(",") if b.strip()
+)
+
+
+class _Metrics:
+    """
+    Minimal in-process metrics registry rendered in the Prometheus text format (GET /metrics).
+    Counters and histograms are keyed by (name, sorted labels); gauges are read from callbacks at scrape time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: dict[str, tuple[str, str]] = {}  # name -> (type, help)
+        self._counters: dict[tuple, float] = {}
+        self._hists: dict[tuple, list] = {}  # key -> [bucket counts..., sum, count]
+        self._collectors: list = []  # () -> [(name, type, help, [(labels, value), ...])]
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [0] * len(METRICS_BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def collector(self, fn) -> None:
+        self._collectors.append(fn)
+
+    @staticmethod
+    def _labels(pairs, extra: tuple = ()) -> str:
+        pairs = tuple(pairs) + extra
+        if not pairs:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        return "{" + ",".join('%s="%s"' % (k, esc(v)) for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        series: dict[str, list[str]] = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                series.setdefault(name, []).append("%s%s %s" % (name, self._labels(labels), repr(float(value))))
+            for (name, labels), h in self._hists.items():
+                lines = series.setdefault(name, [])
+                for i, bound in enumerate(METRICS_BUCKETS):
+                    lines.append("%s_bucket%s %d" % (name, self._labels(labels, (("le", repr(bound)),)), h[i]))
+                lines.append("%s_bucket%s %d" % (name, self._labels(labels, (("le", "+Inf"),)), h[-1]))
+                lines.append("%s_sum%s %s" % (name, self._labels(labels), repr(float(h[-2]))))
+                lines.append("%s_count%s %d" % (name, self._labels(labels), h[-1]))
+        for fn in self._collectors:
+            try:
+                for name, kind, help_text, samples in fn():
+                    self._meta.setdefault(name, (kind, help_text))
+                    series.setdefault(name, []).extend(
+                        "%s%s %s" % (name, self._labels(sorted(labels.items())), repr(float(value)))
+                        for labels, value in samples
+                    )
+            except Exception as e:
+                log.debug("metrics collector failed: %s", e)
+        out = []
+        for name in sorted(series):
+            kind, help_text = self._meta.get(name, ("untyped", ""))
+            out.append("# HELP %s %s" % (name, help_text))
+            out.append("# TYPE %s %s" % (name, kind))
+            out.extend(series[name])
+        return "\n".join(out) + "\n"
+
+
+_metrics = _Metrics()
+_metrics.describe("viber_agent_stage_seconds", "histogram", "Duration of each lookup/send stage (the _log_step lines)")
+_metrics.describe("viber_agent_requests_total", "counter", "HTTP API requests by endpoint and outcome")
+_metrics.describe("viber_agent_coalesced_total", "counter", "Lookups/captures that joined an identical in-flight job")
+_metrics.describe("viber_agent_queue_rejected_total", "counter", "Jobs refused with 429 because their queue was full")
+_metrics.describe("viber_agent_jobs_expired_total", "counter", "Queued jobs dropped because their deadline passed")
+_metrics.describe("viber_agent_campaign_messages_total", "counter", "Campaign sends by outcome (sent, retry, failed)")
+_metrics.describe("viber_agent_openai_requests_total", "counter", "OpenAI chat calls by model and outcome")
+_metrics.describe("viber_agent_openai_retries_total", "counter", "OpenAI calls retried after 429/5xx/timeouts")
+_metrics.describe("viber_agent_openai_tokens_total", "counter", "OpenAI tokens used, by model and kind (prompt/completion)")
+_metrics.describe("viber_agent_openai_cost_usd_total", "counter", "Estimated OpenAI spend in USD (_OPENAI_PRICE_PER_1M)")
+_metrics.describe("viber_agent_tenant_requests_total", "counter", "POST requests accepted per API key")
+_metrics.describe("viber_agent_tenant_rejected_total", "counter", "Requests/GPT calls refused per API key (rpm or budget)")
+_metrics.describe("viber_agent_tenant_ocr_cost_usd_total", "counter", "Estimated OpenAI spend in USD per API key")
+
+
+# Per-request traces: every _log_step inside a request (also on the desktop worker / OCR pool) becomes a span
+TRACE_HISTORY = int(os.environ.get("TRACE_HISTORY", "200"))  # finished traces kept for GET /debug/traces
+
+
+class _Trace:
+    """Spans of one HTTP request. Jobs carry it to the desktop worker and OCR pool, so async work lands here too."""
+
+    def __init__(self, trace_id: str, name: str):
+        self.id = trace_id
+        self.name = name
+        self.started = time.time()
+        self._t0 = time.monotonic()
+        self.duration_ms: float | None = None
+        self.status: int | None = None
+        self.spans: list[dict] = []
+        self.tenant = _ANONYMOUS_TENANT  # API key name; OpenAI spend of the request's jobs is charged to it
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, elapsed: float, **attrs) -> None:
+        start_ms = (time.monotonic() - elapsed - self._t0) * 1000
+        span = {"name": name, "start_ms": round(max(0.0, start_ms), 1), "dur_ms": round(elapsed * 1000, 1)}
+        span.update({k: v for k, v in attrs.items() if v not in (None, "")})
+        with self._lock:
+            self.spans.append(span)
+
+    def finish(self, status: int) -> None:
+        self.status = status
+        self.duration_ms = round((time.monotonic() - self._t0) * 1000, 1)
+
+    def timings(self) -> list[dict]:
+        with self._lock:
+            return list(self.spans)
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: one metric per span plus total."""
+        parts = []
+        for i, span in enumerate(self.timings()):
+            token = "-".join("".join(c if c.isalnum() else " " for c in span["name"].lower()).split())
+            desc = span["name"].replace("\\", "").replace('"', "'")
+            parts.append('%s-%d;dur=%s;desc="%s"' % (token or "step", i, span["dur_ms"], desc))
+        parts.append("total;dur=%s" % round((time.monotonic() - self._t0) * 1000, 1))
+        return ", ".join(parts)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.id,
+            "name": self.name,
+            "started": self.started,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "spans": self.timings(),
+        }
+
+
+_traces: "deque[_Trace]" = deque(maxlen=max(1, TRACE_HISTORY))
+_traces_lock = threading.Lock()
+
+
+def _current_trace() -> tuple[_Trace | None, str | None]:
+    """(trace, tag) active on this thread; tag is the job's number so batch spans can be told apart."""
+    return getattr(_trace_local, "trace", None), getattr(_trace_local, "tag", None)
+
+
+@contextmanager
+def _traced(trace: _Trace | None, tag: str | None = None):
+    """Make trace the current one on this thread (desktop worker, OCR pool) for the duration of the block."""
+    prev = _current_trace()
+    _trace_local.trace, _trace_local.tag = trace, tag
+    try:
+        yield
+    finally:
+        _trace_local.trace, _trace_local.tag = prev
+
+
+@app.before_request
+def _start_trace():
+    trace_id = request.headers.get("X-Trace-Id", "").strip()[:64] or uuid.uuid4().hex
+    g.trace = _Trace(trace_id, "%s %s" % (request.method, request.path))
+    g.trace.tenant = g.get("tenant", _ANONYMOUS_TENANT)
+    _trace_local.trace, _trace_local.tag = g.trace, None
+
+
+@app.after_request
+def _end_trace(resp):
+    trace = g.pop("trace", None)
+    _trace_local.trace = _trace_local.tag = None
+    if trace is None or request.method == "OPTIONS":
+        return resp
+    trace.finish(resp.status_code)
+    resp.headers["X-Trace-Id"] = trace.id
+    resp.headers["Server-Timing"] = trace.server_timing()
+    resp.headers["Timing-Allow-Origin"] = "*"
+    resp.headers["Access-Control-Expose-Headers"] = "Server-Timing, X-Trace-Id"
+    # Keep work requests (lookups, sends, jobs); polling / image / health GETs would flush the ring
+    if request.method != "GET" or resp.status_code >= 500:
+        with _traces_lock:
+            _traces.append(trace)
+    return resp
+
+
+def _log_step(
+    step_name: str, elapsed: float, extra: str = "", backend: str = "", retry: int = 0, outcome: str = "ok"
+) -> None:
+    """
+    Print the step timing, record it in viber_agent_stage_seconds{stage, backend, retry, outcome} and add it as a
+    span to the current request's trace.
+    """
+    trace, tag = _current_trace()
+    if trace is not None:
+        trace.add_span(step_name, elapsed, backend=backend, retry=retry or None, outcome=outcome, number=tag)
+    msg = f"{step_name}: {elapsed:.2f}s"
+    if retry:
+        msg += f" (retry {retry})"
     if extra:
         msg += f" — {extra}"
-    print(msg, flush=True)
+    alog.info(msg)
+    _metrics.observe(
+        "viber_agent_stage_seconds", elapsed, stage=step_name, backend=backend or "", retry=str(retry), outcome=outcome
+    )
 
 
 def _api_cost_usd(model: str, prompt_tokens: int, completion_tokens: int) -> float:
@@ -178,6 +634,164 @@ def _api_cost_usd(model: str, prompt_tokens: int, completion_tokens: int) -> flo
     return (prompt_tokens * in_p + completion_tokens * out_p) / 1_000_000
 
 
+# Callers without a key (no AGENT_API_KEY / AGENT_API_KEYS, or the open routes) all count as this tenant
+_ANONYMOUS_TENANT = "anonymous"
+
+
+class _Tenant:
+    """One API key: share of the desktop (weight), POSTs per minute and GPT OCR USD per day (0 = unlimited)."""
+
+    def __init__(self, name: str, key: str, weight: float = 1.0, rpm: int = 0, daily_usd: float = 0.0):
+        self.name = name
+        self.key = key
+        self.weight = weight
+        self.rpm = rpm
+        self.daily_usd = daily_usd
+        self.recent: deque[float] = deque()  # time.monotonic() of the POSTs of the last 60 s (only with rpm)
+        self.day = ""
+        self.spent_today = 0.0
+        self.requests = 0
+        self.rejected = {"rpm": 0, "budget": 0}
+
+
+class _OcrBudgetExceeded(RuntimeError):
+    """The calling API key has used up its daily GPT OCR budget (daily_usd in AGENT_API_KEYS)."""
+
+    def __init__(self, tenant: str):
+        super().__init__("Daily OCR budget of API key %r reached" % tenant)
+        self.tenant = tenant
+
+
+class _Tenants:
+    """
+    API key -> tenant (AGENT_API_KEYS, plus AGENT_API_KEY as "default"). Enforces each key's request rate and daily
+    OCR spend (charged from _api_cost_usd of its requests' OpenAI calls); the desktop worker reads the weights.
+    """
+
+    def __init__(self, spec: str, legacy_key: str):
+        self._by_name: dict[str, _Tenant] = {}
+        self._by_key: dict[str, _Tenant] = {}
+        self._lock = threading.Lock()
+        for i, entry in enumerate(e.strip() for e in spec.split(",")):
+            if entry:
+                self._add(self._parse(entry, i + 1))
+        if legacy_key and legacy_key not in self._by_key:
+            self._add(_Tenant("default", legacy_key))
+        self.enabled = bool(self._by_key)
+        self._by_name.setdefault(_ANONYMOUS_TENANT, _Tenant(_ANONYMOUS_TENANT, ""))
+
+    @staticmethod
+    def _parse(entry: str, n: int) -> _Tenant:
+        """name:key[:weight[:rpm[:daily_usd]]]; raises ValueError (without echoing the key)."""
+        parts = [p.strip() for p in entry.split(":")]
+        if not 2 <= len(parts) <= 5 or not parts[0] or not parts[1]:
+            raise ValueError("entry %d: expected name:key[:weight[:rpm[:daily_usd]]]" % n)
+        parts += [""] * (5 - len(parts))
+        try:
+            weight, rpm, daily_usd = float(parts[2] or 1), int(parts[3] or 0), float(parts[4] or 0)
+        except ValueError:
+            raise ValueError("entry %d (%s): weight, rpm and daily_usd must be numbers" % (n, parts[0])) from None
+        if weight <= 0 or rpm < 0 or daily_usd < 0:
+            raise ValueError("entry %d (%s): weight must be > 0, rpm and daily_usd >= 0" % (n, parts[0]))
+        return _Tenant(parts[0], parts[1], weight, rpm, daily_usd)
+
+    def _add(self, tenant: _Tenant) -> None:
+        if tenant.name in self._by_name or tenant.key in self._by_key:
+            raise ValueError("duplicate name or key (%s)" % tenant.name)
+        self._by_name[tenant.name] = tenant
+        self._by_key[tenant.key] = tenant
+
+    def by_key(self, key: str) -> _Tenant | None:
+        return self._by_key.get(key) if key else None
+
+    def weight(self, name: str) -> float:
+        tenant = self._by_name.get(name)
+        return tenant.weight if tenant else 1.0
+
+    def hit(self, name: str) -> int:
+        """Count a POST; returns 0, or (refused, not counted) the seconds until the key's rpm window has room."""
+        tenant = self._by_name.get(name)
+        if tenant is None:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            if tenant.rpm:
+                while tenant.recent and now - tenant.recent[0] >= 60:
+                    tenant.recent.popleft()
+                if len(tenant.recent) >= tenant.rpm:
+                    tenant.rejected["rpm"] += 1
+                    _metrics.inc("viber_agent_tenant_rejected_total", tenant=name, reason="rpm")
+                    return max(1, int(60 - (now - tenant.recent[0]) + 0.999))
+                tenant.recent.append(now)
+            tenant.requests += 1
+        _metrics.inc("viber_agent_tenant_requests_total", tenant=name)
+        return 0
+
+    @staticmethod
+    def _roll_locked(tenant: _Tenant) -> None:
+        today = time.strftime("%Y-%m-%d")
+        if tenant.day != today:
+            tenant.day, tenant.spent_today = today, 0.0
+
+    def charge(self, name: str, usd: float) -> None:
+        tenant = self._by_name.get(name)
+        if tenant is None or usd <= 0:
+            return
+        with self._lock:
+            self._roll_locked(tenant)
+            tenant.spent_today += usd
+        _metrics.inc("viber_agent_tenant_ocr_cost_usd_total", usd, tenant=name)
+
+    def over_budget(self, name: str) -> bool:
+        """True once the key's OCR spend today reached daily_usd (checked before each call, so one call may overshoot)."""
+        tenant = self._by_name.get(name)
+        if tenant is None or not tenant.daily_usd:
+            return False
+        with self._lock:
+            self._roll_locked(tenant)
+            return tenant.spent_today >= tenant.daily_usd
+
+    def refuse(self, name: str) -> None:
+        """Count a GPT call or OCR pass skipped because of the key's daily budget."""
+        tenant = self._by_name.get(name)
+        if tenant is None:
+            return
+        with self._lock:
+            tenant.rejected["budget"] += 1
+        _metrics.inc("viber_agent_tenant_rejected_total", tenant=name, reason="budget")
+
+    def names(self) -> list[str]:
+        return list(self._by_name)
+
+    def stats(self, name: str) -> dict:
+        tenant = self._by_name.get(name) or self._by_name[_ANONYMOUS_TENANT]
+        now = time.monotonic()
+        with self._lock:
+            self._roll_locked(tenant)
+            return {
+                "api_key": tenant.name,
+                "weight": tenant.weight,
+                "rpm": tenant.rpm or None,
+                "requests_last_minute": sum(1 for t in tenant.recent if now - t < 60) if tenant.rpm else None,
+                "daily_usd": tenant.daily_usd or None,
+                "spent_today_usd": round(tenant.spent_today, 6),
+                "requests": tenant.requests,
+                "rejected": dict(tenant.rejected),
+            }
+
+
+try:
+    _tenants = _Tenants(AGENT_API_KEYS, AGENT_API_KEY)
+except ValueError as e:
+    raise SystemExit("AGENT_API_KEYS: %s" % e)
+
+
+def _current_tenant() -> str:
+    """API key name of the request being served on this thread (carried to the desktop worker / OCR pool by _traced)."""
+    trace, _ = _current_trace()
+    return trace.tenant if trace is not None else _ANONYMOUS_TENANT
+
+
 # Strings we never treat as a person's name (app labels, UI text, etc.)
 _NOT_PERSON_NAMES = frozenset({
     "viber out", "viber", "chat", "no name found", "no name", "unknown", "contact",
@@ -219,6 +833,384 @@ def _looks_like_clean_name(s: str) -> bool:
     return True
 
 
+# Latin letters that look like Cyrillic ones (and back); OCR mixes them up within one word
+_LATIN_TO_CYRILLIC = dict(zip("aeopcxyABCEHKMOPTXkmt", "аеорсхуАВСЕНКМОРТХкмт"))
+_CYRILLIC_TO_LATIN = {c: l for l, c in _LATIN_TO_CYRILLIC.items() if l not in "kmt"}
+# Latin letters that stand for either of two Cyrillic ones (n: н typed in Latin, п misread); the dictionary decides
+_LATIN_TO_CYRILLIC_AMBIGUOUS = {"n": ("н", "п"), "b": ("ь", "б")}
+# Digits OCR reads instead of letters, by the script of the word they are in
+_DIGIT_TO_CYRILLIC = {"0": "о", "3": "з", "6": "б", "4": "ч", "@": "а"}
+_DIGIT_TO_LATIN = {"0": "o", "1": "l", "5": "s", "@": "a"}
+# Bulgarian Latin transliteration (official + common informal spellings), longest first; first option = most likely
+_TRANSLIT = (
+    ("sht", ("щ",)), ("dzh", ("дж",)), ("sch", ("щ", "ш")),
+    ("zh", ("ж",)), ("ts", ("ц",)), ("tz", ("ц",)), ("ch", ("ч",)), ("sh", ("ш",)), ("kh", ("х",)),
+    ("yu", ("ю",)), ("iu", ("ю", "иу")), ("ju", ("ю",)), ("ya", ("я",)), ("ia", ("ия", "я")), ("ja", ("я",)),
+    ("yo", ("йо", "ьо")),
+    ("a", ("а", "ъ")), ("b", ("б",)), ("c", ("ц", "к")), ("d", ("д",)), ("e", ("е",)), ("f", ("ф",)),
+    ("g", ("г",)), ("h", ("х",)), ("i", ("и", "й")), ("j", ("ж", "й")), ("k", ("к",)), ("l", ("л",)),
+    ("m", ("м",)), ("n", ("н",)), ("o", ("о",)), ("p", ("п",)), ("q", ("к",)), ("r", ("р",)), ("s", ("с",)),
+    ("t", ("т",)), ("u", ("у", "ъ")), ("v", ("в",)), ("w", ("в",)), ("x", ("кс",)), ("y", ("й", "и", "ъ")),
+    ("z", ("з",)),
+)
+_SURNAME_SUFFIXES = ("ова", "ева", "ина", "ска", "цка", "ов", "ев", "ин", "ски", "цки", "ян", "ич")
+
+
+def _is_cyrillic(c: str) -> bool:
+    return "\u0400" <= c <= "\u04ff"
+
+
+class _NameNormalizer:
+    """
+    Offline fix for OCR'd contact names, instead of the gpt_fix_contact_name round trip: unmixes Latin/Cyrillic
+    homoglyphs and digit look-alikes, transliterates Latin words to Bulgarian Cyrillic, and scores each word against
+    the bundled first-name/surname dictionary (NAME_DICT_PATH, indexed by first letter for one-typo matches).
+    normalize() returns (name, score 0..1); the score is that of the weakest word.
+    """
+
+    def __init__(self, path: str):
+        self.words: set[str] = set()
+        self.by_initial: dict[str, list[str]] = {}
+        self.fixed = 0
+        self.escalated = 0
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    word = line.strip().lower()
+                    if not word or word.startswith("#"):
+                        continue
+                    self._add(word)
+                    if word.endswith(("ов", "ев", "ин")):
+                        self._add(word + "а")
+                    elif word.endswith(("ски", "цки")):
+                        self._add(word[:-1] + "а")
+        except OSError as e:
+            alog.info("name dictionary not loaded (%s): local name fixing without dictionary", e)
+
+    def _add(self, word: str) -> None:
+        if word not in self.words:
+            self.words.add(word)
+            self.by_initial.setdefault(word[0], []).append(word)
+
+    def normalize(self, raw: str, transliterate: bool = True) -> tuple[str, float]:
+        """
+        Fixed name and its score. With transliterate=False only homoglyphs/digits inside mixed words are fixed
+        (for names that already look clean, e.g. a contact saved in Latin); such fixed words are still scored against
+        the dictionary, untouched ones score 1.0.
+        """
+        words = []
+        score = 1.0
+        for token in raw.replace("_", " ").split():
+            parts = []
+            for part in token.split("-"):
+                part = part.strip(".,;:!?\"'()[]{}|/\\*")
+                if not part:
+                    continue
+                word, word_score = self._word(part, transliterate)
+                if not word:
+                    continue
+                parts.append(word)
+                score = min(score, word_score)
+            if parts:
+                words.append("-".join(parts))
+        if not words:
+            return "", 0.0
+        return " ".join(words), score
+
+    def _word(self, part: str, transliterate: bool) -> tuple[str, float]:
+        cyr = sum(1 for c in part if _is_cyrillic(c))
+        lat = sum(1 for c in part if c.isascii() and c.isalpha())
+        if cyr and (cyr >= lat or any(_is_cyrillic(c) and c not in _CYRILLIC_TO_LATIN for c in part)):
+            spellings = [""]
+            for c in part:
+                options = _LATIN_TO_CYRILLIC_AMBIGUOUS.get(c) or (_LATIN_TO_CYRILLIC.get(c) or _DIGIT_TO_CYRILLIC.get(c, c),)
+                spellings = [w + o for w in spellings for o in options][:16]
+        elif lat:
+            spellings = ["".join(_CYRILLIC_TO_LATIN.get(c) or _DIGIT_TO_LATIN.get(c, c) for c in part)]
+        else:
+            return "", 0.0
+        spellings = ["".join(c for c in w if c.isalpha() or c == "'") for w in spellings]
+        word = spellings[0]
+        if not word:
+            return "", 0.0
+        if not any(_is_cyrillic(c) for c in word):
+            if not transliterate:
+                return word, 1.0
+            cyrillic, score = self._best_transliteration(word.lower())
+            if cyrillic is None:
+                return word, 0.4
+            return cyrillic.capitalize(), score
+        # Letters were replaced (mixed scripts, digits): only the dictionary can tell whether they were the right ones
+        if not transliterate and word == part:
+            return word, 1.0
+        best, match, score = word, None, -1.0
+        for spelling in spellings:
+            spelling_match, spelling_score = self._lookup(spelling.lower())
+            if spelling_score > score:
+                best, match, score = spelling, spelling_match, spelling_score
+        if not transliterate:
+            return best, score
+        return (match or best.lower()).capitalize(), score
+
+    def _lookup(self, word: str, fuzzy: bool = True) -> tuple[str | None, float]:
+        """(dictionary form, score): exact 1.0, one edit away 0.85 (OCR typo), surname-shaped 0.8, unknown 0.5."""
+        if word in self.words:
+            return word, 1.0
+        if fuzzy and len(word) >= 4:
+            for cand in self.by_initial.get(word[0], ()):
+                if abs(len(cand) - len(word)) <= 1 and _within_one_edit(word, cand):
+                    return cand, 0.85
+        if len(word) >= 4 and word.endswith(_SURNAME_SUFFIXES):
+            return word, 0.8
+        return None, 0.5
+
+    def _best_transliteration(self, word: str, limit: int = 64) -> tuple[str | None, float]:
+        """Most likely Cyrillic spelling of a Latin word: best dictionary score, earliest (most usual) spelling first."""
+        candidates = [""]
+        i = 0
+        while i < len(word):
+            for latin, options in _TRANSLIT:
+                if word.startswith(latin, i):
+                    candidates = [c + o for c in candidates for o in options][:limit]
+                    i += len(latin)
+                    break
+            else:
+                if word[i] != "'":
+                    return None, 0.0
+                i += 1
+        best, best_score = None, 0.0
+        for cand in candidates:
+            # No typo matching here: one of the many spellings is usually one edit from some other name
+            match, score = self._lookup(cand, fuzzy=False)
+            if score > best_score:
+                best, best_score = match or cand, score
+            if score == 1.0:
+                break
+        return best, best_score
+
+    def fix(self, raw: str) -> str:
+        """
+        Name to use for an OCR'd line: clean-looking names only get homoglyphs unmixed; others are fixed locally. Either
+        is sent to gpt_fix_contact_name only when the local score is below NAME_FIX_MIN_SCORE (never with
+        SKIP_FIX_NAME), e.g. a clean-looking name whose unmixed word is not in the dictionary.
+        """
+        t0 = time.monotonic()
+        clean = _looks_like_clean_name(raw)
+        name, score = self.normalize(raw, transliterate=not clean)
+        if SKIP_FIX_NAME or (name and score >= NAME_FIX_MIN_SCORE):
+            self.fixed += 1
+            _log_step("fix name (local)", time.monotonic() - t0, "%r -> %r score=%.2f" % (raw, name, score),
+                      backend="local")
+            return name if name else raw
+        self.escalated += 1
+        log.debug("local name fix %r -> %r score=%.2f below %.2f, asking GPT", raw, name, score, NAME_FIX_MIN_SCORE)
+        return gpt_fix_contact_name(raw)
+
+    def stats(self) -> dict:
+        return {"dictionary": len(self.words), "fixed_locally": self.fixed, "escalated": self.escalated}
+
+
+def _within_one_edit(a: str, b: str) -> bool:
+    """True if a and b differ by at most one insertion, deletion, substitution or adjacent swap."""
+    if a == b:
+        return True
+    if len(a) == len(b):
+        diff = [i for i in range(len(a)) if a[i] != b[i]]
+        return len(diff) == 1 or (
+            len(diff) == 2 and diff[1] == diff[0] + 1 and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]]
+        )
+    if len(a) > len(b):
+        a, b = b, a
+    if len(b) - len(a) != 1:
+        return False
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    return a[i:] == b[i + 1:]
+
+
+_name_normalizer = _NameNormalizer(NAME_DICT_PATH)
+
+
+def _parse_reset_seconds(value: str | None) -> float:
+    """Parse x-ratelimit-reset-* durations like '1s', '6m0s', '250ms' into seconds (0 if unknown)."""
+    if not value:
+        return 0.0
+    total, num = 0.0, ""
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c.isdigit() or c == ".":
+            num += c
+        elif num:
+            unit = "ms" if value[i:i + 2] == "ms" else c
+            total += float(num) * {"h": 3600, "m": 60, "s": 1, "ms": 0.001}.get(unit, 0)
+            num = ""
+            i += len(unit) - 1
+        i += 1
+    return total + (float(num) if num else 0.0)
+
+
+class _RateLimiter:
+    """
+    Token buckets for requests/min and tokens/min. acquire() waits (up to the call deadline) until both have room.
+    Response headers (x-ratelimit-remaining-*, x-ratelimit-reset-*, retry-after) pull the buckets down to what the
+    API says is left, so bursts are smoothed before they turn into 429s.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = max(1, rpm)
+        self.tpm = max(1, tpm)
+        self._requests = float(self.rpm)
+        self._tokens = float(self.tpm)
+        self._blocked_until = 0.0
+        self._last = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill_locked(self) -> None:
+        now = time.monotonic()
+        dt = now - self._last
+        self._last = now
+        self._requests = min(self.rpm, self._requests + dt * self.rpm / 60.0)
+        self._tokens = min(self.tpm, self._tokens + dt * self.tpm / 60.0)
+
+    def acquire(self, tokens: int, deadline: float) -> None:
+        """Take one request and `tokens` tokens; raises TimeoutError if that is not possible before deadline."""
+        tokens = min(tokens, self.tpm)
+        with self._cond:
+            while True:
+                self._refill_locked()
+                now = time.monotonic()
+                if now >= self._blocked_until and self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max(
+                    self._blocked_until - now,
+                    (1 - self._requests) * 60.0 / self.rpm,
+                    (tokens - self._tokens) * 60.0 / self.tpm,
+                    0.01,
+                )
+                if now + wait > deadline:
+                    raise TimeoutError("OpenAI rate limit: no capacity before deadline")
+                self._cond.wait(wait)
+
+    def refund(self, tokens: int) -> None:
+        """Give back over-estimated tokens once the real usage is known."""
+        if tokens > 0:
+            with self._cond:
+                self._tokens = min(self.tpm, self._tokens + tokens)
+                self._cond.notify_all()
+
+    def update_from_headers(self, headers) -> None:
+        if not headers:
+            return
+        with self._cond:
+            self._refill_locked()
+            try:
+                rem_req = headers.get("x-ratelimit-remaining-requests")
+                if rem_req is not None:
+                    self._requests = min(self._requests, float(rem_req))
+                    if float(rem_req) <= 0:
+                        reset = _parse_reset_seconds(headers.get("x-ratelimit-reset-requests"))
+                        self._blocked_until = max(self._blocked_until, time.monotonic() + reset)
+                rem_tok = headers.get("x-ratelimit-remaining-tokens")
+                if rem_tok is not None:
+                    self._tokens = min(self._tokens, float(rem_tok))
+                retry_after = headers.get("retry-after")
+                if retry_after is not None:
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + float(retry_after))
+            except (TypeError, ValueError):
+                pass
+
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+_openai_limiter = _RateLimiter(OPENAI_RPM, OPENAI_TPM)
+
+
+def _get_openai_client():
+    """Process-wide OpenAI client (reuses HTTP keep-alive connections and TLS sessions across calls)."""
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            kwargs = {"api_key": _get_openai_key(), "timeout": OPENAI_TIMEOUT, "max_retries": 0}
+            if httpx is not None:
+                kwargs["http_client"] = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS
+                    ),
+                    timeout=OPENAI_TIMEOUT,
+                )
+            _openai_client = OpenAI(**kwargs)
+        return _openai_client
+
+
+def _is_retryable_openai_error(e: Exception) -> bool:
+    if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(e, openai.RateLimitError):
+        return getattr(e, "code", None) != "insufficient_quota"  # quota exhausted won't fix itself
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+
+def _openai_chat(model: str, messages: list, max_tokens: int, est_prompt_tokens: int, timeout: float | None = None):
+    """
+    chat.completions.create through the shared client, rate limiter and retry policy.
+    The whole call (waiting for capacity, retries, backoff) must finish within timeout (default OPENAI_TIMEOUT).
+    The cost is charged to the calling API key; raises _OcrBudgetExceeded once that key's daily budget is used up.
+    """
+    tenant = _current_tenant()
+    if _tenants.over_budget(tenant):
+        _tenants.refuse(tenant)
+        raise _OcrBudgetExceeded(tenant)
+    client = _get_openai_client()
+    deadline = time.monotonic() + (timeout or OPENAI_TIMEOUT)
+    est_tokens = est_prompt_tokens + max_tokens
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        _openai_limiter.acquire(est_tokens, deadline)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("OpenAI call deadline exceeded")
+        try:
+            raw = client.with_options(timeout=remaining).chat.completions.with_raw_response.create(
+                model=model, messages=messages, max_tokens=max_tokens
+            )
+            _openai_limiter.update_from_headers(raw.headers)
+            response = raw.parse()
+            usage = getattr(response, "usage", None)
+            if usage:
+                _openai_limiter.refund(est_tokens - (getattr(usage, "total_tokens", 0) or est_tokens))
+                p_tok = getattr(usage, "prompt_tokens", 0) or 0
+                c_tok = getattr(usage, "completion_tokens", 0) or 0
+                _metrics.inc("viber_agent_openai_tokens_total", p_tok, model=model, kind="prompt")
+                _metrics.inc("viber_agent_openai_tokens_total", c_tok, model=model, kind="completion")
+                cost = _api_cost_usd(model, p_tok, c_tok)
+                _metrics.inc("viber_agent_openai_cost_usd_total", cost, model=model)
+                _tenants.charge(tenant, cost)
+            _metrics.inc("viber_agent_openai_requests_total", model=model, outcome="ok")
+            return response
+        except Exception as e:
+            if not HAS_OPENAI or not _is_retryable_openai_error(e) or attempt == OPENAI_MAX_RETRIES:
+                _metrics.inc("viber_agent_openai_requests_total", model=model, outcome=type(e).__name__)
+                raise
+            resp = getattr(e, "response", None)
+            headers = getattr(resp, "headers", None)
+            _openai_limiter.update_from_headers(headers)
+            backoff = OPENAI_RETRY_BASE * (2 ** attempt) * random.uniform(0.5, 1.5)
+            try:
+                backoff = max(backoff, float((headers or {}).get("retry-after") or 0))
+            except (TypeError, ValueError):
+                pass
+            if time.monotonic() + backoff >= deadline:
+                _metrics.inc("viber_agent_openai_requests_total", model=model, outcome=type(e).__name__)
+                raise
+            _metrics.inc("viber_agent_openai_retries_total", model=model, reason=type(e).__name__)
+            log.warning("OpenAI %s (attempt %d), retrying in %.2fs", type(e).__name__, attempt + 1, backoff)
+            time.sleep(backoff)
+    raise TimeoutError("OpenAI retries exhausted")
+
+
 def gpt_fix_contact_name(raw_name: str) -> str:
     """
     Ask GPT to correct the name: proper Cyrillic spelling, valid person's name. Returns corrected name or "".
@@ -226,12 +1218,11 @@ def gpt_fix_contact_name(raw_name: str) -> str:
     if not raw_name or not _has_gpt_ocr():
         return raw_name or ""
     try:
-        client = OpenAI(api_key=_get_openai_key())
         model = os.environ.get("OPENAI_OCR_MODEL", "gpt-4o-mini")
         t0 = time.monotonic()
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
+        response = _openai_chat(
+            model,
+            [
                 {
                     "role": "user",
                     "content": (
@@ -244,6 +1235,7 @@ def gpt_fix_contact_name(raw_name: str) -> str:
                 }
             ],
             max_tokens=80,
+            est_prompt_tokens=150,
         )
         elapsed = time.monotonic() - t0
         out = (response.choices[0].message.content or "").strip()
@@ -252,9 +1244,9 @@ def gpt_fix_contact_name(raw_name: str) -> str:
         usage = getattr(response, "usage", None)
         if usage:
             cost = _api_cost_usd(model, getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
-            _log_step("GPT fix name (API)", elapsed, f"tokens in={getattr(usage,'prompt_tokens',0)} out={getattr(usage,'completion_tokens',0)} ~${cost:.6f}")
+            _log_step("GPT fix name (API)", elapsed, f"tokens in={getattr(usage,'prompt_tokens',0)} out={getattr(usage,'completion_tokens',0)} ~${cost:.6f}", backend=model)
         else:
-            _log_step("GPT fix name (API)", elapsed)
+            _log_step("GPT fix name (API)", elapsed, backend=model)
         log.debug("GPT fix name: %r -> %r", raw_name, out)
         return out
     except Exception as e:
@@ -262,115 +1254,497 @@ def gpt_fix_contact_name(raw_name: str) -> str:
         return raw_name
 
 
+# Same text for every Vision call (both cascade passes) and placed first, so provider-side prompt caching can reuse it
+_VISION_SYSTEM_PROMPT = (
+    "You read contact names from crops of a Viber chat window's contact panel. The CONTACT NAME (the person's name) "
+    "is in the BOTTOM-LEFT of the panel; the image may be only that part of it. "
+    "Your task: On the FIRST line write ONLY the real person's name (first/last name). On the next line write a dash '-', "
+    "then list any other text. If you only see app labels (e.g. 'Viber Out', buttons, icons) or no clear person name, "
+    "write 'No name found' on the first line."
+)
+
+
+def _vision_image_tokens(width: int, height: int, detail: str) -> int:
+    """OpenAI image token cost: 85 for low detail; high = 85 + 170 per 512px tile after the API's own rescaling."""
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return 85 + 170 * (-(-int(w) // 512)) * (-(-int(h) // 512))
+
+
+def _png_size(png_bytes: bytes) -> tuple[int, int]:
+    from PIL import Image
+    return Image.open(io.BytesIO(png_bytes)).size
+
+
+def _prepare_vision_image(png_bytes: bytes) -> tuple[bytes, int, int, int, int]:
+    """
+    Cheap-pass image: crop a panel to the name region (OCR_NAME_CROP), downscale to OCR_VISION_MAX_SIDE, grayscale.
+    Larger images (full window fallback) are only downscaled. Returns (png, width, height, orig_width, orig_height).
+    """
+    from PIL import Image
+    im = Image.open(io.BytesIO(png_bytes))
+    ow, oh = im.size
+    if oh <= PANEL_HEIGHT:
+        try:
+            fl, ft, fr, fb = (float(x) for x in OCR_NAME_CROP.split(","))
+            im = im.crop((int(ow * fl), int(oh * ft), int(ow * fr), int(oh * fb)))
+        except ValueError:
+            pass
+    if OCR_VISION_GRAYSCALE:
+        im = im.convert("L")
+    if max(im.size) > OCR_VISION_MAX_SIDE:
+        im.thumbnail((OCR_VISION_MAX_SIDE, OCR_VISION_MAX_SIDE), Image.LANCZOS)
+    buf = io.BytesIO()
+    im.save(buf, format="PNG", optimize=True)
+    return buf.getvalue(), im.width, im.height, ow, oh
+
+
+def _gpt_vision_pass(png_bytes: bytes, model: str, detail: str, label: str, baseline_tokens: int) -> str:
+    """One Vision call. Logs tokens, cost and the image-token saving against sending the full panel at high detail."""
+    b64 = base64.b64encode(png_bytes).decode("ascii")
+    sent_tokens = _vision_image_tokens(*_png_size(png_bytes), detail)
+    log.debug("GPT Vision model=%s detail=%s (%s)", model, detail, label)
+    t0 = time.monotonic()
+    response = _openai_chat(
+        model,
+        [
+            {"role": "system", "content": _VISION_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": [{"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64}", "detail": detail}}],
+            },
+        ],
+        max_tokens=300,
+        est_prompt_tokens=150 + sent_tokens,
+    )
+    elapsed = time.monotonic() - t0
+    raw = (response.choices[0].message.content or "").strip()
+    usage = getattr(response, "usage", None)
+    if usage:
+        p_tok = getattr(usage, "prompt_tokens", 0) or 0
+        c_tok = getattr(usage, "completion_tokens", 0) or 0
+        cost = _api_cost_usd(model, p_tok, c_tok)
+        saved_usd = _api_cost_usd(model, baseline_tokens - sent_tokens, 0)
+        _log_step(
+            "GPT Vision OCR (API, %s)" % label, elapsed,
+            f"tokens in={p_tok} out={c_tok} ~${cost:.6f}; image tokens {sent_tokens} vs {baseline_tokens} full panel"
+            f" (saved ~${saved_usd:.6f})",
+            backend=model,
+        )
+    else:
+        _log_step("GPT Vision OCR (API, %s)" % label, elapsed, backend=model)
+    log.debug("GPT raw=%r", raw[:300] if len(raw) > 300 else raw)
+    return raw
+
+
+def _parse_vision_name(raw: str) -> tuple[str, bool]:
+    """
+    First non-label line of the Vision answer as the contact name (fixed by _name_normalizer; GPT only when the local
+    fix is not confident). Returns (contact_name or "", had_candidate) — had_candidate is True when a line was rejected as implausible.
+    """
+    lines = [ln.strip() for ln in raw.splitlines() if ln.strip()]
+    # First line is the contact name; skip only obvious non-names
+    _skip = {"", "no name found", "-", "viber out", "viber"}
+    for line in lines:
+        if line.lower() in _skip:
+            if line.lower() == "no name found":
+                return "", False
+            continue
+        contact_name = _name_normalizer.fix(line.strip())
+        if not _is_plausible_person_name(contact_name):
+            log.debug("OCR name rejected (not a person name): %r", contact_name)
+            return "", True
+        return contact_name, False
+    return "", False
+
+
 def ocr_image_gpt(png_bytes: bytes) -> tuple[str, str]:
     """
     Use GPT Vision to extract text and contact name from the image. Returns (full_text, contact_name).
-    Then ask GPT again to fix/normalize the name (Cyrillic, correct spelling).
+    The name is fixed locally (_name_normalizer.fix); GPT is asked again to fix it only when the local score is low.
+    Cheap pass first (name crop, low detail); escalates to the full panel at high detail on
+    OPENAI_OCR_ESCALATE_MODEL only when the cheap pass yields an implausible name (OCR_CASCADE).
     """
     if not _has_gpt_ocr():
         return "", ""
     try:
-        client = OpenAI(api_key=_get_openai_key())
-        b64 = base64.b64encode(png_bytes).decode("ascii")
         model = os.environ.get("OPENAI_OCR_MODEL", "gpt-4o-mini")
-        log.debug("GPT Vision model=%s", model)
-        t0 = time.monotonic()
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": (
-                                "This image is a crop from a Viber chat window (right-side panel). The CONTACT NAME (the person's name) is in the BOTTOM-LEFT of this image. "
-                                "Your task: On the FIRST line write ONLY the real person's name (first/last name). On the next line write a dash '-', then list any other text. "
-                                "If you only see app labels (e.g. 'Viber Out', buttons, icons) or no clear person name, write 'No name found' on the first line."
-                            ),
-                        },
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64}"}},
-                    ],
-                }
-            ],
-            max_tokens=300,
-        )
-        elapsed = time.monotonic() - t0
-        raw = (response.choices[0].message.content or "").strip()
-        usage = getattr(response, "usage", None)
-        if usage:
-            cost = _api_cost_usd(model, getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
-            _log_step("GPT Vision OCR (API)", elapsed, f"tokens in={getattr(usage,'prompt_tokens',0)} out={getattr(usage,'completion_tokens',0)} ~${cost:.6f}")
-        else:
-            _log_step("GPT Vision OCR (API)", elapsed)
-        log.debug("GPT raw=%r", raw[:300] if len(raw) > 300 else raw)
-        lines = [ln.strip() for ln in raw.splitlines() if ln.strip()]
-        contact_name = ""
-        # First line is the contact name; skip only obvious non-names
-        _skip = {"", "no name found", "-", "viber out", "viber"}
-        for line in lines:
-            if line.lower() in _skip:
-                continue
-            line = line.strip()
-            if SKIP_FIX_NAME or _looks_like_clean_name(line):
-                contact_name = line
-                log.debug("OCR name used as-is (skip fix): %r", contact_name)
-            else:
-                contact_name = gpt_fix_contact_name(line)
-            if not _is_plausible_person_name(contact_name):
-                log.debug("OCR name rejected (not a person name): %r", contact_name)
-                contact_name = ""
-            break
+        ow, oh = _png_size(png_bytes)
+        baseline = _vision_image_tokens(ow, oh, "high")
+        try:
+            cheap_png = _prepare_vision_image(png_bytes)[0]
+        except Exception as e:
+            log.debug("vision preprocessing failed (%s), sending original", e)
+            cheap_png = png_bytes
+        raw = _gpt_vision_pass(cheap_png, model, OCR_VISION_DETAIL, "cheap", baseline)
+        contact_name, implausible = _parse_vision_name(raw)
+        if implausible and OCR_CASCADE:
+            log.debug("cheap pass implausible, escalating to %s full panel", OPENAI_OCR_ESCALATE_MODEL)
+            raw = _gpt_vision_pass(png_bytes, OPENAI_OCR_ESCALATE_MODEL, "high", "escalated", baseline)
+            contact_name, _ = _parse_vision_name(raw)
         return raw, contact_name
     except Exception as e:
         log.exception("GPT OCR failed: %s", e)
         return "", ""
 
 
-def _digits_only(phone_number: str) -> str:
-    """Return digits only (no normalization)."""
-    return "".join(c for c in phone_number if c.isdigit())
+_tesseract_ok: bool | None = None
 
 
-def _close_viber_window_if_open() -> None:
-    """Close the Viber window (without killing the process) so the next viber:// opens the right chat."""
-    if not HAS_PYWINAUTO or not os.path.isfile(VIBER_EXE):
-        return
-    try:
-        app = Application(backend="uia").connect(path=VIBER_EXE, timeout=1)
-        dlg = app.top_window()
-        dlg.close()
-        time.sleep(1.2)
-    except Exception:
-        pass
+def _has_local_ocr() -> bool:
+    """True if pytesseract is installed and the Tesseract binary runs (checked once)."""
+    global _tesseract_ok
+    if _tesseract_ok is None:
+        _tesseract_ok = False
+        if HAS_TESSERACT_PY:
+            if OCR_TESSERACT_CMD:
+                pytesseract.pytesseract.tesseract_cmd = OCR_TESSERACT_CMD
+            try:
+                pytesseract.get_tesseract_version()
+                _tesseract_ok = True
+            except Exception as e:
+                alog.info("local OCR unavailable: %s", e)
+    return _tesseract_ok
 
 
-def open_viber_chat(phone_number: str) -> str | None:
+def ocr_image_local(png_bytes: bytes) -> tuple[str, str, float]:
     """
-    Open Viber chat with the given number via viber://chat?number=...
-    Uses digits as-is (e.g. 0877315132). On Windows uses os.startfile() so the link
-    goes straight to Viber instead of via the browser (faster).
-    Returns None on success, or an error message string.
+    Read the panel with Tesseract on this PC (no network). Returns (full_text, contact_name, confidence 0..1).
+    The name is the first plausible person-name line; confidence is that line's mean word confidence.
     """
-    digits = _digits_only(phone_number)
-    if not digits:
-        return "No valid phone number provided"
-    url = f"viber://chat?number={digits}"
+    if not _has_local_ocr():
+        return "", "", 0.0
     try:
-        if sys.platform == "win32":
-            os.startfile(url)
-        else:
-            webbrowser.open(url)
-        return None
+        from PIL import Image, ImageOps
+        t0 = time.monotonic()
+        im = Image.open(io.BytesIO(png_bytes)).convert("L")
+        # Upscale small UI text and stretch contrast: Tesseract is tuned for ~300 DPI print
+        im = ImageOps.autocontrast(im.resize((im.width * 2, im.height * 2), Image.LANCZOS))
+        data = pytesseract.image_to_data(im, lang=OCR_TESSERACT_LANG, output_type=pytesseract.Output.DICT)
+        lines: OrderedDict[tuple, list] = OrderedDict()
+        for i, word in enumerate(data["text"]):
+            word = (word or "").strip()
+            conf = float(data["conf"][i])
+            if not word or conf < 0:
+                continue
+            lines.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append((word, conf))
+        text_lines = [(" ".join(w for w, _ in ws), sum(c for _, c in ws) / len(ws) / 100.0) for ws in lines.values()]
+        full_text = "\n".join(t for t, _ in text_lines)
+        contact_name, confidence = "", 0.0
+        for line, conf in text_lines:
+            if _is_plausible_person_name(line) and _looks_like_clean_name(line):
+                contact_name, score = _name_normalizer.normalize(line, transliterate=False)
+                # An unmixed word that is not in the dictionary lowers the confidence -> next backend
+                confidence = min(conf, score)
+                break
+        _log_step(
+            "local OCR (Tesseract)", time.monotonic() - t0, "name=%r conf=%.2f" % (contact_name, confidence),
+            backend="local", outcome="ok" if contact_name else "no_name",
+        )
+        return full_text, contact_name, confidence
     except Exception as e:
-        return str(e)
+        log.warning("local OCR failed: %s", e)
+        return "", "", 0.0
 
 
-def connect_to_viber_window():
-    """
-    Wait for Viber window to appear and return (Application, window_rect_dict) for mss.
-    rect_dict is {"left", "top", "width", "height"} in screen coordinates.
-    Returns (None, None, error_str) on failure.
+def _ocr_backend_gpt(png_bytes: bytes) -> tuple[str, str, float]:
+    text, name = ocr_image_gpt(png_bytes)
+    return text, name, 1.0 if name else 0.0
+
+
+def _gpt_ocr_allowed() -> bool:
+    """GPT Vision is configured and the calling API key has not used up its daily OCR budget."""
+    return _has_gpt_ocr() and not _tenants.over_budget(_current_tenant())
+
+
+# name -> (ocr function returning (full_text, contact_name, confidence 0..1), availability check)
+_OCR_BACKENDS = {
+    "local": (ocr_image_local, _has_local_ocr),
+    "gpt": (_ocr_backend_gpt, _gpt_ocr_allowed),
+}
+
+
+def _parse_ocr_chain(spec: str | None) -> list[str] | None:
+    """'local,gpt' -> ["local", "gpt"]; default OCR_CHAIN when spec is empty; None if it names an unknown backend."""
+    names = [n.strip().lower() for n in (spec or OCR_CHAIN).split(",") if n.strip()]
+    if not names or any(n not in _OCR_BACKENDS for n in names):
+        return None
+    return names
+
+
+def _available_ocr_backends(chain: list[str] | None = None) -> list[str]:
+    return [n for n in (chain or _parse_ocr_chain(None) or []) if _OCR_BACKENDS[n][1]()]
+
+
+def _has_any_ocr() -> bool:
+    return bool(_available_ocr_backends())
+
+
+def ocr_image(png_bytes: bytes, chain: list[str] | None = None) -> tuple[str, str, str]:
+    """
+    Run the OCR fallback chain. Returns (full_text, contact_name, backend_name).
+    A backend's result is accepted when the name is plausible and its confidence reaches OCR_LOCAL_MIN_CONFIDENCE
+    (the last available backend is always accepted). Otherwise the next backend is tried.
+    """
+    backends = _available_ocr_backends(chain)
+    best = ("", "", "")
+    for i, name in enumerate(backends):
+        fn = _OCR_BACKENDS[name][0]
+        text, contact_name, confidence = fn(png_bytes)
+        if contact_name and not _is_plausible_person_name(contact_name):
+            contact_name = ""
+        if contact_name and (confidence >= OCR_LOCAL_MIN_CONFIDENCE or i == len(backends) - 1):
+            return text, contact_name, name
+        if (contact_name and not best[1]) or (text and not best[0]):
+            best = (text, contact_name, name)
+        if i < len(backends) - 1:
+            log.debug("OCR %s not confident (name=%r conf=%.2f), trying %s", name, contact_name, confidence, backends[i + 1])
+    return best
+
+
+def _digits_only(phone_number: str) -> str:
+    """Return digits only (no normalization)."""
+    return "".join(c for c in phone_number if c.isdigit())
+
+
+def _normalize_number(phone_number: str) -> str:
+    """
+    Key for caching/coalescing a number's lookup (same person -> same key): international digits without "+".
+    0877315132, +359877315132 and 00359877315132 all give 359877315132 (national numbers use DEFAULT_COUNTRY_CODE).
+    """
+    digits = _digits_only(phone_number)
+    if phone_number.strip().startswith("+"):
+        return digits
+    if digits.startswith("00"):
+        return digits[2:]
+    if digits.startswith("0") and DEFAULT_COUNTRY_CODE:
+        return DEFAULT_COUNTRY_CODE + digits[1:]
+    return digits
+
+
+class _LookupCache:
+    """
+    Lookup results keyed by normalized number: contact_name, panel_text and the panel PNG.
+    Memory LRU (LOOKUP_CACHE_MAX_ITEMS) in front of a SQLite tier (LOOKUP_CACHE_DB) that survives restarts.
+    Results without a name expire after LOOKUP_CACHE_NEGATIVE_TTL instead of LOOKUP_CACHE_TTL.
+    """
+
+    def __init__(self, db_path: str):
+        self._mem: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self.hits = 0
+        self.misses = 0
+        if db_path and db_path.lower() not in ("off", "0", "none"):
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS lookups ("
+                    " key TEXT PRIMARY KEY, number TEXT, contact_name TEXT, panel_text TEXT,"
+                    " panel_png BLOB, created REAL, expires REAL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS lookups_created ON lookups (created)")
+                self._db.execute("DELETE FROM lookups WHERE expires <= ?", (time.time(),))
+                self._db.commit()
+            except Exception as e:
+                alog.info("lookup cache: SQLite disabled (%s)", e)
+                self._db = None
+
+    def get(self, number: str) -> dict | None:
+        key = _normalize_number(number)
+        if not key:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is None and self._db is not None:
+                row = self._db.execute(
+                    "SELECT number, contact_name, panel_text, panel_png, created, expires FROM lookups WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row:
+                    entry = dict(zip(("number", "contact_name", "panel_text", "panel_png", "created", "expires"), row))
+                    self._remember_locked(key, entry)
+            if entry is not None and entry["expires"] <= now:
+                self._forget_locked(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._mem.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, number: str, contact_name: str, panel_text: str, panel_png: bytes | None) -> None:
+        key = _normalize_number(number)
+        if not key:
+            return
+        now = time.time()
+        ttl = LOOKUP_CACHE_TTL if contact_name else LOOKUP_CACHE_NEGATIVE_TTL
+        entry = {
+            "number": number,
+            "contact_name": contact_name or "",
+            "panel_text": panel_text or "",
+            "panel_png": panel_png,
+            "created": now,
+            "expires": now + ttl,
+        }
+        with self._lock:
+            self._remember_locked(key, entry)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO lookups (key, number, contact_name, panel_text, panel_png, created, expires)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, number, entry["contact_name"], entry["panel_text"], panel_png, now, entry["expires"]),
+                    )
+                    self._db.execute(
+                        "DELETE FROM lookups WHERE key IN (SELECT key FROM lookups ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                        (LOOKUP_CACHE_DISK_MAX_ITEMS,),
+                    )
+                    self._db.commit()
+                except Exception as e:
+                    log.warning("lookup cache write failed: %s", e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"items": len(self._mem), "hits": self.hits, "misses": self.misses, "disk": self._db is not None}
+
+    def _remember_locked(self, key: str, entry: dict) -> None:
+        self._mem[key] = entry
+        self._mem.move_to_end(key)
+        while len(self._mem) > LOOKUP_CACHE_MAX_ITEMS:
+            self._mem.popitem(last=False)
+
+    def _forget_locked(self, key: str) -> None:
+        self._mem.pop(key, None)
+        if self._db is not None:
+            try:
+                self._db.execute("DELETE FROM lookups WHERE key = ?", (key,))
+                self._db.commit()
+            except Exception:
+                pass
+
+
+_lookup_cache = _LookupCache(LOOKUP_CACHE_DB)
+
+
+class _ImageStore:
+    """
+    Content-addressed, size-bounded (IMAGE_STORE_MAX_MB) LRU of captured images, served by GET /images/<id>.
+    The id is a SHA-256 prefix of the bytes, so identical panels are stored once and their URL never changes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict[str, bytes] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def put(self, data: bytes) -> str:
+        image_id = hashlib.sha256(data).hexdigest()[:32]
+        with self._lock:
+            if image_id in self._items:
+                self._items.move_to_end(image_id)
+                return image_id
+            self._items[image_id] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self._bytes -= len(old)
+                self.evicted += 1
+        return image_id
+
+    def get(self, image_id: str) -> bytes | None:
+        with self._lock:
+            data = self._items.get(image_id)
+            if data is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(image_id)
+            self.hits += 1
+            return data
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "items": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted,
+            }
+
+
+_image_store = _ImageStore(int(IMAGE_STORE_MAX_MB * 1024 * 1024))
+
+
+def _add_image(out: dict, field: str, data: bytes, inline: bool) -> None:
+    """Store data and set out["<field>_url"] (plus out["<field>_base64"] when inline)."""
+    out[field + "_url"] = "/images/%s" % _image_store.put(data)
+    if inline:
+        out[field + "_base64"] = base64.b64encode(data).decode("ascii")
+
+
+def _lookup_result_from_cache(entry: dict, number: str, only_panel: bool, inline: bool = False) -> dict:
+    """Build the /check-number-base64 JSON body from a cache entry (same shape as a fresh lookup, plus cached=true)."""
+    out = {"number": number, "cached": True, "cached_at": entry["created"]}
+    if entry["panel_png"] is not None:
+        _add_image(out, "panel" if only_panel else "contact_panel", entry["panel_png"], inline)
+        out["image_mime"] = _image_mime(entry["panel_png"])
+    out["panel_text"] = entry["panel_text"] or "(no text detected)"
+    if entry["contact_name"]:
+        out["contact_name"] = entry["contact_name"]
+    return out
+
+
+def _close_viber_window_if_open() -> None:
+    """Close the Viber window (without killing the process) so the next viber:// opens the right chat."""
+    if not HAS_PYWINAUTO or not os.path.isfile(VIBER_EXE):
+        return
+    try:
+        app = Application(backend="uia").connect(path=VIBER_EXE, timeout=1)
+        dlg = app.top_window()
+        dlg.close()
+        time.sleep(1.2)
+    except Exception:
+        pass
+
+
+def open_viber_chat(phone_number: str) -> str | None:
+    """
+    Open Viber chat with the given number via viber://chat?number=...
+    Uses digits as-is (e.g. 0877315132). On Windows uses os.startfile() so the link
+    goes straight to Viber instead of via the browser (faster).
+    Returns None on success, or an error message string.
+    """
+    digits = _digits_only(phone_number)
+    if not digits:
+        return "No valid phone number provided"
+    url = f"viber://chat?number={digits}"
+    try:
+        if sys.platform == "win32":
+            os.startfile(url)
+        else:
+            webbrowser.open(url)
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def connect_to_viber_window():
+    """
+    Wait for Viber window to appear and return (Application, window_rect_dict) for mss.
+    rect_dict is {"left", "top", "width", "height"} in screen coordinates.
+    Returns (None, None, error_str) on failure.
     Uses find_windows() + connect(handle=) first (fast Win32 enum); falls back to UIA connect(path=) if needed.
     """
     if not HAS_PYWINAUTO or not os.path.isfile(VIBER_EXE):
@@ -426,29 +1800,177 @@ def connect_to_viber_window():
     return None, None, f"Viber window did not appear within {WINDOW_WAIT_TIMEOUT}s"
 
 
-def _save_last_capture(panel_png: bytes | None, window_png: bytes | None) -> None:
-    """Always save last capture to last_panel.png / last_window.png; log success or failure."""
-    _agent_dir = os.path.dirname(os.path.abspath(__file__))
+def _close_viber_app(viber_app) -> None:
+    """Close the Viber window (process keeps running in the tray). Can block for seconds."""
+    t0 = time.monotonic()
+    try:
+        dlg = viber_app.top_window()
+        dlg.close()
+    except Exception:
+        pass
+    _log_step("close window", time.monotonic() - t0)
+
+
+def _live_window_rect(hwnd: int) -> dict | None:
+    """Current rect of hwnd if it is still a visible Viber window (restores it when minimized), else None."""
+    try:
+        import win32gui
+    except ImportError:
+        return None
+    try:
+        if not win32gui.IsWindow(hwnd) or not win32gui.IsWindowVisible(hwnd):
+            return None
+        if "Viber" not in (win32gui.GetWindowText(hwnd) or ""):
+            return None
+        if win32gui.IsIconic(hwnd):
+            win32gui.ShowWindow(hwnd, 9)  # SW_RESTORE
+        left, top, right, bottom = win32gui.GetWindowRect(hwnd)
+    except Exception:
+        return None
+    if right - left <= 0 or bottom - top <= 0:
+        return None
+    return {"left": left, "top": top, "width": right - left, "height": bottom - top}
+
+
+class _ViberSession:
+    """
+    Cached Viber window (Application + hwnd) reused across lookups and sends when VIBER_SESSION is on.
+    The handle is re-validated cheaply (IsWindow / GetWindowRect) on each acquire instead of rediscovering the
+    window. Only used from the desktop worker thread, so no locking.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.hwnd: int | None = None
+        self.created = 0.0
+        self.failures = 0
+        self.reuses = 0
+
+    def acquire(self):
+        """Returns (Application, hwnd, rect_dict, error). Reuses the cached window when it is still valid."""
+        if VIBER_SESSION and self.app is not None and self.hwnd:
+            rect_dict = _driver.window_rect(self.hwnd)
+            if rect_dict is not None:
+                self.reuses += 1
+                return self.app, self.hwnd, rect_dict, None
+            alog.info("session: cached Viber window is gone, reconnecting")
+            self._forget()
+        viber_app, hwnd, rect_dict, err = _driver.connect_window()
+        if err or viber_app is None:
+            return None, None, None, err
+        if VIBER_SESSION:
+            self.app, self.hwnd, self.created, self.failures = viber_app, hwnd, time.monotonic(), 0
+        return viber_app, hwnd, rect_dict, None
+
+    def release(self, viber_app, healthy: bool = True) -> None:
+        """
+        End of one lookup/send. Without VIBER_SESSION the window is closed as before; with it the window stays
+        open unless it failed VIBER_SESSION_MAX_FAILURES times in a row or is older than VIBER_SESSION_MAX_AGE.
+        """
+        if viber_app is None:
+            return
+        if not VIBER_SESSION:
+            _driver.close_window(viber_app)
+            return
+        self.failures = 0 if healthy else self.failures + 1
+        if self.failures >= VIBER_SESSION_MAX_FAILURES:
+            alog.info("session: %d failed captures, restarting Viber window", self.failures)
+            self.reset()
+        elif time.monotonic() - self.created > VIBER_SESSION_MAX_AGE:
+            alog.info("session: max age reached, restarting Viber window")
+            self.reset()
+
+    def reset(self) -> None:
+        """Close the cached window and forget it; the next acquire reconnects from scratch."""
+        if self.app is not None:
+            _driver.close_window(self.app)
+        self._forget()
+
+    def _forget(self) -> None:
+        self.app = None
+        self.hwnd = None
+        self.failures = 0
+
+    def stats(self) -> dict:
+        return {
+            "enabled": VIBER_SESSION,
+            "connected": self.app is not None,
+            "age_s": round(time.monotonic() - self.created, 1) if self.app is not None else None,
+            "reuses": self.reuses,
+            "failures": self.failures,
+        }
+
+
+_viber_session = _ViberSession()
+
+
+class _CaptureFlusher:
+    """
+    Background writer for the opt-in capture files (SAVE_LAST_CAPTURE, DEBUG_SAVE_PANEL). Only the newest bytes per
+    file name are kept, so a burst of lookups costs one write per file; pending files are flushed at exit.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._pending: dict[str, bytes] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.written = 0
+        atexit.register(self.flush)
+
+    def write(self, name: str, data: bytes) -> None:
+        with self._lock:
+            self._pending[name] = data
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="capture-flusher", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for name, data in pending.items():
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "wb") as f:
+                    f.write(data)
+                self.written += 1
+                log.debug("%s saved: %s (%s bytes)", name, path, len(data))
+            except Exception as e:
+                alog.error("could not save %s — %s", name, e)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self.flush()
+
+
+_capture_flusher = _CaptureFlusher(os.path.dirname(os.path.abspath(__file__)))
+_last_captures: deque = deque(maxlen=max(1, LAST_CAPTURES_MAX))
+
+
+def _save_last_capture(number: str, panel_png: bytes | None, window_png: bytes | None) -> None:
+    """
+    Keep the capture in the in-memory ring (GET /debug/last-captures). Files are written only when opted in
+    (SAVE_LAST_CAPTURE → last_panel.* / last_window.*), by the background flusher, never on the request thread.
+    """
+    trace, _ = _current_trace()
+    _last_captures.append({
+        "number": number,
+        "time": time.time(),
+        "trace_id": trace.id if trace is not None else None,
+        "tenant": trace.tenant if trace is not None else _ANONYMOUS_TENANT,
+        "panel": panel_png,
+        "window": window_png,
+    })
     if panel_png is None:
-        print("[viber-agent] WARNING: no panel image — nothing to save as last_panel.png", flush=True)
-    else:
-        try:
-            _path = os.path.join(_agent_dir, "last_panel.png")
-            with open(_path, "wb") as f:
-                f.write(panel_png)
-            print("[viber-agent] last_panel.png saved: %s (%s bytes)" % (_path, len(panel_png)), flush=True)
-        except Exception as e:
-            print("[viber-agent] ERROR: could not save last_panel.png — %s" % e, flush=True)
-    if window_png is None:
-        print("[viber-agent] (no full window this run; only_panel=true or no window capture)", flush=True)
-    else:
-        try:
-            _path = os.path.join(_agent_dir, "last_window.png")
-            with open(_path, "wb") as f:
-                f.write(window_png)
-            print("[viber-agent] last_window.png saved: %s (%s bytes)" % (_path, len(window_png)), flush=True)
-        except Exception as e:
-            print("[viber-agent] ERROR: could not save last_window.png — %s" % e, flush=True)
+        alog.warning("no panel image in this capture")
+    if SAVE_LAST_CAPTURE:
+        for name, data in (("last_panel", panel_png), ("last_window", window_png)):
+            if data is not None:
+                _capture_flusher.write("%s.%s" % (name, _image_mime(data).split("/")[1]), data)
 
 
 def _panel_rect_from_window(rect_dict: dict) -> dict:
@@ -477,367 +1999,2252 @@ def _panel_rect_from_window(rect_dict: dict) -> dict:
     }
 
 
-def _capture_window_printwindow(hwnd: int, rect_dict: dict) -> tuple[bytes | None, bytes | None]:
+def _panel_box(w: int, h: int) -> tuple[int, int, int, int]:
+    """Panel crop (left, top, width, height) relative to a w×h window frame; same region as _panel_rect_from_window."""
+    r = _panel_rect_from_window({"left": 0, "top": 0, "width": w, "height": h})
+    return r["left"], r["top"], r["width"], r["height"]
+
+
+class _RawFrame:
     """
-    Capture window via PrintWindow (window draws into a buffer). Works when RDP is disconnected.
-    Returns (window_png_bytes, panel_png_bytes). Returns (None, None) on failure.
+    Raw 32-bit BGRX/BGRA pixels of one capture (PrintWindow bitmap bits or an mss grab), top-down rows.
+    view() decodes only the requested rectangle straight from the buffer (row stride = full frame), so cropping the
+    panel never copies or converts the whole window.
     """
-    if not HAS_PRINTWINDOW:
-        return None, None
-    try:
+
+    def __init__(self, buf, width: int, height: int, stride: int | None = None):
+        self.buf = memoryview(buf).cast("B")
+        self.width = width
+        self.height = height
+        self.stride = stride or width * 4
+
+    def view(self, left: int = 0, top: int = 0, width: int | None = None, height: int | None = None):
         from PIL import Image
-        import win32gui
-        import win32ui
-    except ImportError:
-        return None, None
+        width = self.width - left if width is None else width
+        height = self.height - top if height is None else height
+        offset = top * self.stride + left * 4
+        return Image.frombuffer("RGB", (width, height), self.buf[offset:], "raw", "BGRX", self.stride, 1)
+
+    def crop(self, left: int, top: int, width: int, height: int) -> "_RawFrame":
+        """Sub-frame sharing this buffer (no copy)."""
+        return _RawFrame(self.buf[top * self.stride + left * 4:], width, height, self.stride)
+
+    def image(self):
+        return self.view()
+
+
+def _panel_is_blank(im) -> bool:
+    """Blank/not-yet-drawn panel: almost no pixel variance (replaces the old encoded-size heuristic)."""
+    from PIL import ImageStat
+    probe = im.convert("L")
+    probe.thumbnail((96, 96))
+    return ImageStat.Stat(probe).stddev[0] < PANEL_MIN_STDDEV
+
+
+def _encode_image(im, fmt: str = "png") -> bytes:
+    """Encode once in the requested format: png (PNG_COMPRESS_LEVEL), webp or jpeg (IMAGE_QUALITY)."""
+    buf = io.BytesIO()
+    if fmt == "webp":
+        im.save(buf, format="WEBP", quality=IMAGE_QUALITY, method=4)
+    elif fmt == "jpeg":
+        im.save(buf, format="JPEG", quality=IMAGE_QUALITY)
+    else:
+        im.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
+
+
+def _image_mime(data: bytes | None) -> str:
+    """MIME type from the image's magic bytes (png when unknown)."""
+    if data and data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data and data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+class _CaptureBackend:
+    """
+    Source of raw window frames for the capture code. grab() is a context manager yielding a _RawFrame (or None);
+    its pixels are only valid inside the with-block, so a backend may reuse its buffers between grabs. region is
+    (left, top, width, height) relative to the window; variants are the render modes tried in order until the panel
+    is not blank.
+    """
+
+    name = "base"
+    variants: tuple = (None,)
+
+    def available(self, hwnd: int | None) -> bool:
+        return True
+
+    @contextmanager
+    def grab(self, hwnd: int | None, rect_dict: dict, region: tuple | None = None, variant=None):
+        yield None
+
+    def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+
+class _GdiCaptureBackend(_CaptureBackend):
+    """
+    PrintWindow (works when RDP is disconnected) into a top-down 32-bit DIB section selected into a memory DC.
+    DC + bitmap are created once per window size (up to CAPTURE_CACHE_SIZES) and reused, so a capture allocates no
+    GDI objects; the pixels are read in place (a region is a strided view of the DIB, nothing is copied).
+    Evicted sizes are released at once and the rest by close() (also at exit).
+    """
+
+    name = "printwindow"
+    # Flag 0 first (some apps render better), then 2 (PW_RENDERFULLCONTENT)
+    variants = (PW_DEFAULT, PW_RENDERFULLCONTENT)
+
+    def __init__(self, max_sizes: int = CAPTURE_CACHE_SIZES):
+        self._lock = threading.Lock()
+        self._surfaces: OrderedDict = OrderedDict()  # (w, h) -> (hdc, hbitmap, previous object, bits pointer)
+        self._max_sizes = max(1, max_sizes)
+        self._allocations = 0
+        self._releases = 0
+        self._grabs = 0
+        atexit.register(self.close)
+
+    def available(self, hwnd: int | None) -> bool:
+        return bool(hwnd) and HAS_PRINTWINDOW
+
+    def _surface(self, w: int, h: int) -> tuple:
+        key = (w, h)
+        surface = self._surfaces.get(key)
+        if surface is not None:
+            self._surfaces.move_to_end(key)
+            return surface
+        hdc = _gdi32.CreateCompatibleDC(None)
+        if not hdc:
+            raise OSError("CreateCompatibleDC failed")
+        header = _BITMAPINFOHEADER()
+        header.biSize = ctypes.sizeof(_BITMAPINFOHEADER)
+        header.biWidth = w
+        header.biHeight = -h  # top-down rows
+        header.biPlanes = 1
+        header.biBitCount = 32
+        bits = ctypes.c_void_p()
+        hbitmap = _gdi32.CreateDIBSection(hdc, ctypes.byref(header), 0, ctypes.byref(bits), None, 0)
+        if not hbitmap or not bits.value:
+            _gdi32.DeleteDC(hdc)
+            raise OSError("CreateDIBSection failed for %sx%s" % (w, h))
+        surface = (hdc, hbitmap, _gdi32.SelectObject(hdc, hbitmap), bits.value)
+        self._surfaces[key] = surface
+        self._allocations += 1
+        while len(self._surfaces) > self._max_sizes:
+            self._release(self._surfaces.popitem(last=False)[1])
+        return surface
+
+    def _release(self, surface: tuple) -> None:
+        hdc, hbitmap, previous, _ = surface
+        _gdi32.SelectObject(hdc, previous)
+        _gdi32.DeleteObject(hbitmap)
+        _gdi32.DeleteDC(hdc)
+        self._releases += 1
+
+    @contextmanager
+    def grab(self, hwnd, rect_dict, region=None, variant=PW_RENDERFULLCONTENT):
+        w, h = rect_dict["width"], rect_dict["height"]
+        with self._lock:
+            frame = None
+            try:
+                hdc, _, _, bits = self._surface(w, h)
+                self._grabs += 1
+                if _PrintWindow(hwnd, hdc, PW_RENDERFULLCONTENT if variant is None else variant):
+                    _gdi32.GdiFlush()
+                    frame = _RawFrame((ctypes.c_char * (w * 4 * h)).from_address(bits), w, h)
+                    if region is not None:
+                        frame = frame.crop(*region)
+            except Exception as e:
+                log.debug("PrintWindow failed: %s", e)
+            yield frame
+
+    def close(self) -> None:
+        with self._lock:
+            while self._surfaces:
+                self._release(self._surfaces.popitem()[1])
 
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.name,
+                "sizes": ["%sx%s" % k for k in self._surfaces],
+                "grabs": self._grabs,
+                "allocations": self._allocations,
+                "releases": self._releases,
+            }
+
+
+class _MssCaptureBackend(_CaptureBackend):
+    """Screen grab with mss (requires the session to be drawn, e.g. RDP connected); grabs only the region if given."""
+
+    name = "mss"
+
+    def available(self, hwnd: int | None) -> bool:
+        return HAS_MSS
+
+    @contextmanager
+    def grab(self, hwnd, rect_dict, region=None, variant=None):
+        rect = rect_dict
+        if region is not None:
+            rect = {
+                "left": rect_dict["left"] + region[0],
+                "top": rect_dict["top"] + region[1],
+                "width": region[2],
+                "height": region[3],
+            }
+        with mss.mss() as sct:
+            shot = sct.grab(rect)
+            yield _RawFrame(shot.raw, shot.width, shot.height)
+
+
+class _FakeCaptureBackend(_CaptureBackend):
+    """
+    Serves frames from an image instead of the desktop, so the capture logic runs anywhere (e.g. on Linux).
+    source is a path, PNG/JPEG bytes, a PIL image, or a callable returning one of those per grab; the image is
+    scaled to the window size. variants=(None, None) makes the blank-panel retry observable.
+    """
+
+    name = "fake"
+
+    def __init__(self, source, variants: tuple = (None,)):
+        self.source = source
+        self.variants = variants
+        self.grabs = 0
+
+    @contextmanager
+    def grab(self, hwnd, rect_dict, region=None, variant=None):
+        from PIL import Image
+        self.grabs += 1
+        src = self.source() if callable(self.source) else self.source
+        if src is None:
+            yield None
+            return
+        im = src if isinstance(src, Image.Image) else Image.open(io.BytesIO(src) if isinstance(src, bytes) else src)
+        w, h = rect_dict["width"], rect_dict["height"]
+        im = im.convert("RGB")
+        if im.size != (w, h):
+            im = im.resize((w, h))
+        frame = _RawFrame(im.tobytes("raw", "BGRX"), w, h)
+        yield frame.crop(*region) if region is not None else frame
+
+
+# Tried in order; the last one is the fallback whose result is used even if the panel looks blank
+_capture_backends: list[_CaptureBackend] = [_GdiCaptureBackend(), _MssCaptureBackend()]
+
+
+def _capture_window(
+    backend: _CaptureBackend,
+    hwnd: int | None,
+    rect_dict: dict,
+    only_panel: bool = False,
+    fmt: str = "png",
+    allow_blank: bool = False,
+) -> tuple[bytes | None, bytes | None]:
+    """
+    Capture window + right panel through backend. Each backend variant is tried until the panel is not blank
+    (allow_blank: accept it anyway); only then the images the caller asked for are encoded, once. With only_panel
+    just the panel region is grabbed. Returns (window_bytes, panel_bytes); (None, None) on failure or blank panel.
+    """
     w, h = rect_dict["width"], rect_dict["height"]
     if w <= 0 or h <= 0:
         return None, None
-
-    try:
-        hwnd_dc = win32gui.GetWindowDC(hwnd)
-        if not hwnd_dc:
-            return None, None
-        mfc_dc = win32ui.CreateDCFromHandle(hwnd_dc)
-        save_dc = mfc_dc.CreateCompatibleDC()
-        bitmap = win32ui.CreateBitmap()
-        bitmap.CreateCompatibleBitmap(mfc_dc, w, h)
-        save_dc.SelectObject(bitmap)
-
-        # Try flag 0 first (some apps render better), then 2 (PW_RENDERFULLCONTENT)
-        for pw_flag in (PW_DEFAULT, PW_RENDERFULLCONTENT):
-            result = _PrintWindow(hwnd, save_dc.GetSafeHdc(), pw_flag)
-            if not result:
-                continue
-            bmpinfo = bitmap.GetInfo()
-            bmpstr = bitmap.GetBitmapBits(True)
-            try:
-                im = Image.frombuffer(
-                    "RGB",
-                    (bmpinfo["bmWidth"], bmpinfo["bmHeight"]),
-                    bmpstr,
-                    "raw",
-                    "BGRX",
-                    0,
-                    1,
-                )
-            except Exception:
-                continue
-            buf = io.BytesIO()
-            im.save(buf, format="PNG")
-            window_png = buf.getvalue()
-            if PANEL_USE_FULL_WIDTH:
-                panel_w = w
-                panel_left = 0
-            elif PANEL_LEFT:
-                panel_w = min(PANEL_WIDTH, w)
-                panel_left = 0
-            else:
-                panel_w = min(PANEL_WIDTH, w)
-                panel_left = max(0, w - PANEL_WIDTH)
-            crop_top = min(PANEL_TOP + PANEL_STRIP_TOP, h - 1)
-            panel_h = min(PANEL_HEIGHT, h - crop_top)
-            if panel_w <= 0 or panel_h <= 0:
-                win32gui.ReleaseDC(hwnd, hwnd_dc)
-                save_dc.DeleteDC()
-                return window_png, None
-            panel_im = im.crop((panel_left, crop_top, panel_left + panel_w, crop_top + panel_h))
-            buf2 = io.BytesIO()
-            panel_im.save(buf2, format="PNG")
-            panel_png = buf2.getvalue()
-            if len(panel_png) >= PANEL_MIN_BYTES:
-                win32gui.ReleaseDC(hwnd, hwnd_dc)
-                save_dc.DeleteDC()
-                return window_png, panel_png
-
-        win32gui.ReleaseDC(hwnd, hwnd_dc)
-        save_dc.DeleteDC()
+    box = _panel_box(w, h)
+    has_panel = box[2] > 0 and box[3] > 0
+    if only_panel and not has_panel:
         return None, None
+    try:
+        for variant in backend.variants:
+            with backend.grab(hwnd, rect_dict, box if only_panel else None, variant) as frame:
+                if frame is None:
+                    continue
+                panel_im = None
+                if has_panel:
+                    panel_im = frame.image() if only_panel else frame.view(*box)
+                    if not allow_blank and _panel_is_blank(panel_im):
+                        log.debug("%s variant=%s: panel blank", backend.name, variant)
+                        continue
+                window_bytes = None if only_panel else _encode_image(frame.image(), fmt)
+                return window_bytes, (_encode_image(panel_im, fmt) if panel_im is not None else None)
     except Exception as e:
-        log.debug("PrintWindow capture failed: %s", e)
-        return None, None
+        log.debug("%s capture failed: %s", backend.name, e)
+    return None, None
+
+
+def _panel_thumbnail(hwnd: int | None, rect_dict: dict):
+    """
+    Cheap low-res grayscale probe of the panel region (PANEL_READY_THUMB), or None.
+    Uses the first capture backend that works (PrintWindow when we have the hwnd, same source as the real capture).
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    box = _panel_box(rect_dict["width"], rect_dict["height"])
+    if box[2] <= 0 or box[3] <= 0:
+        return None
+    for backend in _driver.capture_backends:
+        if not backend.available(hwnd):
+            continue
+        try:
+            with backend.grab(hwnd, rect_dict, box, backend.variants[-1]) as frame:
+                if frame is not None:
+                    return frame.image().convert("L").resize(PANEL_READY_THUMB, Image.BILINEAR)
+        except Exception as e:
+            log.debug("%s panel probe failed: %s", backend.name, e)
+    return None
+
+
+def _thumb_diff(a, b) -> float:
+    """Mean absolute pixel difference of two probe thumbnails (0 = identical, 255 = inverted)."""
+    from PIL import ImageChops, ImageStat
+    return ImageStat.Stat(ImageChops.difference(a, b)).mean[0]
+
+
+# (normalized number, thumbnail) of the last captured panel — a new contact's panel must differ from it
+_last_panel_probe: tuple[str, object] | None = None
+
+
+def _wait_for_panel_ready(hwnd: int | None, rect_dict: dict, number_key: str) -> str:
+    """
+    Poll probe thumbnails until the panel is stable for PANEL_READY_STABLE_FRAMES frames, is not blank, and
+    (for a different number than last time) differs from the previous contact's panel.
+    Returns when ready or after PANEL_READY_TIMEOUT; the return value says which ("stable", "stale" = still the
+    previous contact's panel at the deadline, "deadline", or "no-probe" / "no-pil" after a fixed PANEL_LOAD_WAIT).
+    The last probe is remembered as this number's panel for the next lookup's / send's comparison, except a stale
+    one (that is the previous contact's).
+    """
+    global _last_panel_probe
+    deadline = time.monotonic() + PANEL_READY_TIMEOUT
+    prev = _last_panel_probe[1] if _last_panel_probe and _last_panel_probe[0] != number_key else None
+    last = None
+    stable = 0
+    stale = False
+    try:
+        from PIL import ImageStat
+    except ImportError:
+        time.sleep(PANEL_LOAD_WAIT)
+        return "no-pil"
+    while time.monotonic() < deadline:
+        thumb = _panel_thumbnail(hwnd, rect_dict)
+        if thumb is None:
+            time.sleep(PANEL_LOAD_WAIT)
+            return "no-probe"
+        blank = ImageStat.Stat(thumb).stddev[0] < PANEL_READY_MIN_STDDEV
+        stale = prev is not None and _thumb_diff(thumb, prev) < PANEL_READY_DIFF
+        if last is not None and _thumb_diff(thumb, last) < PANEL_READY_DIFF:
+            stable += 1
+        else:
+            stable = 0
+        last = thumb
+        if not blank and not stale and stable >= PANEL_READY_STABLE_FRAMES - 1:
+            _last_panel_probe = (number_key, thumb)
+            return "stable"
+        time.sleep(PANEL_READY_POLL)
+    if stale:
+        return "stale"
+    if last is not None:
+        _last_panel_probe = (number_key, last)
+    return "deadline"
+
+
+def _wait_for_chat_switch(hwnd: int | None, rect_dict: dict, number: str) -> str | None:
+    """
+    Before typing a message: the reused session window keeps showing the previous chat (with a ready input) until
+    Viber has switched, so wait (the lookup readiness probe) until the contact panel is rendered and differs from
+    the previous lookup's / send's contact, if there was one. Error if it still shows the previous contact at
+    PANEL_READY_TIMEOUT. Only when the panel cannot be probed at all (no probe, no PIL, PANEL_READY_DETECT off) is
+    the fixed MESSAGE_INPUT_WAIT used instead; the input readiness check follows either way.
+    """
+    t0 = time.monotonic()
+    state = _wait_for_panel_ready(hwnd, rect_dict, _normalize_number(number)) if PANEL_READY_DETECT else "off"
+    if state == "stale":
+        _log_step("chat switch wait", time.monotonic() - t0, state, outcome=state)
+        return "Viber still shows the previous chat after %.1fs; message not sent" % PANEL_READY_TIMEOUT
+    if state in ("no-probe", "no-pil", "off"):
+        time.sleep(max(0.0, MESSAGE_INPUT_WAIT - (time.monotonic() - t0)))
+    _log_step("chat switch wait", time.monotonic() - t0, state, outcome=state)
+    return None
 
 
 def do_viber_search_and_screenshot(
-    phone_number: str, only_panel: bool = False
+    phone_number: str,
+    only_panel: bool = False,
+    read_uia: bool = False,
+    info: dict | None = None,
+    image_format: str = IMAGE_FORMAT,
 ) -> tuple[bytes | None, bytes | None, str | None]:
     """
-    Open Viber chat via viber://chat?number=..., capture window + right panel (highlighted part), then close Viber.
+    Open Viber chat via viber://chat?number=..., capture window + right panel (highlighted part), then close Viber
+    (or, with VIBER_SESSION, keep the window open for the next lookup).
     If only_panel is True, window_png is None and only the panel (highlighted part) is captured.
+    If read_uia is True, the contact name is also read from the UIA tree before capture.
+    If info is given it is filled with capture details: panel_ready, uia_name, uia_text, capture_backend.
+    Images are encoded in image_format (png | webp | jpeg).
     Returns (window_png_bytes, panel_png_bytes, error_message). error_message is None on success.
     """
-    if not HAS_MSS:
-        return None, None, "mss not installed (pip install mss)"
+    if info is None:
+        info = {}
+    err = _driver.check("lookup")
+    if err:
+        return None, None, err
 
     total_start = time.monotonic()
-    print("[viber-agent] --- lookup start ---", flush=True)
+    alog.info("--- lookup start ---")
 
     # 0) Skip closing window here — dlg.close() can block ~10s. Open link directly; if Viber is open it will switch chat.
 
     # 1) Open chat via Viber URI (launches Viber if needed, or brings to front and opens chat)
     t0 = time.monotonic()
-    err = open_viber_chat(phone_number)
+    err = _driver.open_chat(phone_number)
     _log_step("open viber:// link", time.monotonic() - t0)
     if err:
         return None, None, err
 
-    # 2) Short wait then poll for window (don't wait full time — capture as soon as ready)
-    t0 = time.monotonic()
-    time.sleep(INITIAL_WAIT)
-    _log_step("initial wait", time.monotonic() - t0)
+    # 2) Short wait then poll for window (don't wait full time — capture as soon as ready).
+    #    With PANEL_READY_DETECT the readiness probe below decides when the panel is there, so no fixed sleep.
+    if not PANEL_READY_DETECT:
+        t0 = time.monotonic()
+        time.sleep(INITIAL_WAIT)
+        _log_step("initial wait", time.monotonic() - t0)
 
-    # 3) Find Viber window (retry once if cold start is slow)
+    # 3) Find Viber window — cached session window if still valid (retry once if cold start is slow)
     t0 = time.monotonic()
-    viber_app, rect_dict, err = connect_to_viber_window()
+    viber_app, hwnd, rect_dict, err = _viber_session.acquire()
     elapsed = time.monotonic() - t0
-    _log_step("find Viber window", elapsed, "retry=0" if not err else f"err={err}")
+    _log_step("find Viber window", elapsed, f"err={err}" if err else "", outcome="error" if err or not rect_dict else "ok")
     if err or not rect_dict:
         time.sleep(RETRY_EXTRA_WAIT)
         t0 = time.monotonic()
-        viber_app, rect_dict, err = connect_to_viber_window()
-        _log_step("find Viber window (retry)", time.monotonic() - t0)
+        viber_app, hwnd, rect_dict, err = _viber_session.acquire()
+        _log_step("find Viber window", time.monotonic() - t0, retry=1, outcome="error" if err or not rect_dict else "ok")
     if err or not rect_dict:
         return None, None, err or "Could not get Viber window bounds"
 
-    # 4) Brief wait for right panel to load then capture
+    number_key = _normalize_number(phone_number)
+
+    # 4) Wait for right panel to load then capture
     t0 = time.monotonic()
-    time.sleep(PANEL_LOAD_WAIT)
-    _log_step("panel load wait", time.monotonic() - t0)
+    if PANEL_READY_DETECT:
+        ready = _wait_for_panel_ready(hwnd, rect_dict, number_key)
+        _log_step("panel ready wait", time.monotonic() - t0, ready, outcome=ready)
+        if ready == "stale":
+            # Still the previous contact: capturing now would file its name and panel under this number.
+            # Open the chat once more, then give up rather than return the wrong contact.
+            t0 = time.monotonic()
+            err = _driver.open_chat(phone_number)
+            ready = "stale" if err else _wait_for_panel_ready(hwnd, rect_dict, number_key)
+            _log_step("panel ready wait", time.monotonic() - t0, ready, retry=1, outcome=ready)
+        info["panel_ready"] = ready
+        if ready == "stale":
+            _viber_session.release(viber_app, healthy=False)
+            return None, None, "Viber still shows the previous contact after %.1fs" % PANEL_READY_TIMEOUT
+    else:
+        time.sleep(PANEL_LOAD_WAIT)
+        _log_step("panel load wait", time.monotonic() - t0)
+
+    # 4b) Name straight from the UI Automation tree (no OCR needed when Viber exposes it)
+    if read_uia:
+        t0 = time.monotonic()
+        info["uia_name"], info["uia_text"] = _driver.read_uia_name(hwnd, rect_dict)
+        _log_step(
+            "UIA name read", time.monotonic() - t0, "name=%r" % info["uia_name"],
+            backend="uia", outcome="ok" if info["uia_name"] else "no_name",
+        )
 
     # 5) Capture window + right panel. Prefer PrintWindow (works when RDP disconnected); fallback to mss.
+    #    Each image is encoded once, in image_format, and only if it was asked for.
     t0 = time.monotonic()
     window_png = None
     panel_png = None
     try:
+        backends = [b for b in _driver.capture_backends if b.available(hwnd)]
+        for i, backend in enumerate(backends):
+            last = i == len(backends) - 1
+            window_png, panel_png = _capture_window(
+                backend, hwnd, rect_dict, only_panel=only_panel, fmt=image_format, allow_blank=last
+            )
+            if panel_png is not None or (last and window_png is not None):
+                info["capture_backend"] = backend.name
+                break
+            alog.info("%s panel blank, using next capture backend", backend.name)
+        if panel_png is None and window_png is None:
+            return None, None, "Panel region invalid" if only_panel else "Screen capture failed"
+        if DEBUG_SAVE_PANEL and panel_png:
+            _capture_flusher.write("panel_debug.%s" % _image_mime(panel_png).split("/")[1], panel_png)
+    finally:
+        backend_name = info.get("capture_backend", "")
+        _log_step(
+            "screenshot capture", time.monotonic() - t0, backend_name,
+            backend=backend_name, outcome="ok" if panel_png is not None or window_png is not None else "error",
+        )
+        # 6) Session mode: keep the window for the next lookup. Otherwise close it (process stays in tray).
+        _viber_session.release(viber_app, healthy=panel_png is not None)
+
+    _log_step("TOTAL (Viber + capture)", time.monotonic() - total_start, backend=info.get("capture_backend", ""))
+    alog.info("--- lookup done ---")
+
+    _save_last_capture(phone_number, panel_png, window_png)
+    return window_png, panel_png, None
+
+
+class _UiaNameReader:
+    """
+    Reads the contact name (and the other Text elements around it) from Viber's UI Automation tree, so the lookup
+    can skip image OCR. The first successful read remembers the child-index path to the name element; later reads
+    follow that path directly and only fall back to a bounded breadth-first search (UIA_NAME_MAX_DEPTH /
+    UIA_NAME_MAX_NODES) when it no longer leads to a plausible name inside the panel region.
+    """
+
+    def __init__(self):
+        self.path: list[int] | None = None
+        self.hits = 0
+        self.misses = 0
+        self.ever_found = False
+
+    def read(self, hwnd: int | None, rect_dict: dict) -> tuple[str, str]:
+        """Returns (contact_name, panel_text) or ("", "") when the name is not exposed."""
+        if not HAS_PYWINAUTO or not hwnd:
+            return "", ""
+        if not self.ever_found and self.misses >= UIA_NAME_GIVE_UP:
+            return "", ""
+        try:
+            from pywinauto.uia_element_info import UIAElementInfo
+            root = UIAElementInfo(hwnd)
+            panel = _panel_rect_from_window(rect_dict)
+            found = self._follow_cached_path(root, panel) or self._search(root, panel)
+        except Exception as e:
+            log.debug("UIA name read failed: %s", e)
+            found = None
+        if found is None:
+            self.misses += 1
+            if not self.ever_found and self.misses == UIA_NAME_GIVE_UP:
+                alog.info("UIA: contact name not exposed, using OCR only from now on")
+            return "", ""
+        self.hits += 1
+        self.ever_found = True
+        return found
+
+    def _follow_cached_path(self, root, panel: dict):
+        if not self.path:
+            return None
+        el = root
+        for idx in self.path:
+            children = el.children()
+            if idx >= len(children):
+                return None
+            el = children[idx]
+        name = self._name_if_match(el, panel)
+        if not name:
+            return None
+        texts = [t for t in (self._text(c) for c in el.parent.children() if self._in_panel(c, panel)) if t]
+        return name, "\n".join(texts) or name
+
+    def _search(self, root, panel: dict):
+        texts: list[tuple[int, int, str]] = []
+        name_hit = None
+        queue_: list[tuple[object, list[int], int]] = [(root, [], 0)]
+        visited = 0
+        while queue_ and visited < UIA_NAME_MAX_NODES:
+            el, path, depth = queue_.pop(0)
+            visited += 1
+            if depth > 0 and self._in_panel(el, panel):
+                text = self._text(el)
+                if text:
+                    rect = el.rectangle
+                    texts.append((rect.top, rect.left, text))
+                    name = self._name_if_match(el, panel)
+                    if name and (name_hit is None or (rect.top, rect.left) < name_hit[0]):
+                        name_hit = ((rect.top, rect.left), name, path)
+            if depth < UIA_NAME_MAX_DEPTH:
+                for i, child in enumerate(el.children()):
+                    queue_.append((child, path + [i], depth + 1))
+        if name_hit is None:
+            return None
+        self.path = name_hit[2]
+        texts.sort()
+        return name_hit[1], "\n".join(t for _, _, t in texts)
+
+    @staticmethod
+    def _text(el) -> str:
+        try:
+            if el.control_type != "Text":
+                return ""
+            return (el.name or "").strip()
+        except Exception:
+            return ""
+
+    @staticmethod
+    def _in_panel(el, panel: dict) -> bool:
+        try:
+            r = el.rectangle
+        except Exception:
+            return False
+        cx, cy = (r.left + r.right) // 2, (r.top + r.bottom) // 2
+        return (panel["left"] <= cx < panel["left"] + panel["width"]
+                and panel["top"] <= cy < panel["top"] + panel["height"])
+
+    def _name_if_match(self, el, panel: dict) -> str:
+        text = self._text(el)
+        if not text or not self._in_panel(el, panel):
+            return ""
+        if UIA_NAME_AUTO_ID and UIA_NAME_AUTO_ID not in (el.automation_id or ""):
+            return ""
+        if not (_is_plausible_person_name(text) and _looks_like_clean_name(text)):
+            return ""
+        return text
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "cached_path": self.path is not None}
+
+
+_uia_name_reader = _UiaNameReader()
+
+
+_SEND_BUTTON_LABELS = ("Send", "Изпрати", "Senden", "Envoyer", "Enviar")
+
+
+class _UiaSendControls:
+    """
+    Finds the chat's message input (Edit, automation_id QQuickTextEdit) and Send button (automation_id
+    SendToolbarButton, or a "Send" label) in Viber's UI Automation tree. Both are collected in one bounded
+    breadth-first traversal (UIA_SEND_MAX_DEPTH / UIA_SEND_MAX_NODES), repeated every UIA_SEND_POLL until they exist
+    or UIA_SEND_TIMEOUT passes. Their child-index paths are cached; later sends follow the paths directly and only
+    traverse again when a path no longer leads to the right control.
+    """
+
+    def __init__(self):
+        self.paths: dict[str, list[int]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def find(self, hwnd: int) -> tuple[object | None, object | None]:
+        """Returns (edit, send_button) as UIA element infos; either is None if it did not appear in time."""
+        from pywinauto.uia_element_info import UIAElementInfo
+        deadline = time.monotonic() + UIA_SEND_TIMEOUT
+        while True:
+            root = UIAElementInfo(hwnd)
+            edit = self._follow(root, "edit")
+            send = self._follow(root, "send")
+            if edit is not None and send is not None:
+                self.hits += 1
+                return edit, send
+            found = self._search(root)
+            edit = edit or found.get("edit")
+            send = send or found.get("send")
+            if (edit is not None and send is not None) or time.monotonic() >= deadline:
+                self.misses += 1
+                return edit, send
+            time.sleep(UIA_SEND_POLL)
+
+    def forget(self):
+        """Drop the cached paths (e.g. when the controls they led to failed)."""
+        self.paths.clear()
+
+    def count_messages(self, hwnd: int, text: str, cached_only: bool = False) -> int | None:
+        """
+        Number of conversation elements (not the input or buttons) whose text is exactly text, whitespace-normalized.
+        With cached_only only the cached message list (the parent of the last bubble found) is searched, and None
+        is returned when there is none; otherwise the whole window, within the traversal bounds, which caches it.
+        """
+        from pywinauto.uia_element_info import UIAElementInfo
+        needle = " ".join(text.split())
+        root = UIAElementInfo(hwnd)
+        if not cached_only:
+            return self._count(root, [], needle, remember=True)
+        listed = self.paths.get("list")
+        el = self._walk(root, listed) if listed is not None else None
+        if el is None:
+            return None
+        return self._count(el, listed, needle, remember=False)
+
+    def _count(self, start, start_path: list[int], needle: str, remember: bool) -> int:
+        count = 0
+        queue_: list[tuple[object, list[int], int]] = [(start, start_path, 0)]
+        visited = 0
+        while queue_ and visited < UIA_SEND_MAX_NODES:
+            el, path, depth = queue_.pop(0)
+            visited += 1
+            if depth > 0 and self._control_type(el) not in ("Edit", "Button"):
+                try:
+                    name = " ".join((el.name or "").split())
+                except Exception:
+                    name = ""
+                if needle and name == needle:
+                    count += 1
+                    if remember:
+                        self.paths["list"] = path[:-1]
+            if depth < UIA_SEND_MAX_DEPTH:
+                try:
+                    children = el.children()
+                except Exception:
+                    continue
+                for i, child in enumerate(children):
+                    queue_.append((child, path + [i], depth + 1))
+        return count
+
+    @staticmethod
+    def _walk(root, path: list[int]):
+        el = root
+        try:
+            for idx in path:
+                children = el.children()
+                if idx >= len(children):
+                    return None
+                el = children[idx]
+        except Exception:
+            return None
+        return el
+
+    def _follow(self, root, role: str):
+        path = self.paths.get(role)
+        if not path:
+            return None
+        el = self._walk(root, path)
+        return el if el is not None and self._role(el) == role else None
+
+    def _search(self, root) -> dict:
+        found: dict[str, object] = {}
+        fallback_edit = None
+        queue_: list[tuple[object, list[int], int]] = [(root, [], 0)]
+        visited = 0
+        while queue_ and visited < UIA_SEND_MAX_NODES and len(found) < 2:
+            el, path, depth = queue_.pop(0)
+            visited += 1
+            role = self._role(el)
+            if role and role not in found:
+                found[role] = el
+                self.paths[role] = path
+            elif role is None and depth > 0 and self._control_type(el) == "Edit":
+                fallback_edit = (el, path)
+            if depth < UIA_SEND_MAX_DEPTH:
+                try:
+                    children = el.children()
+                except Exception:
+                    continue
+                for i, child in enumerate(children):
+                    queue_.append((child, path + [i], depth + 1))
+        if "edit" not in found and fallback_edit is not None:
+            # Not cached: only the automation_id identifies the input reliably
+            found["edit"] = fallback_edit[0]
+        return found
+
+    @staticmethod
+    def _control_type(el) -> str:
+        try:
+            return el.control_type or ""
+        except Exception:
+            return ""
+
+    @classmethod
+    def _role(cls, el) -> str | None:
+        """Role of el: "edit" for the message input, "send" for the Send button, None otherwise."""
+        try:
+            ctype = el.control_type
+            auto_id = el.automation_id or ""
+        except Exception:
+            return None
+        if ctype == "Edit" and "QQuickTextEdit" in auto_id:
+            return "edit"
+        if ctype == "Button":
+            if "SendToolbarButton" in auto_id:
+                return "send"
+            try:
+                if (el.name or "").strip() in _SEND_BUTTON_LABELS:
+                    return "send"
+            except Exception:
+                pass
+        return None
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "cached": sorted(self.paths)}
+
+
+def _poll_until(predicate, timeout: float, poll: float = UIA_SEND_POLL) -> bool:
+    """Call predicate every poll seconds until it returns true (True) or timeout passes (False). Errors count as false."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if predicate():
+                return True
+        except Exception:
+            pass
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(poll)
+
+
+_uia_send_controls = _UiaSendControls()
+
+
+def _send_message_via_uia(hwnd: int, message: str, info: dict) -> str | None:
+    """
+    Use UI Automation: set text on the chat Edit and invoke Send button.
+    Works without keyboard focus (e.g. when RDP is disconnected). Returns None on success, error string on failure.
+    Every step waits for its observable condition (input enabled, text applied, message listed) with a deadline
+    instead of a fixed sleep; info["delivery"] says how the send was confirmed (see _confirm_sent).
+    """
+    try:
+        from pywinauto.controls.uia_controls import ButtonWrapper, EditWrapper
+        if os.environ.get("DEBUG_UIA_DUMP", "").strip().lower() in ("1", "true", "yes"):
+            _agent_dir = os.path.dirname(os.path.abspath(__file__))
+            path = os.path.join(_agent_dir, "viber_uia_tree.txt")
+            try:
+                dlg = Application(backend="uia").connect(handle=hwnd).window(handle=hwnd)
+                dlg.print_control_identifiers(depth=None, filename=path)
+                alog.info("UIA tree dumped to %s", path)
+            except Exception as dump_err:
+                alog.info("UIA dump failed: %s", dump_err)
+        t0 = time.monotonic()
+        edit_info, send_info = _uia_send_controls.find(hwnd)
+        _log_step("find chat controls (UIA)", time.monotonic() - t0, backend="uia",
+                  outcome="ok" if edit_info is not None and send_info is not None else "error")
+        if edit_info is None:
+            return "No Edit control found"
+        edit = EditWrapper(edit_info)
+
+        t0 = time.monotonic()
+        ready = _poll_until(lambda: edit.is_enabled() and edit.element_info.element.CurrentIsKeyboardFocusable,
+                            SEND_READY_TIMEOUT)
+        _log_step("message input ready", time.monotonic() - t0, backend="uia", outcome="ok" if ready else "timeout")
+        if not ready:
+            return "Message input not ready within %.1fs" % SEND_READY_TIMEOUT
+        if send_info is None:
+            return "Send button not found"
+        edit.set_focus()
+        # From here on the text is (maybe) in the input: the keyboard fallback must not type it again
+        info["text_applied"] = True
+        edit.set_edit_text(message)
+        if not _poll_until(lambda: (edit.get_value() or "").strip() == message, SEND_READY_TIMEOUT):
+            return "Message text was not applied to the input"
+
+        send_btn = ButtonWrapper(send_info)
+        if not _poll_until(send_btn.is_enabled, SEND_READY_TIMEOUT):
+            return "Send button not enabled within %.1fs" % SEND_READY_TIMEOUT
+        # Copies of the text already listed (repeat message), so the confirmation only counts a new one.
+        # Reads the cached message list only; None when there is none yet or it cannot be read.
+        try:
+            before = _uia_send_controls.count_messages(hwnd, message, cached_only=True)
+        except Exception:
+            before = None
+        try:
+            send_btn.invoke()
+        except Exception:
+            try:
+                send_btn.click()
+            except Exception as click_err:
+                # The invoke may have gone through before it failed
+                info["delivery"] = "unknown"
+                _uia_send_controls.forget()
+                return "Send button invoke/click failed: %s" % click_err
+        try:
+            info["delivery"] = _confirm_sent(hwnd, message, edit, before)
+        except Exception:
+            info["delivery"] = "unconfirmed"
+        return None
+    except Exception as e:
+        _uia_send_controls.forget()
+        return str(e)
+
+
+def _confirm_sent(hwnd: int, message: str, edit=None, before: int | None = None) -> str:
+    """
+    Wait up to SEND_CONFIRM_TIMEOUT for evidence that Viber took the message: "listed" (the text shows up in the
+    conversation), "input_cleared" (the input emptied but the bubble is not exposed to UIA, or could be an earlier
+    copy of the same text) or "unconfirmed".
+    before is the number of copies in the cached message list before the send: polls read only the input and that
+    list, and a copy more than before means listed. Without it (None) the whole window is searched once, after
+    the input cleared or the deadline, and only a single copy counts as listed.
+    """
+    t0 = time.monotonic()
+    cleared = False
+
+    def _check():
+        nonlocal cleared
+        if edit is not None and not cleared:
+            cleared = not (edit.get_value() or "").strip()
+        if before is None:
+            return cleared
+        count = _uia_send_controls.count_messages(hwnd, message, cached_only=True)
+        return count is not None and count > before
+
+    listed = _poll_until(_check, SEND_CONFIRM_TIMEOUT) and before is not None
+    if before is None and (cleared or edit is None):
+        try:
+            listed = _uia_send_controls.count_messages(hwnd, message) == 1
+        except Exception:
+            listed = False
+    delivery = "listed" if listed else "input_cleared" if cleared else "unconfirmed"
+    _log_step("send confirmation", time.monotonic() - t0, delivery, backend="uia", outcome=delivery)
+    return delivery
+
+
+def _send_message_windows(viber_app, hwnd: int | None, msg: str, info: dict) -> str | None:
+    """
+    Type and send msg in the open chat: UIA first (Edit + Send button; works when RDP disconnected), keyboard as
+    fallback only while UIA has not put the text in the input yet. Returns None on success, or an error message
+    string; info["delivery"] is set on success, and to "unknown" on an error after Send may have been pressed.
+    """
+    try:
+        dlg = viber_app.window(handle=hwnd) if hwnd else viber_app.top_window()
+        dlg.restore()
+        dlg.set_focus()
+    except Exception:
+        pass
+
+    uia_error = None
+    if hwnd:
+        err_uia = _send_message_via_uia(hwnd, msg, info)
+        if err_uia is None:
+            alog.info("send message via UIA (Edit + Send button): %s", info.get("delivery"))
+            return None
+        if info.get("text_applied"):
+            # Typing again could send the message twice (or append it to the text already in the input)
+            alog.info("UIA send failed after the text was applied: %s — no keyboard fallback", err_uia)
+            return err_uia
+        uia_error = err_uia
+        alog.info("UIA send failed: %s — falling back to keyboard", err_uia)
+    else:
+        # Nothing to observe without a window handle: fixed wait for the input to get focus
+        time.sleep(MESSAGE_INPUT_WAIT)
+
+    if _keyboard_send_keys is None:
+        return "Could not send via UIA and keyboard not available"
+    try:
+        import win32gui
+        if hwnd:
+            win32gui.SetForegroundWindow(hwnd)
+            time.sleep(0.2)
+    except Exception:
+        pass
+    before = None
+    if hwnd:
+        try:
+            before = _uia_send_controls.count_messages(hwnd, msg, cached_only=True)
+        except Exception:
+            pass
+    safe = msg.replace("{", "{{").replace("}", "}}")
+    for attempt in range(2):
+        try:
+            _keyboard_send_keys(safe + "{ENTER}", with_spaces=True)
+            if hwnd:
+                try:
+                    info["delivery"] = _confirm_sent(hwnd, msg, before=before)
+                except Exception:
+                    info["delivery"] = "unconfirmed"
+            else:
+                time.sleep(0.5)
+                info["delivery"] = "unconfirmed"
+            return None
+        except Exception as e:
+            err_msg = str(e).strip()
+            if "inserted only 0" in err_msg.lower() or "0 out of" in err_msg:
+                err_msg = (
+                    "UIA path failed (%s). Keyboard fallback failed because RDP is not in the foreground. "
+                    "Keep RDP connected and the Viber window visible, or ensure Viber exposes the message box and Send button to UI Automation."
+                ) % (uia_error or "unknown")
+            if attempt == 0 and hwnd:
+                try:
+                    import win32gui
+                    win32gui.SetForegroundWindow(hwnd)
+                    time.sleep(0.5)
+                except Exception:
+                    pass
+                continue
+            return f"Failed to type/send: {err_msg}"
+    return "Failed to type/send"
+
+
+def do_viber_send_message(phone_number: str, message: str, info: dict | None = None) -> str | None:
+    """
+    Open Viber chat with the given number, type the message, send it, then close Viber (kept open with VIBER_SESSION).
+    Typing/sending is done by the desktop driver (Windows: UIA, keyboard fallback).
+    If info is given, info["delivery"] is set to listed | input_cleared | unconfirmed, or to unknown with an error
+    when the message may have been sent anyway (do not retry blindly).
+    Returns None on success, or an error message string.
+    """
+    if info is None:
+        info = {}
+    err = _driver.check("send")
+    if err:
+        return err
+    if not message or not message.strip():
+        return "Message is empty"
+    msg = message.strip()
+
+    total_start = time.monotonic()
+    alog.info("--- send message start ---")
+
+    t0 = time.monotonic()
+    err = _driver.open_chat(phone_number)
+    _log_step("open viber:// link", time.monotonic() - t0)
+    if err:
+        return err
+
+    # No fixed wait: acquire polls for the window (WINDOW_WAIT_TIMEOUT), then the panel and the input are checked
+    t0 = time.monotonic()
+    viber_app, hwnd, rect_dict, err = _viber_session.acquire()
+    _log_step("find Viber window", time.monotonic() - t0, outcome="error" if err or viber_app is None else "ok")
+    if err or viber_app is None:
+        return err or "Could not find Viber window"
+    # The input readiness checks below pass on the previous chat too: confirm the chat switched first
+    err = _wait_for_chat_switch(hwnd, rect_dict, phone_number) if rect_dict else None
+    if err:
+        _viber_session.release(viber_app, healthy=False)
+        return err
+
+    t0 = time.monotonic()
+    err = _driver.send_message(viber_app, hwnd, msg, info)
+    if err:
+        _log_step("type message", time.monotonic() - t0, outcome="error")
+        _viber_session.release(viber_app, healthy=False)
+        return err
+    _log_step("type message + Send", time.monotonic() - t0, info.get("delivery", ""))
+
+    _viber_session.release(viber_app)
+    _log_step("TOTAL (send message)", time.monotonic() - total_start)
+    alog.info("--- send message done ---")
+    return None
+
+
+class _DesktopDriver(abc.ABC):
+    """
+    Everything the lookup/send flows need from the desktop: open a chat link, find/validate/close the Viber window,
+    capture frames, read the name from UI Automation, type and send a message. Selected with VIBER_DRIVER.
+    open_chat, connect_window and send_message are abstract: a driver missing one fails when it is created.
+    """
+
+    name = "base"
+    capture_backends: list[_CaptureBackend] = []
+
+    def check(self, kind: str) -> str | None:
+        """Error message if this driver cannot do kind ("lookup" | "send") here, else None."""
+        return None
+
+    @abc.abstractmethod
+    def open_chat(self, phone_number: str) -> str | None:
+        """Open the number's chat (viber:// link); error message or None."""
+
+    @abc.abstractmethod
+    def connect_window(self):
+        """Returns (app, hwnd, rect_dict, error)."""
+
+    def window_rect(self, hwnd) -> dict | None:
+        """Current rect of a previously connected window, or None when it is gone."""
+        return None
+
+    def close_window(self, app) -> None:
+        pass
+
+    def read_uia_name(self, hwnd, rect_dict: dict) -> tuple[str, str]:
+        return "", ""
+
+    @abc.abstractmethod
+    def send_message(self, app, hwnd, message: str, info: dict) -> str | None:
+        """Type and send message in the open chat; sets info["delivery"] on success."""
+
+    def stats(self) -> dict:
+        return {"name": self.name}
+
+
+class _WindowsDriver(_DesktopDriver):
+    """Real Viber desktop: viber:// links, pywinauto/win32 window handling, PrintWindow/mss capture, UIA."""
+
+    name = "windows"
+    capture_backends = _capture_backends
+
+    def check(self, kind: str) -> str | None:
+        if kind == "send":
+            return None if HAS_PYWINAUTO else "pywinauto not installed"
+        return None if HAS_MSS else "mss not installed (pip install mss)"
+
+    def open_chat(self, phone_number: str) -> str | None:
+        return open_viber_chat(phone_number)
+
+    def connect_window(self):
+        viber_app, rect_dict, err = connect_to_viber_window()
+        if err or viber_app is None:
+            return None, None, None, err
         hwnd = None
         try:
             dlg = viber_app.top_window()
             hwnd = getattr(dlg, "handle", None) or getattr(dlg, "handle_id", None)
         except Exception:
             pass
+        return viber_app, hwnd, rect_dict, None
 
-        if hwnd and HAS_PRINTWINDOW:
-            window_png, panel_png = _capture_window_printwindow(hwnd, rect_dict)
-            if DEBUG_SAVE_PANEL and panel_png:
-                _debug_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "panel_debug.png")
-                try:
-                    with open(_debug_path, "wb") as f:
-                        f.write(panel_png)
-                    print("[viber-agent] DEBUG_SAVE_PANEL: saved to", _debug_path, flush=True)
-                except Exception as e:
-                    print("[viber-agent] DEBUG_SAVE_PANEL save failed:", e, flush=True)
-            # Use PrintWindow only if panel looks substantial (tiny PNG = likely blank/wrong)
-            use_pw = panel_png and len(panel_png) >= PANEL_MIN_BYTES
-            if only_panel and use_pw:
-                print("[viber-agent] screenshot capture (PrintWindow, works when RDP disconnected)", flush=True)
-                _log_step("screenshot capture (PrintWindow)", time.monotonic() - t0)
-                _save_last_capture(panel_png, None)
-                return None, panel_png, None
-            if not only_panel and window_png and use_pw:
-                print("[viber-agent] screenshot capture (PrintWindow, works when RDP disconnected)", flush=True)
-                _log_step("screenshot capture (PrintWindow)", time.monotonic() - t0)
-                _save_last_capture(panel_png, window_png)
-                return window_png, panel_png, None
-            if panel_png and len(panel_png) < PANEL_MIN_BYTES:
-                print("[viber-agent] PrintWindow panel too small (%s bytes), using mss fallback" % len(panel_png), flush=True)
-
-        # Fallback: mss (screen grab; requires session to be drawn, e.g. RDP connected)
-        with mss.mss() as sct:
-            panel_rect = _panel_rect_from_window(rect_dict)
-            if only_panel:
-                if panel_rect["width"] <= 0 or panel_rect["height"] <= 0:
-                    return None, None, "Panel region invalid"
-                panel_shot = sct.grab(panel_rect)
-                panel_png = mss.tools.to_png(panel_shot.rgb, panel_shot.size)
-                window_png = None
-            else:
-                shot = sct.grab(rect_dict)
-                window_png = mss.tools.to_png(shot.rgb, shot.size)
-                if panel_rect["width"] > 0 and panel_rect["height"] > 0:
-                    panel_shot = sct.grab(panel_rect)
-                    panel_png = mss.tools.to_png(panel_shot.rgb, panel_shot.size)
+    def window_rect(self, hwnd) -> dict | None:
+        return _live_window_rect(hwnd)
+
+    def close_window(self, app) -> None:
+        _close_viber_app(app)
+
+    def read_uia_name(self, hwnd, rect_dict: dict) -> tuple[str, str]:
+        return _uia_name_reader.read(hwnd, rect_dict)
+
+    def send_message(self, app, hwnd, message: str, info: dict) -> str | None:
+        return _send_message_windows(app, hwnd, message, info)
+
+    def stats(self) -> dict:
+        return {"name": self.name, "uia_name": _uia_name_reader.stats(), "uia_send": _uia_send_controls.stats()}
+
+
+class _SimDriver(_DesktopDriver):
+    """
+    Simulated Viber desktop (VIBER_DRIVER=sim) so the agent runs and can be benchmarked without Windows.
+    The window appears SIM_WINDOW_DELAY after the first chat link; a chat's panel is blank until SIM_PANEL_DELAY
+    after its link was opened; SIM_FAILURE_RATE of window lookups and sends fail. Frames are the window fixture
+    (SIM_WINDOW_IMAGE) with the panel fixture (SIM_PANEL_IMAGE) pasted into the panel region, plus a per-number
+    grey block so consecutive contacts look different to the readiness probe.
+    """
+
+    name = "sim"
+
+    def __init__(self):
+        self._rng = random.Random(SIM_SEED) if SIM_SEED else random.Random()
+        self._window = self._panel = None
+        self._load_error = None
+        try:
+            from PIL import Image
+            self._window = Image.open(SIM_WINDOW_IMAGE).convert("RGB")
+            self._panel = Image.open(SIM_PANEL_IMAGE).convert("RGB")
+        except Exception as e:
+            self._load_error = "sim driver: cannot load fixture images (%s)" % e
+        self._lock = threading.Lock()
+        self._window_open = False
+        self._window_at = 0.0
+        self._number = ""
+        self._chat_at = 0.0
+        self._frames: dict[tuple[str, bool], object] = {}
+        self.opens = 0
+        self.failures = 0
+        self.sends = 0
+        self.capture_backends = [_FakeCaptureBackend(self._frame)]
+
+    def check(self, kind: str) -> str | None:
+        return self._load_error
+
+    def _rect(self) -> dict:
+        return {"left": 0, "top": 0, "width": self._window.width, "height": self._window.height}
+
+    def _fail(self) -> bool:
+        if SIM_FAILURE_RATE > 0 and self._rng.random() < SIM_FAILURE_RATE:
+            self.failures += 1
+            return True
+        return False
+
+    def open_chat(self, phone_number: str) -> str | None:
+        digits = _digits_only(phone_number)
+        if not digits:
+            return "No valid phone number provided"
+        now = time.monotonic()
+        with self._lock:
+            if not self._window_open:
+                self._window_open = True
+                self._window_at = now + SIM_WINDOW_DELAY
+            self._number = digits
+            self._chat_at = max(now, self._window_at)
+            self.opens += 1
+        return None
+
+    def connect_window(self):
+        wait = self._window_at - time.monotonic()
+        if not self._window_open or wait > WINDOW_WAIT_TIMEOUT:
+            return None, None, None, f"Viber window did not appear within {WINDOW_WAIT_TIMEOUT}s"
+        if wait > 0:
+            time.sleep(wait)
+        if self._fail():
+            return None, None, None, "Viber window did not appear (simulated failure)"
+        return "sim", 1, self._rect(), None
+
+    def window_rect(self, hwnd) -> dict | None:
+        return self._rect() if self._window_open else None
+
+    def close_window(self, app) -> None:
+        with self._lock:
+            self._window_open = False
+        _log_step("close window", 0.0)
+
+    def read_uia_name(self, hwnd, rect_dict: dict) -> tuple[str, str]:
+        return (SIM_UIA_NAME, SIM_UIA_NAME) if SIM_UIA_NAME else ("", "")
+
+    def send_message(self, app, hwnd, message: str, info: dict) -> str | None:
+        time.sleep(SIM_SEND_DELAY)
+        if self._fail():
+            return "Send button not found (simulated failure)"
+        self.sends += 1
+        info["delivery"] = "listed"
+        return None
+
+    def _frame(self):
+        """Current window frame: the chat's panel once it has rendered, a blank panel region before that."""
+        from PIL import ImageDraw
+        with self._lock:
+            number = self._number
+            rendered = time.monotonic() >= self._chat_at + SIM_PANEL_DELAY
+        key = (number, rendered)
+        frame = self._frames.get(key)
+        if frame is None:
+            frame = self._window.copy()
+            px, py, pw, ph = _panel_box(frame.width, frame.height)
+            if pw > 0 and ph > 0:
+                if rendered:
+                    frame.paste(self._panel.resize((pw, ph)), (px, py))
+                    # grey level 97 steps apart for consecutive numbers, well above PANEL_READY_DIFF
+                    shade = int(number[-6:] or "0") * 97 % 256
+                    ImageDraw.Draw(frame).rectangle(
+                        (px + 8, py + 8, px + pw // 2, py + ph // 2), fill=(shade, shade, shade)
+                    )
                 else:
-                    panel_png = None
-    finally:
-        _log_step("screenshot capture", time.monotonic() - t0)
-        # 6) Close Viber window (leave process running, e.g. in tray)
-        if viber_app is not None:
-            t0 = time.monotonic()
+                    ImageDraw.Draw(frame).rectangle((px, py, px + pw - 1, py + ph - 1), fill=(255, 255, 255))
+            if len(self._frames) > 64:
+                self._frames.clear()
+            self._frames[key] = frame
+        return frame
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "window_open": self._window_open,
+            "opens": self.opens,
+            "sends": self.sends,
+            "failures": self.failures,
+        }
+
+
+_driver: _DesktopDriver = _SimDriver() if VIBER_DRIVER == "sim" else _WindowsDriver()
+
+
+def _lookup_capture(
+    number: str, only_panel: bool = False, source: str | None = None, image_format: str | None = None
+) -> tuple[dict | None, str | None]:
+    """
+    Desktop stage of a lookup (must run on the desktop worker): open chat, wait for the panel, capture, and read
+    the name from UIA when source allows. Returns (capture dict for _lookup_recognize, error_message).
+    """
+    source = source or LOOKUP_SOURCE
+    info: dict = {}
+    window_png, panel_png, err = do_viber_search_and_screenshot(
+        number, only_panel=only_panel, read_uia=source in ("auto", "uia"), info=info,
+        image_format=image_format or IMAGE_FORMAT,
+    )
+    if err:
+        return None, err
+    return {
+        "number": number,
+        "only_panel": only_panel,
+        "source": source,
+        "window_png": window_png,
+        "panel_png": panel_png,
+        "uia_name": info.get("uia_name", ""),
+        "uia_text": info.get("uia_text", ""),
+    }, None
+
+
+def _needs_ocr(cap: dict) -> bool:
+    return not cap["uia_name"] and cap["source"] != "uia"
+
+
+def _lookup_recognize(cap: dict, ocr: list[str] | None = None, inline: bool = False) -> dict:
+    """
+    Recognition stage of a lookup (no desktop access, safe on the OCR pool): UIA name if we have one, otherwise
+    the OCR chain. Returns the /check-number-base64 JSON body (image URLs, plus base64 when inline).
+    """
+    number, only_panel = cap["number"], cap["only_panel"]
+    window_png, panel_png = cap["window_png"], cap["panel_png"]
+    if not _needs_ocr(cap):
+        uia_name = cap["uia_name"]
+        return _lookup_output(
+            number, only_panel, window_png, panel_png, cap["uia_text"], uia_name,
+            "uia" if uia_name else "", bool(uia_name), inline=inline,
+        )
+
+    # Run OCR on the image that contains the contact (panel if available, else full window)
+    ocr_image_bytes = panel_png if panel_png is not None else window_png
+    if ocr_image_bytes:
+        log.debug("running on %s (%d bytes)", "panel" if panel_png is not None else "window", len(ocr_image_bytes))
+    t0 = time.monotonic()
+    has_ocr = bool(_available_ocr_backends(ocr))
+    # GPT is in the chain but this API key's daily OCR budget is spent: local OCR only (if any), nothing cached
+    over_budget = _has_gpt_ocr() and "gpt" in (ocr or _parse_ocr_chain(None) or []) and not _gpt_ocr_allowed()
+    if ocr_image_bytes and over_budget:
+        _tenants.refuse(_current_tenant())
+        alog.info("GPT OCR skipped: daily OCR budget of API key %r reached", _current_tenant())
+    elif ocr_image_bytes and not has_ocr:
+        alog.info("OCR skipped: no OCR backend available (set OPENAI_API_KEY or install Tesseract)")
+    panel_text, contact_name, ocr_backend = ocr_image(ocr_image_bytes, ocr) if ocr_image_bytes else ("", "", "")
+    if ocr_image_bytes:
+        _log_step(
+            "OCR total", time.monotonic() - t0, "backend=%s" % (ocr_backend or "none"),
+            backend=ocr_backend or "none", outcome="ok" if contact_name else "no_name",
+        )
+    return _lookup_output(
+        number, only_panel, window_png, panel_png, panel_text, contact_name, ocr_backend, has_ocr, inline=inline,
+        over_budget=over_budget,
+    )
+
+
+def do_viber_lookup(
+    number: str,
+    only_panel: bool = False,
+    ocr: list[str] | None = None,
+    source: str | None = None,
+    image_format: str | None = None,
+    inline: bool = False,
+) -> tuple[dict | None, str | None]:
+    """
+    Capture + OCR for one number, sequentially. Returns (result_dict, error_message); result_dict is the
+    /check-number-base64 JSON body (number, contact_name, panel_text and image URL(s), base64 too when inline).
+    ocr is the OCR backend chain (default OCR_CHAIN); source is auto | uia | ocr (default LOOKUP_SOURCE);
+    image_format is png | webp | jpeg (default IMAGE_FORMAT).
+    """
+    cap, err = _lookup_capture(number, only_panel=only_panel, source=source, image_format=image_format)
+    if err:
+        return None, err
+    return _lookup_recognize(cap, ocr, inline), None
+
+
+def _lookup_output(
+    number: str,
+    only_panel: bool,
+    window_png: bytes | None,
+    panel_png: bytes | None,
+    panel_text: str,
+    contact_name: str,
+    ocr_backend: str,
+    has_ocr: bool,
+    inline: bool = False,
+    over_budget: bool = False,
+) -> dict:
+    """Cache the result and build the /check-number-base64 JSON body (images as /images URLs, base64 if inline)."""
+    out = {"number": number}
+    # Cache only real name reads (no OCR backend / no GPT budget must not pin "no name" for the negative TTL)
+    if panel_png is not None and (contact_name or (has_ocr and not over_budget)):
+        _lookup_cache.put(number, contact_name, panel_text, panel_png)
+
+    if only_panel and panel_png is not None:
+        _add_image(out, "panel", panel_png, inline)
+    else:
+        _add_image(out, "screenshot", window_png, inline)
+        if panel_png is not None:
+            _add_image(out, "contact_panel", panel_png, inline)
+    out["image_mime"] = _image_mime(panel_png if panel_png is not None else window_png)
+
+    # Always include captured text so the UI can show it
+    if panel_text:
+        out["panel_text"] = panel_text
+    elif over_budget and not has_ocr:
+        out["panel_text"] = "(daily OCR budget of this API key reached)"
+    else:
+        out["panel_text"] = "(no text detected)" if has_ocr else "(set OPENAI_API_KEY for OCR)"
+    if over_budget:
+        out["ocr_budget_exhausted"] = True
+    if contact_name:
+        out["contact_name"] = contact_name
+    if ocr_backend:
+        out["ocr_backend"] = ocr_backend
+    return out
+
+
+def _job_capture(number: str, only_panel: bool = False, image_format: str | None = None):
+    window_png, panel_png, err = do_viber_search_and_screenshot(
+        number, only_panel=only_panel, image_format=image_format or IMAGE_FORMAT
+    )
+    return (window_png, panel_png), err
+
+
+_ocr_pool = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr")
+_ocr_slots = threading.BoundedSemaphore(OCR_MAX_PENDING)
+
+
+def _submit_ocr(fn, *args) -> Future:
+    """
+    Run fn(*args) on the OCR pool. Blocks the caller (the desktop worker) while OCR_MAX_PENDING captures are
+    already waiting, so a slow OCR backend throttles the desktop instead of piling up panels in memory.
+    """
+    _ocr_slots.acquire()
+    trace, tag = _current_trace()
+
+    def _run():
+        with _traced(trace, tag):
+            return fn(*args)
+
+    try:
+        fut = _ocr_pool.submit(_run)
+    except Exception:
+        _ocr_slots.release()
+        raise
+    fut.add_done_callback(lambda _f: _ocr_slots.release())
+    return fut
+
+
+def _job_lookup(
+    number: str,
+    only_panel: bool = False,
+    ocr: list[str] | None = None,
+    source: str | None = None,
+    image_format: str | None = None,
+    inline: bool = False,
+):
+    """Desktop stage here; recognition is handed to the OCR pool (returned Future) so the desktop moves on."""
+    cap, err = _lookup_capture(number, only_panel=only_panel, source=source, image_format=image_format)
+    if err:
+        return None, err
+    if not _needs_ocr(cap):
+        return _lookup_recognize(cap, ocr, inline), None
+    return _submit_ocr(_lookup_recognize, cap, ocr, inline), None
+
+
+def _job_send(number: str, message: str):
+    info: dict = {}
+    err = do_viber_send_message(number, message, info)
+    if err:
+        if info.get("delivery") == "unknown":
+            return {"ok": False, "number": number, "delivery": "unknown", "confirmed": False}, err
+        return None, err
+    delivery = info.get("delivery", "unconfirmed")
+    return {"ok": True, "number": number, "delivery": delivery, "confirmed": delivery == "listed"}, None
+
+
+# Job kind -> handler(**params) returning (result, error). "capture" is internal (binary result for /check-number).
+# A handler may return a Future as result: the desktop is free again and the job finishes when the Future does.
+_JOB_HANDLERS = {
+    "capture": _job_capture,
+    "lookup": _job_lookup,
+    "send": _job_send,
+}
+_PUBLIC_JOB_KINDS = ("lookup", "send")
+_COALESCED_JOB_KINDS = ("capture", "lookup")  # read-only, so concurrent duplicates can share one run
+
+
+class _Job:
+    """One unit of desktop work. HTTP threads wait on `done`; the worker fills status/result/error."""
+
+    def __init__(self, kind: str, params: dict):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = "queued"  # queued -> running [-> ocr] -> done | error
+        self.result = None
+        self.error: str | None = None
+        self.created = time.time()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.done = threading.Event()
+        self.trace, _ = _current_trace()  # spans from the worker / OCR pool go to the submitting request's trace
+        self.tenant = self.trace.tenant if self.trace is not None else _ANONYMOUS_TENANT
+        self.tenants = {self.tenant}  # API keys allowed to see the job: the submitter and those coalesced onto it
+        self.priority = "interactive"
+        self.deadline: float | None = None  # time.time() after which the job is dropped if it has not started
+        self.expired = False
+        self._callbacks: list = []
+        self._cb_lock = threading.Lock()
+
+    def add_done_callback(self, fn) -> None:
+        """Call fn(job) once the job finishes (immediately if it already has)."""
+        with self._cb_lock:
+            if not self.done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def finish(self, result, error: str | None) -> None:
+        self.result = result
+        self.error = error
+        self.status = "error" if error else "done"
+        self.finished = time.time()
+        with self._cb_lock:
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
             try:
-                dlg = viber_app.top_window()
-                dlg.close()
-            except Exception:
-                pass
-            _log_step("close window", time.monotonic() - t0)
+                fn(self)
+            except Exception as e:
+                log.warning("job %s callback failed: %s", self.id, e)
+
+    def to_dict(self) -> dict:
+        d = {
+            "job_id": self.id,
+            "type": self.kind,
+            "status": self.status,
+            "number": self.params.get("number"),
+            "priority": self.priority,
+            "api_key": self.tenant,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        if self.status in ("done", "error") and self.result is not None and self.kind in _PUBLIC_JOB_KINDS:
+            d["result"] = self.result  # on error: e.g. a send whose delivery is unknown
+        if self.error:
+            d["error"] = self.error
+        if self.trace is not None:
+            d["trace_id"] = self.trace.id
+        if self.deadline is not None:
+            d["deadline"] = self.deadline
+        return d
+
+
+class _QueueFull(Exception):
+    """The priority class's queue is at its limit; retry_after is the estimated wait in seconds."""
+
+    def __init__(self, priority: str, depth: int, retry_after: int):
+        super().__init__("Queue full (%s: %d waiting), retry in %ds" % (priority, depth, retry_after))
+        self.priority = priority
+        self.depth = depth
+        self.retry_after = retry_after
+
+
+class _DesktopWorker:
+    """
+    Single owner of the Viber desktop. Jobs run strictly one at a time on a dedicated thread, so
+    open_viber_chat / connect_to_viber_window / capture never interleave between requests.
+    """
+
+    def __init__(self):
+        # (class rank, fair-share tag, sequence, job): interactive jobs always run before bulk ones. Within a class,
+        # API keys take turns in proportion to their weight (see _enqueue_locked); one key alone is FIFO.
+        # A job can be in here twice after a priority upgrade; entries of jobs no longer queued are skipped.
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._seq = 0
+        self._vclock = {p: 0.0 for p in _PRIORITIES}  # tag of the class's last dequeued job
+        self._last_tag: dict[tuple[str, str], float] = {}  # (class, API key) -> tag of its newest queued job
+        self._waiting: dict[str, set[_Job]] = {p: set() for p in _PRIORITIES}
+        self._limits = {"interactive": QUEUE_MAX_INTERACTIVE, "bulk": QUEUE_MAX_BULK}
+        self.rejected = {p: 0 for p in _PRIORITIES}
+        self.expired = 0
+        self._avg_run = 5.0  # EWMA of desktop seconds per job, for Retry-After
+        self._jobs: OrderedDict[str, _Job] = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        # Single flight: unfinished lookup/capture job per (kind, normalized number, params); see submit()
+        self._inflight: dict[tuple, _Job] = {}
+        self.coalesced = 0
+        # (API key, Idempotency-Key) -> (send job, time.time() stored), oldest first; see submit()
+        self._by_idempotency_key: OrderedDict[tuple[str, str], tuple[_Job, float]] = OrderedDict()
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="viber-desktop-worker", daemon=True)
+                self._thread.start()
+
+    def submit(
+        self, kind: str, params: dict, priority: str = "interactive", deadline: float | None = None,
+        idempotency_key: str | None = None,
+    ) -> _Job:
+        """
+        Queue a job in its priority class; raises _QueueFull when the class is at its limit. deadline (time.time())
+        drops the job unstarted once passed. A lookup/capture for a number that already has an identical one queued
+        or running (same normalized number and options) is not queued again: the caller gets the in-flight job and
+        shares its result (raising its priority / extending its deadline if needed).
+        An idempotency_key the caller's API key already used (within IDEMPOTENCY_KEY_TTL, even after the job left
+        the history) returns that job instead (whatever its params), unless it certainly did nothing: expired
+        unstarted, or failed without a result (a send that was not made).
+        """
+        key = self._flight_key(kind, params)
+        with self._lock:
+            if idempotency_key:
+                self._prune_idempotency_keys_locked()
+                job, _ = self._by_idempotency_key.get((_current_tenant(), idempotency_key), (None, 0.0))
+                if job is not None and not (job.expired or (job.error and job.result is None)):
+                    return job
+            job = self._inflight.get(key) if key else None
+            if job is not None and not job.done.is_set():
+                self.coalesced += 1
+                _metrics.inc("viber_agent_coalesced_total", kind=kind)
+                job.tenants.add(_current_tenant())
+                if job.deadline is not None:
+                    job.deadline = None if deadline is None else max(job.deadline, deadline)
+                if job.status == "queued" and _PRIORITIES.index(priority) < _PRIORITIES.index(job.priority):
+                    self._waiting[job.priority].discard(job)
+                    job.priority = priority
+                    self._enqueue_locked(job)
+                return job
+            waiting = len(self._waiting[priority])
+            if waiting >= self._limits[priority]:
+                self.rejected[priority] += 1
+                _metrics.inc("viber_agent_queue_rejected_total", priority=priority)
+                raise _QueueFull(priority, waiting, self._retry_after_locked(priority))
+            job = _Job(kind, params)
+            job.priority = priority
+            job.deadline = deadline
+            self._prune_locked()
+            self._jobs[job.id] = job
+            if key:
+                self._inflight[key] = job
+            if idempotency_key:
+                self._by_idempotency_key.pop((job.tenant, idempotency_key), None)
+                self._by_idempotency_key[(job.tenant, idempotency_key)] = (job, time.time())
+                self._prune_idempotency_keys_locked()
+            self._enqueue_locked(job)
+        if key:
+            job.add_done_callback(lambda j, key=key: self._land(key, j))
+        self._ensure_started()
+        return job
+
+    def _enqueue_locked(self, job: _Job) -> None:
+        """
+        Weighted round robin by virtual time: each job of a key is tagged 1/weight after that key's previous job
+        (or after the class's current clock, so an idle key gets no saved-up credit) and the lowest tag runs first.
+        Keys with weights 3 and 1 that both have work queued get 3 jobs to 1.
+        """
+        self._seq += 1
+        flow = (job.priority, job.tenant)
+        tag = max(self._vclock[job.priority], self._last_tag.get(flow, 0.0)) + 1.0 / _tenants.weight(job.tenant)
+        self._last_tag[flow] = tag
+        self._waiting[job.priority].add(job)
+        self._queue.put((_PRIORITIES.index(job.priority), tag, self._seq, job))
+
+    def admit(self, priority: str, n: int) -> None:
+        """Raise _QueueFull unless n more jobs fit into priority's queue (checked up front for batches)."""
+        with self._lock:
+            waiting = len(self._waiting[priority])
+            if waiting + n > self._limits[priority]:
+                self.rejected[priority] += 1
+                _metrics.inc("viber_agent_queue_rejected_total", priority=priority)
+                raise _QueueFull(priority, waiting, self._retry_after_locked(priority))
+
+    def _retry_after_locked(self, priority: str) -> int:
+        """Seconds until priority's queue has room: the higher classes' waiting jobs plus one, x average run time."""
+        ahead = 1 + sum(len(self._waiting[p]) for p in _PRIORITIES[:_PRIORITIES.index(priority)])
+        return max(1, min(3600, int(ahead * self._avg_run + 0.999)))
+
+    @staticmethod
+    def _flight_key(kind: str, params: dict) -> tuple | None:
+        if kind not in _COALESCED_JOB_KINDS:
+            return None
+        number = _normalize_number(params.get("number") or "")
+        if not number:
+            return None
+        return (kind, number) + tuple(sorted((k, repr(v)) for k, v in params.items() if k != "number"))
+
+    def _land(self, key: tuple, job: _Job) -> None:
+        with self._lock:
+            if self._inflight.get(key) is job:
+                del self._inflight[key]
+
+    def record_done(self, kind: str, params: dict, result) -> _Job:
+        """Register a job answered without the desktop (e.g. cache hit) so GET /jobs/<id> works the same way."""
+        job = _Job(kind, params)
+        job.started = job.created
+        job.finish(result, None)
+        with self._lock:
+            self._prune_locked()
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> _Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def queue_depth(self, priority: str | None = None) -> int:
+        with self._lock:
+            if priority is not None:
+                return len(self._waiting[priority])
+            return sum(len(w) for w in self._waiting.values())
+
+    def tenant_depths(self) -> dict[str, int]:
+        """Waiting jobs per API key (all classes)."""
+        with self._lock:
+            depths = {name: 0 for name in _tenants.names()}
+            for w in self._waiting.values():
+                for j in w:
+                    depths[j.tenant] = depths.get(j.tenant, 0) + 1
+        return depths
+
+    def queue_stats(self) -> dict:
+        """Per class: waiting jobs, limit, age of the oldest waiting job; plus rejected/expired counts."""
+        now = time.time()
+        with self._lock:
+            classes = {
+                p: {
+                    "depth": len(w),
+                    "max": self._limits[p],
+                    "oldest_wait_s": round(now - min(j.created for j in w), 1) if w else 0.0,
+                    "rejected": self.rejected[p],
+                }
+                for p, w in self._waiting.items()
+            }
+        return dict(classes, expired=self.expired, avg_job_s=round(self._avg_run, 2))
+
+    def status_counts(self) -> dict[str, int]:
+        with self._lock:
+            counts: dict[str, int] = {}
+            for j in self._jobs.values():
+                counts[j.status] = counts.get(j.status, 0) + 1
+            return counts
+
+    def _prune_locked(self) -> None:
+        """Drop finished jobs past JOB_RESULT_TTL or beyond JOB_HISTORY_MAX (oldest first)."""
+        now = time.time()
+        finished = [j for j in self._jobs.values() if j.done.is_set()]
+        excess = len(self._jobs) - JOB_HISTORY_MAX
+        for j in finished:
+            if excess > 0 or (j.finished and now - j.finished > JOB_RESULT_TTL):
+                del self._jobs[j.id]
+                excess -= 1
+
+    def _prune_idempotency_keys_locked(self) -> None:
+        """Drop idempotency keys past IDEMPOTENCY_KEY_TTL or beyond IDEMPOTENCY_KEY_MAX (oldest first)."""
+        now = time.time()
+        keys = self._by_idempotency_key
+        while keys and (len(keys) > IDEMPOTENCY_KEY_MAX or now - next(iter(keys.values()))[1] > IDEMPOTENCY_KEY_TTL):
+            keys.popitem(last=False)
+
+    def _next(self) -> _Job:
+        """Next job to run, skipping stale entries (priority upgrades) and jobs whose deadline has passed."""
+        while True:
+            _, tag, _, job = self._queue.get()
+            with self._lock:
+                if job not in self._waiting[job.priority]:
+                    continue
+                self._waiting[job.priority].discard(job)
+                self._vclock[job.priority] = max(self._vclock[job.priority], tag)
+            if job.deadline is not None and time.time() > job.deadline:
+                self.expired += 1
+                _metrics.inc("viber_agent_jobs_expired_total", kind=job.kind, priority=job.priority)
+                alog.info("job %s (%s %s) dropped: deadline passed while queued", job.id[:8], job.kind, job.priority)
+                job.expired = True
+                job.finish(None, "Deadline passed before the job reached Viber")
+                continue
+            job.status = "running"
+            return job
+
+    def _run(self) -> None:
+        while True:
+            job = self._next()
+            job.started = time.time()
+            _metrics.observe(
+                "viber_agent_stage_seconds", job.started - job.created,
+                stage="queue wait", backend=job.priority, retry="0", outcome=job.kind,
+            )
+            if job.trace is not None:
+                job.trace.add_span("queue wait", job.started - job.created, number=job.params.get("number"),
+                                   priority=job.priority)
+            try:
+                with _traced(job.trace, job.params.get("number")):
+                    result, err = _JOB_HANDLERS[job.kind](**job.params)
+            except Exception as e:
+                log.exception("job %s (%s) failed: %s", job.id, job.kind, e)
+                result, err = None, str(e)
+            self._avg_run = 0.8 * self._avg_run + 0.2 * (time.time() - job.started)
+            if isinstance(result, Future):
+                job.status = "ocr"
+                result.add_done_callback(lambda fut, job=job: self._finish_from_future(job, fut))
+            else:
+                job.finish(result, err)
+
+    @staticmethod
+    def _finish_from_future(job: _Job, fut: Future) -> None:
+        try:
+            job.finish(fut.result(), None)
+        except Exception as e:
+            log.exception("job %s (%s) failed in OCR stage: %s", job.id, job.kind, e)
+            job.finish(None, str(e))
+
+
+_worker = _DesktopWorker()
+
+
+# Recipient states that never change again (a campaign is done when all of its messages are in one)
+_CAMPAIGN_FINAL = ("sent", "failed", "unknown", "skipped", "cancelled")
+_CAMPAIGN_ACTIONS = ("pause", "resume", "cancel")
+
+
+def _render_message(template: str, variables: dict) -> tuple[str | None, str | None]:
+    """Fill the {name} fields of a campaign template from variables. Returns (message, None) or (None, error)."""
+    try:
+        for _, field, _, _ in string.Formatter().parse(template):
+            if field is None:
+                continue
+            if not field.isidentifier():
+                return None, "template fields must be plain names like {name}, got {%s}" % field
+            if field not in variables:
+                return None, "missing variable %r" % field
+        return template.format_map(variables), None
+    except (ValueError, KeyError, IndexError) as e:
+        return None, "invalid template: %s" % e
+
+
+class _CampaignOutbox:
+    """
+    Durable outbox behind POST /campaigns (SQLite, CAMPAIGN_DB): one row per recipient with the rendered message.
+    A sender thread hands due rows to the desktop worker as bulk "send" jobs, each campaign at its own rate, and
+    records the outcome, so campaigns continue where they stopped after a restart.
+    Delivery is at most once: a message that was on its way to Viber when the agent stopped, whose send failed
+    after Send may have been pressed, or whose send still ran after SYNC_JOB_TIMEOUT becomes "unknown" and is not
+    resent; messages whose send returned any other error are retried up to CAMPAIGN_MAX_ATTEMPTS times.
+    """
+
+    def __init__(self, db_path: str):
+        self._db: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._next_due: dict[str, float] = {}  # campaign id -> time.time() its next message may start
+        if db_path and db_path.lower() not in ("off", "0", "none"):
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.executescript(
+                    "CREATE TABLE IF NOT EXISTS campaigns ("
+                    " id TEXT PRIMARY KEY, tenant TEXT, name TEXT, idempotency_key TEXT, status TEXT,"
+                    " rate_per_minute REAL, created REAL, updated REAL, UNIQUE (tenant, idempotency_key));"
+                    "CREATE TABLE IF NOT EXISTS outbox ("
+                    " id INTEGER PRIMARY KEY AUTOINCREMENT, campaign_id TEXT, seq INTEGER, tenant TEXT,"
+                    " idempotency_key TEXT, number TEXT, message TEXT, status TEXT, attempts INTEGER DEFAULT 0,"
+                    " next_attempt REAL DEFAULT 0, error TEXT, delivery TEXT, job_id TEXT, updated REAL, sent_at REAL,"
+                    " UNIQUE (tenant, idempotency_key));"
+                    "CREATE INDEX IF NOT EXISTS outbox_campaign ON outbox (campaign_id, status, seq);"
+                )
+                interrupted = self._db.execute(
+                    "UPDATE outbox SET status = 'unknown', error = ?, updated = ? WHERE status = 'sending'",
+                    ("Agent stopped while sending; not resent to avoid a double send", time.time()),
+                ).rowcount
+                self._db.commit()
+                if interrupted:
+                    alog.info("campaigns: %d message(s) interrupted by the last shutdown marked unknown", interrupted)
+            except Exception as e:
+                alog.info("campaigns: SQLite disabled (%s)", e)
+                self._db = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def create(
+        self, tenant: str, idempotency_key: str | None, name: str, rate: float, rows: list[tuple[str, str, str | None]]
+    ) -> tuple[dict, bool]:
+        """
+        Store a campaign and its messages (rows: number, message, recipient idempotency key or None) in one
+        transaction. Returns (campaign, created); a campaign with the same idempotency key is returned unchanged.
+        A recipient key this API key already used (in this or an earlier campaign) makes that message "skipped";
+        without a key, the same number twice in one campaign counts as a duplicate.
+        """
+        now = time.time()
+        campaign_id = uuid.uuid4().hex
+        with self._lock:
+            if idempotency_key:
+                row = self._db.execute(
+                    "SELECT id FROM campaigns WHERE tenant = ? AND idempotency_key = ?", (tenant, idempotency_key)
+                ).fetchone()
+                if row:
+                    return self._summary_locked(row[0]), False
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO campaigns VALUES (?, ?, ?, ?, 'active', ?, ?, ?)",
+                    (campaign_id, tenant, name, idempotency_key or None, rate, now, now),
+                )
+                for seq, (number, message, key) in enumerate(rows):
+                    key = key or "%s:%s" % (campaign_id, _normalize_number(number))
+                    try:
+                        self._db.execute(
+                            "INSERT INTO outbox (campaign_id, seq, tenant, idempotency_key, number, message, status,"
+                            " updated) VALUES (?, ?, ?, ?, ?, ?, 'pending', ?)",
+                            (campaign_id, seq, tenant, key, number, message, now),
+                        )
+                    except sqlite3.IntegrityError:
+                        prev = self._db.execute(
+                            "SELECT campaign_id FROM outbox WHERE tenant = ? AND idempotency_key = ?", (tenant, key)
+                        ).fetchone()
+                        self._db.execute(
+                            "INSERT INTO outbox (campaign_id, seq, tenant, number, message, status, error, updated)"
+                            " VALUES (?, ?, ?, ?, ?, 'skipped', ?, ?)",
+                            (campaign_id, seq, tenant, number, message,
+                             "Duplicate idempotency key (campaign %s)" % (prev[0] if prev else "?"), now),
+                        )
+            summary = self._summary_locked(campaign_id)
+        alog.info("campaign %s created: %d messages at %g/min", campaign_id[:8], len(rows), rate)
+        self.start()
+        self._wake.set()
+        return summary, True
+
+    def _summary_locked(self, campaign_id: str) -> dict | None:
+        row = self._db.execute(
+            "SELECT id, tenant, name, status, rate_per_minute, created, updated FROM campaigns WHERE id = ?",
+            (campaign_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        counts = dict(self._db.execute(
+            "SELECT status, COUNT(*) FROM outbox WHERE campaign_id = ? GROUP BY status", (campaign_id,)
+        ).fetchall())
+        total = sum(counts.values())
+        finished = sum(n for status, n in counts.items() if status in _CAMPAIGN_FINAL)
+        return {
+            "campaign_id": row[0],
+            "api_key": row[1],
+            "name": row[2],
+            "status": row[3],
+            "rate_per_minute": row[4],
+            "created": row[5],
+            "updated": row[6],
+            "total": total,
+            "counts": counts,
+            "progress": round(finished / total, 4) if total else 1.0,
+            "status_url": "/campaigns/%s" % row[0],
+        }
+
+    def get(self, campaign_id: str, tenant: str) -> dict | None:
+        """Campaign summary, or None if it does not exist or belongs to another API key."""
+        with self._lock:
+            summary = self._summary_locked(campaign_id)
+        return summary if summary and summary["api_key"] == tenant else None
+
+    def for_tenant(self, tenant: str, limit: int = 100) -> list[dict]:
+        with self._lock:
+            ids = [r[0] for r in self._db.execute(
+                "SELECT id FROM campaigns WHERE tenant = ? ORDER BY created DESC LIMIT ?", (tenant, limit)
+            ).fetchall()]
+            return [self._summary_locked(cid) for cid in ids]
+
+    def recipients(self, campaign_id: str, status: str | None, offset: int, limit: int) -> list[dict]:
+        """Per-recipient progress in campaign order, optionally only one status."""
+        sql = (
+            "SELECT seq, number, idempotency_key, status, attempts, error, delivery, job_id, sent_at FROM outbox"
+            " WHERE campaign_id = ?" + (" AND status = ?" if status else "") + " ORDER BY seq LIMIT ? OFFSET ?"
+        )
+        args = (campaign_id,) + ((status,) if status else ()) + (limit, offset)
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        keys = ("index", "number", "idempotency_key", "status", "attempts", "error", "delivery", "job_id", "sent_at")
+        return [{k: v for k, v in zip(keys, r) if v is not None} for r in rows]
 
-    _log_step("TOTAL (Viber + capture)", time.monotonic() - total_start)
-    print("[viber-agent] --- lookup done ---", flush=True)
+    def act(self, campaign_id: str, tenant: str, action: str) -> tuple[dict | None, str | None]:
+        """pause (active), resume (paused) or cancel (active/paused; unsent messages become "cancelled")."""
+        allowed = {"pause": ("active",), "resume": ("paused",), "cancel": ("active", "paused")}[action]
+        new_status = {"pause": "paused", "resume": "active", "cancel": "cancelled"}[action]
+        now = time.time()
+        with self._lock:
+            summary = self._summary_locked(campaign_id)
+            if summary is None or summary["api_key"] != tenant:
+                return None, None
+            if summary["status"] not in allowed:
+                return None, "Cannot %s a campaign that is %s" % (action, summary["status"])
+            with self._db:
+                self._db.execute(
+                    "UPDATE campaigns SET status = ?, updated = ? WHERE id = ?", (new_status, now, campaign_id)
+                )
+                if action == "cancel":
+                    self._db.execute(
+                        "UPDATE outbox SET status = 'cancelled', updated = ? WHERE campaign_id = ? AND status = 'pending'",
+                        (now, campaign_id),
+                    )
+            summary = self._summary_locked(campaign_id)
+        alog.info("campaign %s %s", campaign_id[:8], new_status)
+        if action == "resume":
+            self.start()
+            self._wake.set()
+        return summary, None
 
-    _save_last_capture(panel_png, window_png)
-    return window_png, panel_png, None
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        with self._lock:
+            active = self._db.execute("SELECT COUNT(*) FROM campaigns WHERE status = 'active'").fetchone()[0]
+            pending = self._db.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = 'pending' AND campaign_id IN"
+                " (SELECT id FROM campaigns WHERE status = 'active')"
+            ).fetchone()[0]
+        return {"enabled": True, "active": active, "pending": pending}
 
+    def start(self) -> None:
+        """Start the sender thread (no-op if running); at server start this resumes campaigns left active."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="campaign-sender", daemon=True)
+                self._thread.start()
 
-def _send_message_via_uia(hwnd: int, message: str) -> str | None:
-    """
-    Use UI Automation: set text on the chat Edit and invoke Send button.
-    Works without keyboard focus (e.g. when RDP is disconnected). Returns None on success, error string on failure.
-    """
-    try:
-        time.sleep(1.5)  # let chat UI finish loading before querying UIA
-        app_uia = Application(backend="uia").connect(handle=hwnd)
-        dlg = app_uia.window(handle=hwnd)
-        if os.environ.get("DEBUG_UIA_DUMP", "").strip().lower() in ("1", "true", "yes"):
-            _agent_dir = os.path.dirname(os.path.abspath(__file__))
-            path = os.path.join(_agent_dir, "viber_uia_tree.txt")
+    def _run(self) -> None:
+        while True:
             try:
-                dlg.print_control_identifiers(depth=None, filename=path)
-                print("[viber-agent] UIA tree dumped to %s" % path, flush=True)
-            except Exception as dump_err:
-                print("[viber-agent] UIA dump failed: %s" % dump_err, flush=True)
-        # Message input: Viber's typing box is the Edit whose automation_id contains QQuickTextEdit (UIA tree).
-        # Send button: automation_id contains SendToolbarButton. UIA backend has no auto_id_re, so match from descendants.
-        def _auto_id(ctrl):
+                row, wait = self._next_message()
+            except Exception as e:
+                log.exception("campaign sender failed: %s", e)
+                row, wait = None, 5.0
+            if row is None:
+                self._wake.wait(wait)
+                self._wake.clear()
+                continue
             try:
-                return getattr(getattr(ctrl, "element_info", None), "automation_id", None) or ""
-            except Exception:
-                return ""
-
-        edit = None
-        for c in dlg.descendants(control_type="Edit"):
-            if "QQuickTextEdit" in _auto_id(c):
-                edit = c
-                break
-        if edit is None:
-            edits = dlg.descendants(control_type="Edit")
-            if not edits:
-                return "No Edit control found"
-            edit = edits[-1]
-        edit.set_focus()
-        edit.set_edit_text(message)
-        time.sleep(0.2)
-
-        send_btn = None
-        for b in dlg.descendants(control_type="Button"):
-            if "SendToolbarButton" in _auto_id(b):
-                send_btn = b
-                break
-        if send_btn is None:
-            for b in dlg.descendants(control_type="Button"):
+                self._send(*row)
+            except Exception as e:
+                log.exception("campaign sender failed on message %s: %s", row[0], e)
+                # It may have reached Viber: never resend it (a restart would mark it unknown too)
                 try:
-                    if (b.window_text() or "").strip() in ("Send", "Изпрати", "Senden", "Envoyer", "Enviar"):
-                        send_btn = b
-                        break
+                    self._update(row[0], "unknown", error="Sender error: %s" % e)
                 except Exception:
+                    pass
+                time.sleep(1.0)
+
+    def _next_message(self) -> tuple[tuple | None, float]:
+        """
+        Claim the next due message (marked "sending") as ((row id, campaign, tenant, number, message, attempt), 0),
+        or return (None, seconds until one is due). Due campaigns take turns; finished ones are marked done.
+        """
+        now = time.time()
+        best, wait = None, 60.0
+        with self._lock:
+            campaigns = self._db.execute(
+                "SELECT id, tenant, rate_per_minute FROM campaigns WHERE status = 'active' ORDER BY created"
+            ).fetchall()
+            for campaign_id, tenant, rate in campaigns:
+                row = self._db.execute(
+                    "SELECT id, number, message, attempts FROM outbox"
+                    " WHERE campaign_id = ? AND status = 'pending' AND next_attempt <= ? ORDER BY seq LIMIT 1",
+                    (campaign_id, now),
+                ).fetchone()
+                if row is None:
+                    retry_at = self._db.execute(
+                        "SELECT MIN(next_attempt) FROM outbox WHERE campaign_id = ? AND status = 'pending'",
+                        (campaign_id,),
+                    ).fetchone()[0]
+                    if retry_at is not None:
+                        wait = min(wait, retry_at - now)
+                    elif not self._db.execute(
+                        "SELECT 1 FROM outbox WHERE campaign_id = ? AND status = 'sending'", (campaign_id,)
+                    ).fetchone():
+                        self._db.execute(
+                            "UPDATE campaigns SET status = 'done', updated = ? WHERE id = ?", (now, campaign_id)
+                        )
+                        self._db.commit()
+                        self._next_due.pop(campaign_id, None)
+                        alog.info("campaign %s done", campaign_id[:8])
                     continue
-        if send_btn is None:
-            return "Send button not found"
+                due = self._next_due.get(campaign_id, 0.0)
+                if due > now:
+                    wait = min(wait, due - now)
+                elif best is None or due < best[0]:
+                    best = (due, campaign_id, tenant, rate, row)
+            if best is None:
+                return None, max(0.05, wait)
+            _, campaign_id, tenant, rate, (row_id, number, message, attempts) = best
+            self._db.execute(
+                "UPDATE outbox SET status = 'sending', attempts = attempts + 1, updated = ? WHERE id = ?", (now, row_id)
+            )
+            self._db.commit()
+            self._next_due[campaign_id] = now + 60.0 / rate
+        return (row_id, campaign_id, tenant, number, message, attempts + 1), 0.0
+
+    def _send(self, row_id: int, campaign_id: str, tenant: str, number: str, message: str, attempt: int) -> None:
+        """Send one message through the desktop worker (bulk, the campaign's API key) and record the outcome."""
+        trace = _Trace(uuid.uuid4().hex, "campaign %s" % campaign_id)
+        trace.tenant = tenant
         try:
-            send_btn.invoke()
-        except Exception:
-            try:
-                send_btn.click()
-            except Exception as click_err:
-                return "Send button invoke/click failed: %s" % click_err
-        return None
-    except Exception as e:
-        return str(e)
+            with _traced(trace, number):
+                # The deadline drops the job unstarted behind a long queue, so it can be retried safely
+                job = _worker.submit(
+                    "send", {"number": number, "message": message}, "bulk", time.time() + SYNC_JOB_TIMEOUT
+                )
+        except _QueueFull as e:
+            self._update(row_id, "pending", attempts=attempt - 1, next_attempt=time.time() + e.retry_after)
+            return
+        self._update(row_id, "sending", job_id=job.id)
+        # Bounded, so one send that never finishes cannot stall every campaign (nor their pause / cancel);
+        # past the deadline a job still queued can no longer start (the extra second covers the dequeue)
+        done = job.done.wait(SYNC_JOB_TIMEOUT) or job.done.wait(1.0)
+        if job.expired or (not done and job.status == "queued"):
+            status = "pending"
+            self._update(row_id, status, attempts=attempt - 1, next_attempt=time.time() + CAMPAIGN_RETRY_DELAY)
+        elif not done:
+            status = "unknown"
+            self._update(row_id, status, error="Timed out waiting for Viber after %ds (job %s still %s)"
+                         % (SYNC_JOB_TIMEOUT, job.id, job.status))
+        elif not job.error:
+            status = "sent"
+            self._update(row_id, status, error=None, delivery=job.result.get("delivery"), sent_at=job.finished)
+        elif (job.result or {}).get("delivery") == "unknown":
+            # Send may have been pressed before the error: retrying could deliver the message twice
+            status = "unknown"
+            self._update(row_id, status, error=job.error, delivery="unknown")
+        elif attempt < CAMPAIGN_MAX_ATTEMPTS:
+            status = "pending"
+            retry_at = time.time() + CAMPAIGN_RETRY_DELAY * 2 ** (attempt - 1)
+            self._update(row_id, status, error=job.error, next_attempt=retry_at)
+            alog.info("campaign %s: send to %s failed (%s), retry %d at +%ds", campaign_id[:8], number, job.error,
+                      attempt, retry_at - time.time())
+        else:
+            status = "failed"
+            self._update(row_id, status, error=job.error)
+        _metrics.inc("viber_agent_campaign_messages_total", status="retry" if status == "pending" else status)
+
+    def _update(self, row_id: int, status: str, **fields) -> None:
+        fields["status"] = status
+        fields["updated"] = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET %s WHERE id = ?" % ", ".join("%s = ?" % k for k in fields),
+                tuple(fields.values()) + (row_id,),
+            )
+            self._db.commit()
+
+
+_campaigns = _CampaignOutbox(CAMPAIGN_DB)
+
+
+def _collect_runtime_metrics():
+    """Scrape-time gauges/counters kept by other components (queue, caches, capture, OpenAI limiter)."""
+    cache = _lookup_cache.stats()
+    images = _image_store.stats()
+    queue_stats = _worker.queue_stats()
+    yield "viber_agent_queue_depth", "gauge", "Jobs waiting for the desktop worker", [
+        ({"priority": p}, queue_stats[p]["depth"]) for p in _PRIORITIES
+    ]
+    yield "viber_agent_queue_oldest_wait_seconds", "gauge", "Age of the oldest waiting job", [
+        ({"priority": p}, queue_stats[p]["oldest_wait_s"]) for p in _PRIORITIES
+    ]
+    yield "viber_agent_tenant_queue_depth", "gauge", "Jobs waiting for the desktop worker per API key", [
+        ({"tenant": name}, n) for name, n in _worker.tenant_depths().items()
+    ]
+    yield "viber_agent_tenant_ocr_spend_today_usd", "gauge", "Estimated OpenAI spend today per API key", [
+        ({"tenant": name}, _tenants.stats(name)["spent_today_usd"]) for name in _tenants.names()
+    ]
+    yield "viber_agent_jobs", "gauge", "Jobs in the job history by status", [
+        ({"status": status}, n) for status, n in _worker.status_counts().items()
+    ]
+    yield "viber_agent_lookup_cache_requests_total", "counter", "Lookup cache reads by result", [
+        ({"result": "hit"}, cache["hits"]), ({"result": "miss"}, cache["misses"]),
+    ]
+    yield "viber_agent_lookup_cache_items", "gauge", "Entries in the in-memory lookup cache", [({}, cache["items"])]
+    yield "viber_agent_image_store_bytes", "gauge", "Bytes held by the /images store", [({}, images["bytes"])]
+    yield "viber_agent_image_store_evicted_total", "counter", "Images dropped from the /images store", [
+        ({}, images["evicted"])
+    ]
+    yield "viber_agent_capture_grabs_total", "counter", "Window grabs by capture backend", [
+        ({"backend": st["backend"]}, st["grabs"]) for st in (b.stats() for b in _driver.capture_backends) if "grabs" in st
+    ]
+
+
+_metrics.collector(_collect_runtime_metrics)
+
+
+@app.after_request
+def _count_request(resp):
+    if request.url_rule is not None and request.method != "OPTIONS":
+        _metrics.inc(
+            "viber_agent_requests_total", endpoint=request.url_rule.rule, method=request.method, status=str(resp.status_code)
+        )
+    return resp
+
+
+def _run_job_sync(kind: str, params: dict, priority: str = "interactive", deadline: float | None = None) -> _Job:
+    """Enqueue a job and block the HTTP thread until it finishes or SYNC_JOB_TIMEOUT elapses (raises _QueueFull)."""
+    job = _worker.submit(kind, params, priority, deadline)
+    job.done.wait(SYNC_JOB_TIMEOUT)
+    return job
 
 
-def do_viber_send_message(phone_number: str, message: str) -> str | None:
+def _admission_params(data: dict, default_priority: str) -> tuple[str | None, float | None, str | None]:
     """
-    Open Viber chat with the given number, type the message, send it, then close Viber.
-    Tries UIA first (Edit + Send button; works when RDP disconnected). Falls back to keyboard if UIA fails.
-    Returns None on success, or an error message string.
+    'priority' (interactive | bulk) and 'deadline_ms' (ms from now; the job is dropped if it has not reached Viber
+    by then) from the request JSON. Returns (priority, deadline as time.time(), None) or (None, None, error).
     """
-    if not HAS_PYWINAUTO:
-        return "pywinauto not installed"
-    if not message or not message.strip():
-        return "Message is empty"
-    msg = message.strip()
+    priority = str(data.get("priority") or default_priority).strip().lower()
+    if priority not in _PRIORITIES:
+        return None, None, "'priority' must be one of: %s" % ", ".join(_PRIORITIES)
+    deadline = None
+    if data.get("deadline_ms") is not None:
+        try:
+            ms = float(data["deadline_ms"])
+        except (TypeError, ValueError):
+            ms = -1
+        if ms <= 0:
+            return None, None, "'deadline_ms' must be a positive number of milliseconds"
+        deadline = time.time() + ms / 1000.0
+    return priority, deadline, None
 
-    total_start = time.monotonic()
-    print("[viber-agent] --- send message start ---", flush=True)
 
-    t0 = time.monotonic()
-    err = open_viber_chat(phone_number)
-    _log_step("open viber:// link", time.monotonic() - t0)
+@app.errorhandler(_QueueFull)
+def _queue_full_response(e: _QueueFull):
+    resp = jsonify(error=str(e), priority=e.priority, queue_depth=e.depth, retry_after=e.retry_after)
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+
+def _cache_mode(data: dict) -> str | None:
+    """'cache' request field (bypass | prefer | only), default LOOKUP_CACHE_DEFAULT. None if invalid."""
+    mode = str(data.get("cache") or LOOKUP_CACHE_DEFAULT).strip().lower()
+    return mode if mode in _CACHE_MODES else None
+
+
+def _lookup_params(data: dict, number: str) -> tuple[dict | None, str | None]:
+    """
+    Lookup job params from the request JSON: only_panel, 'ocr' backend chain ("gpt", "local,gpt", ...)
+    and name 'source' (auto | uia | ocr). Returns (params, None) or (None, error).
+    """
+    chain = None
+    spec = data.get("ocr")
+    if spec:
+        chain = _parse_ocr_chain(str(spec))
+        if chain is None:
+            return None, "'ocr' must be a comma-separated list of: %s" % ", ".join(_OCR_BACKENDS)
+    source = str(data.get("source") or "").strip().lower() or None
+    if source is not None and source not in _LOOKUP_SOURCES:
+        return None, "'source' must be one of: %s" % ", ".join(_LOOKUP_SOURCES)
+    image_format, err = _image_format_param(data)
     if err:
-        return err
+        return None, err
+    return {
+        "number": number,
+        "only_panel": data.get("only_panel") is True,
+        "ocr": chain,
+        "source": source,
+        "image_format": image_format,
+        "inline": data.get("inline_images", IMAGE_INLINE) is True,
+    }, None
 
-    time.sleep(INITIAL_WAIT)
-    viber_app, _, err = connect_to_viber_window()
-    if err or viber_app is None:
-        return err or "Could not find Viber window"
 
-    dlg = viber_app.top_window()
-    try:
-        dlg.restore()
-        dlg.set_focus()
-    except Exception:
-        pass
-    time.sleep(MESSAGE_INPUT_WAIT)
+def _image_format_param(data: dict) -> tuple[str | None, str | None]:
+    """'image_format' request field (png | webp | jpeg, "jpg" accepted) -> (format or None for IMAGE_FORMAT, error)."""
+    fmt = str(data.get("image_format") or "").strip().lower()
+    if not fmt:
+        return None, None
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    if fmt not in _IMAGE_FORMATS:
+        return None, "'image_format' must be one of: %s" % ", ".join(_IMAGE_FORMATS)
+    return fmt, None
 
-    hwnd = getattr(dlg, "handle", None) or getattr(dlg, "handle_id", None)
-    t0 = time.monotonic()
-    sent = False
 
-    uia_error = None
-    if hwnd:
-        err_uia = _send_message_via_uia(hwnd, msg)
-        if err_uia is None:
-            sent = True
-            print("[viber-agent] send message via UIA (Edit + Send button)", flush=True)
-        else:
-            uia_error = err_uia
-            print("[viber-agent] UIA send failed: %s — falling back to keyboard" % (err_uia,), flush=True)
+def _cached_lookup(number: str, only_panel: bool, cache_mode: str, inline: bool = False) -> dict | None:
+    """
+    Cached /check-number-base64 body for this number, or None (go to Viber).
+    The cache holds the panel only, so full-window lookups read it only with cache=only.
+    bypass never reads but the fresh result still refreshes the cache.
+    """
+    if cache_mode == "bypass" or (cache_mode == "prefer" and not only_panel):
+        return None
+    entry = _lookup_cache.get(number)
+    if entry is None:
+        return None
+    alog.info("lookup cache hit for %s", number)
+    return _lookup_result_from_cache(entry, number, only_panel, inline)
 
-    if not sent and _keyboard_send_keys is not None:
-        try:
-            import win32gui
-            if hwnd:
-                win32gui.SetForegroundWindow(hwnd)
-                time.sleep(0.2)
-        except Exception:
-            pass
-        safe = msg.replace("{", "{{").replace("}", "}}")
-        for attempt in range(2):
-            try:
-                _keyboard_send_keys(safe + "{ENTER}", with_spaces=True)
-                sent = True
-                break
-            except Exception as e:
-                err_msg = str(e).strip()
-                if "inserted only 0" in err_msg.lower() or "0 out of" in err_msg:
-                    err_msg = (
-                        "UIA path failed (%s). Keyboard fallback failed because RDP is not in the foreground. "
-                        "Keep RDP connected and the Viber window visible, or ensure Viber exposes the message box and Send button to UI Automation."
-                    ) % (uia_error or "unknown")
-                if attempt == 0 and hwnd:
-                    try:
-                        import win32gui
-                        win32gui.SetForegroundWindow(hwnd)
-                        time.sleep(0.5)
-                    except Exception:
-                        pass
-                    continue
-                _log_step("type message", time.monotonic() - t0)
-                return f"Failed to type/send: {err_msg}"
-    elif not sent:
-        _log_step("type message", time.monotonic() - t0)
-        return "Could not send via UIA and keyboard not available"
 
-    _log_step("type message + Send", time.monotonic() - t0)
+def _idempotency_key(data: dict) -> str | None:
+    """Idempotency-Key header, or "idempotency_key" in the JSON body."""
+    return str(request.headers.get("Idempotency-Key") or data.get("idempotency_key") or "").strip() or None
 
-    time.sleep(0.5)
-    try:
-        dlg = viber_app.top_window()
-        dlg.close()
-    except Exception:
-        pass
-    _log_step("TOTAL (send message)", time.monotonic() - total_start)
-    print("[viber-agent] --- send message done ---", flush=True)
-    return None
+
+def _same_send(a: dict, b: dict) -> bool:
+    """True if two send params are the same message to the same number, however the number is written."""
+    return (_normalize_number(a.get("number") or "") == _normalize_number(b.get("number") or "")
+            and a.get("message") == b.get("message"))
+
+
+def _job_timeout_response(job: _Job):
+    if job.expired:
+        return jsonify(error=job.error, job_id=job.id), 504
+    error = "Timed out waiting for Viber (job still %s)" % job.status
+    if job.kind == "send":
+        # The job keeps running: a plain retry would queue a second send
+        error += "; the message may still be sent: poll status_url (or retry with the same Idempotency-Key)"
+    return jsonify(error=error, job_id=job.id, status_url="/jobs/%s" % job.id), 504
 
 
 @app.route("/health", methods=["GET"])
@@ -847,11 +4254,36 @@ def health():
         viber_path=VIBER_EXE,
         viber_exists=os.path.isfile(VIBER_EXE),
         pywinauto=HAS_PYWINAUTO,
-        ocr=_has_gpt_ocr(),
-        ocr_backend="gpt" if _has_gpt_ocr() else False,
+        ocr=_has_any_ocr(),
+        ocr_backend=(_available_ocr_backends() or [False])[0],
+        ocr_chain=_available_ocr_backends(),
+        cache=_lookup_cache.stats(),
+        session=_viber_session.stats(),
+        queue=_worker.queue_stats(),
+        campaigns=_campaigns.stats(),
+        uia_name=_uia_name_reader.stats(),
+        name_fix=_name_normalizer.stats(),
+        capture=[b.stats() for b in _driver.capture_backends],
+        driver=_driver.stats(),
+        images=_image_store.stats(),
+        log_dropped=_DroppingQueueHandler.dropped,
     )
 
 
+@app.route("/usage", methods=["GET"])
+def usage():
+    """The calling API key's weight, limits and usage: requests in the last minute, OCR spend today, queued jobs."""
+    d = _tenants.stats(g.tenant)
+    d["queued"] = _worker.tenant_depths().get(g.tenant, 0)
+    return jsonify(d)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus text exposition: stage latency histograms, OpenAI tokens/cost, cache and queue state."""
+    return Response(_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/api", methods=["GET"])
 @app.route("/api/v1", methods=["GET"])
 def api_info():
@@ -864,8 +4296,17 @@ def api_info():
         openapi="%s/openapi.json" % base,
         endpoints={
             "health": {"method": "GET", "path": "/health", "description": "Service health and capabilities"},
-            "lookup": {"method": "POST", "path": "/check-number-base64", "description": "Look up a number and get contact name + panel image (base64)"},
+            "lookup": {"method": "POST", "path": "/check-number-base64", "description": "Look up a number and get contact name + panel image URL"},
             "send_message": {"method": "POST", "path": "/send-message", "description": "Send a message to a number via Viber"},
+            "batch_lookup": {"method": "POST", "path": "/check-numbers", "description": "Look up many numbers; streams one NDJSON line per number as it completes"},
+            "create_job": {"method": "POST", "path": "/jobs", "description": "Queue a lookup or send job; returns 202 with job_id"},
+            "create_campaign": {"method": "POST", "path": "/campaigns", "description": "Send a templated message to many numbers from a durable outbox"},
+            "get_campaign": {"method": "GET", "path": "/campaigns/{campaign_id}", "description": "Campaign progress (add ?recipients=1 for per-recipient status)"},
+            "get_job": {"method": "GET", "path": "/jobs/{job_id}", "description": "Job status and result"},
+            "image": {"method": "GET", "path": "/images/{image_id}", "description": "Captured image by content id (ETag, Range)"},
+            "traces": {"method": "GET", "path": "/debug/traces", "description": "Recent request traces with per-stage spans"},
+            "metrics": {"method": "GET", "path": "/metrics", "description": "Prometheus metrics (stage latencies, OpenAI tokens/cost, cache, queue)"},
+            "usage": {"method": "GET", "path": "/usage", "description": "The calling API key's weight, limits, requests and OCR spend today"},
         },
     )
 
@@ -890,25 +4331,148 @@ def _openapi_spec():
                     "operationId": "lookup",
                     "requestBody": {
                         "required": True,
-                        "content": {"application/json": {"schema": {"type": "object", "required": ["number"], "properties": {"number": {"type": "string", "description": "Phone number"}, "only_panel": {"type": "boolean", "default": True}}}}}},
+                        "content": {"application/json": {"schema": {"type": "object", "required": ["number"], "properties": {"number": {"type": "string", "description": "Phone number"}, "only_panel": {"type": "boolean", "default": True}, "cache": {"type": "string", "enum": ["bypass", "prefer", "only"], "default": "prefer"}, "ocr": {"type": "string", "description": "OCR backend chain, e.g. 'local,gpt'"}, "source": {"type": "string", "enum": ["auto", "uia", "ocr"], "description": "Where the name comes from: UIA tree, OCR, or UIA with OCR fallback"}, "image_format": {"type": "string", "enum": ["png", "webp", "jpeg"], "description": "Encoding of the returned images (default IMAGE_FORMAT)"}, "timings": {"type": "boolean", "default": False, "description": "Add trace_id and per-stage timings to the response"}, "inline_images": {"type": "boolean", "default": False, "description": "Also return the images as *_base64 (compatibility)"}, "priority": {"type": "string", "enum": ["interactive", "bulk"], "default": "interactive", "description": "Queue class; interactive jobs run before bulk ones"}, "deadline_ms": {"type": "number", "description": "Drop the job (504) if it has not reached Viber within this many ms"}}}}}},
                     "responses": {
-                        "200": {"description": "OK", "content": {"application/json": {"schema": {"type": "object", "properties": {"number": {}, "contact_name": {}, "panel_base64": {}, "panel_text": {}}}}}},
+                        "200": {"description": "OK", "content": {"application/json": {"schema": {"type": "object", "properties": {"number": {}, "contact_name": {}, "panel_url": {"type": "string", "description": "GET this path for the panel image"}, "panel_base64": {"description": "Only with inline_images"}, "panel_text": {}, "cached": {"type": "boolean"}, "ocr_backend": {"type": "string"}, "image_mime": {"type": "string", "description": "MIME type of the images"}}}}}},
                         "400": {"description": "Bad request", "content": {"application/json": {"schema": {"type": "object", "properties": {"error": {"type": "string"}}}}}},
+                        "429": {"description": "Queue for this priority class is full, or the API key is over its requests per minute; retry after the Retry-After header (seconds)"},
+                        "504": {"description": "Timed out waiting for Viber, or deadline_ms passed before the job started"},
                         "500": {"description": "Server error", "content": {"application/json": {"schema": {"type": "object", "properties": {"error": {"type": "string"}}}}}},
                     },
                 }
             },
+            "/check-numbers": {
+                "post": {
+                    "summary": "Batch lookup (NDJSON stream)",
+                    "operationId": "batchLookup",
+                    "requestBody": {
+                        "required": True,
+                        "content": {"application/json": {"schema": {"type": "object", "required": ["numbers"], "properties": {"numbers": {"type": "array", "items": {"type": "string"}}, "only_panel": {"type": "boolean"}, "cache": {"type": "string", "enum": ["bypass", "prefer", "only"]}}}}}},
+                    "responses": {
+                        "200": {"description": "One JSON object per line (lookup result or {number, error}), in completion order", "content": {"application/x-ndjson": {"schema": {"type": "string"}}}},
+                        "400": {"description": "Bad request"},
+                        "429": {"description": "Queue for this priority class is full, or the API key is over its requests per minute; retry after the Retry-After header (seconds)"},
+                    },
+                }
+            },
             "/send-message": {
                 "post": {
                     "summary": "Send message",
                     "operationId": "sendMessage",
+                    "parameters": [{"name": "Idempotency-Key", "in": "header", "required": False, "schema": {"type": "string"}, "description": "Same key again returns the first request's send instead of sending twice"}],
                     "requestBody": {
                         "required": True,
                         "content": {"application/json": {"schema": {"type": "object", "required": ["number", "message"], "properties": {"number": {"type": "string"}, "message": {"type": "string"}}}}}},
                     "responses": {
-                        "200": {"description": "OK", "content": {"application/json": {"schema": {"type": "object", "properties": {"ok": {"type": "boolean"}, "number": {"type": "string"}}}}}},
+                        "200": {"description": "OK", "content": {"application/json": {"schema": {"type": "object", "properties": {"ok": {"type": "boolean"}, "number": {"type": "string"}, "delivery": {"type": "string", "enum": ["listed", "input_cleared", "unconfirmed"], "description": "How the send was confirmed in Viber"}, "confirmed": {"type": "boolean", "description": "The message shows up in the conversation"}}}}}},
+                        "400": {"description": "Bad request"},
+                        "429": {"description": "Queue for this priority class is full, or the API key is over its requests per minute; retry after the Retry-After header (seconds)"},
+                        "409": {"description": "Idempotency-Key already used for another number or message"},
+                        "500": {"description": "Send failed. With \"delivery\": \"unknown\" Send may have been pressed: check the chat before retrying", "content": {"application/json": {"schema": {"type": "object", "properties": {"error": {"type": "string"}, "delivery": {"type": "string", "enum": ["unknown"]}}}}}},
+                        "504": {"description": "Timed out waiting for Viber; the job keeps running and the message may still be sent: poll status_url or retry with the same Idempotency-Key", "content": {"application/json": {"schema": {"type": "object", "properties": {"error": {"type": "string"}, "job_id": {"type": "string"}, "status_url": {"type": "string"}}}}}},
+                    },
+                }
+            },
+            "/jobs": {
+                "post": {
+                    "summary": "Queue a lookup or send job",
+                    "operationId": "createJob",
+                    "parameters": [{"name": "Idempotency-Key", "in": "header", "required": False, "schema": {"type": "string"}, "description": "Send jobs: same key again returns the existing job"}],
+                    "requestBody": {
+                        "required": True,
+                        "content": {"application/json": {"schema": {"type": "object", "required": ["number"], "properties": {"type": {"type": "string", "enum": ["lookup", "send"], "default": "lookup"}, "number": {"type": "string"}, "only_panel": {"type": "boolean"}, "message": {"type": "string"}, "cache": {"type": "string", "enum": ["bypass", "prefer", "only"]}}}}}},
+                    "responses": {
+                        "202": {"description": "Queued", "content": {"application/json": {"schema": {"type": "object", "properties": {"job_id": {"type": "string"}, "status": {"type": "string"}, "status_url": {"type": "string"}}}}}},
+                        "200": {"description": "Answered from the lookup cache (job already done)"},
                         "400": {"description": "Bad request"},
-                        "500": {"description": "Server error"},
+                        "404": {"description": "cache=only and the number is not cached"},
+                        "409": {"description": "Idempotency-Key already used for another send"},
+                        "429": {"description": "Queue for this priority class is full, or the API key is over its requests per minute; retry after the Retry-After header (seconds)"},
+                    },
+                }
+            },
+            "/metrics": {
+                "get": {
+                    "summary": "Prometheus metrics",
+                    "operationId": "metrics",
+                    "responses": {"200": {"description": "Prometheus text format", "content": {"text/plain": {}}}},
+                }
+            },
+            "/campaigns": {
+                "post": {
+                    "summary": "Create a send campaign",
+                    "operationId": "createCampaign",
+                    "parameters": [{"name": "Idempotency-Key", "in": "header", "required": False, "schema": {"type": "string"}, "description": "Same key again returns the existing campaign (200)"}],
+                    "requestBody": {
+                        "required": True,
+                        "content": {"application/json": {"schema": {"type": "object", "required": ["recipients"], "properties": {"name": {"type": "string"}, "message": {"type": "string", "description": "Template with {variable} fields"}, "templates": {"type": "object", "additionalProperties": {"type": "string"}}, "vars": {"type": "object", "description": "Default variables for every recipient"}, "recipients": {"type": "array", "items": {"oneOf": [{"type": "string"}, {"type": "object", "required": ["number"], "properties": {"number": {"type": "string"}, "vars": {"type": "object"}, "template": {"type": "string"}, "idempotency_key": {"type": "string"}}}]}}, "rate_per_minute": {"type": "number"}, "idempotency_key": {"type": "string"}}}}},
+                    },
+                    "responses": {
+                        "201": {"description": "Created; messages are sent in the background", "content": {"application/json": {"schema": {"type": "object", "properties": {"campaign_id": {"type": "string"}, "status": {"type": "string"}, "total": {"type": "integer"}, "counts": {"type": "object"}, "progress": {"type": "number"}, "status_url": {"type": "string"}}}}}},
+                        "200": {"description": "Idempotency key already used: the existing campaign"},
+                        "400": {"description": "Bad request (errors lists the first invalid recipients)"},
+                        "503": {"description": "Campaigns disabled (CAMPAIGN_DB=off)"},
+                    },
+                },
+                "get": {
+                    "summary": "The calling API key's campaigns",
+                    "operationId": "listCampaigns",
+                    "responses": {"200": {"description": "OK"}},
+                },
+            },
+            "/campaigns/{campaign_id}": {
+                "get": {
+                    "summary": "Campaign progress",
+                    "operationId": "getCampaign",
+                    "parameters": [
+                        {"name": "campaign_id", "in": "path", "required": True, "schema": {"type": "string"}},
+                        {"name": "recipients", "in": "query", "required": False, "schema": {"type": "boolean"}},
+                        {"name": "status", "in": "query", "required": False, "schema": {"type": "string", "enum": ["pending", "sending", "sent", "failed", "unknown", "skipped", "cancelled"]}},
+                        {"name": "offset", "in": "query", "required": False, "schema": {"type": "integer"}},
+                        {"name": "limit", "in": "query", "required": False, "schema": {"type": "integer", "maximum": 1000}},
+                    ],
+                    "responses": {"200": {"description": "OK"}, "404": {"description": "Unknown campaign"}},
+                }
+            },
+            "/campaigns/{campaign_id}/{action}": {
+                "post": {
+                    "summary": "Pause, resume or cancel a campaign",
+                    "operationId": "campaignAction",
+                    "parameters": [
+                        {"name": "campaign_id", "in": "path", "required": True, "schema": {"type": "string"}},
+                        {"name": "action", "in": "path", "required": True, "schema": {"type": "string", "enum": ["pause", "resume", "cancel"]}},
+                    ],
+                    "responses": {"200": {"description": "OK"}, "404": {"description": "Unknown campaign or action"}, "409": {"description": "Not possible in the campaign's state"}},
+                }
+            },
+            "/usage": {
+                "get": {
+                    "summary": "Limits and usage of the calling API key",
+                    "operationId": "usage",
+                    "responses": {"200": {"description": "OK", "content": {"application/json": {"schema": {"type": "object", "properties": {"api_key": {"type": "string"}, "weight": {"type": "number"}, "rpm": {"type": "integer", "nullable": True}, "requests_last_minute": {"type": "integer", "nullable": True}, "daily_usd": {"type": "number", "nullable": True}, "spent_today_usd": {"type": "number"}, "queued": {"type": "integer"}}}}}}},
+                }
+            },
+            "/images/{image_id}": {
+                "get": {
+                    "summary": "Captured image by content id",
+                    "operationId": "getImage",
+                    "parameters": [{"name": "image_id", "in": "path", "required": True, "schema": {"type": "string"}}],
+                    "responses": {
+                        "200": {"description": "Image bytes (strong ETag, immutable Cache-Control)", "content": {"image/png": {}, "image/webp": {}, "image/jpeg": {}}},
+                        "206": {"description": "Partial content (Range request)"},
+                        "304": {"description": "Not modified (If-None-Match)"},
+                        "404": {"description": "Unknown or evicted image"},
+                    },
+                }
+            },
+            "/jobs/{job_id}": {
+                "get": {
+                    "summary": "Job status and result",
+                    "operationId": "getJob",
+                    "parameters": [{"name": "job_id", "in": "path", "required": True, "schema": {"type": "string"}}],
+                    "responses": {
+                        "200": {"description": "OK", "content": {"application/json": {"schema": {"type": "object", "properties": {"job_id": {"type": "string"}, "status": {"type": "string", "enum": ["queued", "running", "ocr", "done", "error"]}, "result": {"type": "object"}, "error": {"type": "string"}}}}}},
+                        "404": {"description": "Unknown job"},
                     },
                 }
             },
@@ -962,29 +4526,42 @@ def check_number():
         return jsonify(error="Missing 'number' in JSON body"), 400
     only_panel = data.get("only_panel") is True
     include_photo = data.get("include_photo") is True
-
-    window_png, panel_png, err = do_viber_search_and_screenshot(number, only_panel=only_panel)
+    image_format, err = _image_format_param(data)
+    if err:
+        return jsonify(error=err), 400
+    priority, deadline, err = _admission_params(data, "interactive")
     if err:
-        return jsonify(error=err), 500
+        return jsonify(error=err), 400
+
+    job = _run_job_sync(
+        "capture", {"number": number, "only_panel": only_panel, "image_format": image_format}, priority, deadline
+    )
+    if not job.done.is_set() or job.expired:
+        return _job_timeout_response(job)
+    if job.error:
+        return jsonify(error=job.error), 500
+    window_png, panel_png = job.result
+    mime = _image_mime(panel_png if panel_png is not None else window_png)
+    ext = mime.split("/")[1]
 
     if only_panel and panel_png is not None:
         return send_file(
             io.BytesIO(panel_png),
-            mimetype="image/png",
+            mimetype=mime,
             as_attachment=True,
-            download_name="contact_panel.png",
+            download_name="contact_panel.%s" % ext,
         )
 
     if include_photo and panel_png is not None:
         boundary = uuid.uuid4().hex.encode()
         body = (
             b"--" + boundary + b"\r\n"
-            b'Content-Disposition: attachment; filename="viber_window.png"\r\n'
-            b"Content-Type: image/png\r\n\r\n"
+            + ('Content-Disposition: attachment; filename="viber_window.%s"\r\n' % ext).encode()
+            + ("Content-Type: %s\r\n\r\n" % mime).encode()
             + window_png + b"\r\n"
             b"--" + boundary + b"\r\n"
-            b'Content-Disposition: attachment; filename="contact_panel.png"\r\n'
-            b"Content-Type: image/png\r\n\r\n"
+            + ('Content-Disposition: attachment; filename="contact_panel.%s"\r\n' % ext).encode()
+            + ("Content-Type: %s\r\n\r\n" % mime).encode()
             + panel_png + b"\r\n"
             b"--" + boundary + b"--\r\n"
         )
@@ -995,9 +4572,9 @@ def check_number():
 
     return send_file(
         io.BytesIO(window_png),
-        mimetype="image/png",
+        mimetype=mime,
         as_attachment=True,
-        download_name="viber_screenshot.png",
+        download_name="viber_screenshot.%s" % ext,
     )
 
 
@@ -1008,46 +4585,131 @@ def check_number_base64():
     With only_panel: true → panel_base64 only. Otherwise screenshot_base64 and optionally contact_panel_base64.
     """
     request_start = time.monotonic()
-    print("[viber-agent] POST /check-number-base64 received", flush=True)
+    alog.info("POST /check-number-base64 received")
     data = request.get_json(silent=True) or {}
     number = (data.get("number") or "").strip()
     if not number:
         return jsonify(error="Missing 'number' in JSON body"), 400
     only_panel = data.get("only_panel") is True
+    cache_mode = _cache_mode(data)
+    if cache_mode is None:
+        return jsonify(error="'cache' must be one of: %s" % ", ".join(_CACHE_MODES)), 400
 
-    window_png, panel_png, err = do_viber_search_and_screenshot(number, only_panel=only_panel)
+    params, err = _lookup_params(data, number)
     if err:
-        return jsonify(error=err), 500
+        return jsonify(error=err), 400
+    priority, deadline, err = _admission_params(data, "interactive")
+    if err:
+        return jsonify(error=err), 400
 
-    out = {"number": number}
-    # Run OCR on the image that contains the contact (panel if available, else full window)
-    ocr_image_bytes = panel_png if panel_png is not None else window_png
-    if ocr_image_bytes:
-        log.debug("running on %s (%d bytes)", "panel" if panel_png is not None else "window", len(ocr_image_bytes))
-    t0 = time.monotonic()
-    if ocr_image_bytes and not _has_gpt_ocr():
-        print("[viber-agent] OCR skipped: OPENAI_API_KEY not set (add to .env on the VPS)", flush=True)
-    panel_text, contact_name = ocr_image_gpt(ocr_image_bytes) if ocr_image_bytes else ("", "")
-    if ocr_image_bytes:
-        _log_step("OCR total (Vision + fix name)", time.monotonic() - t0)
-    _log_step("REQUEST TOTAL", time.monotonic() - request_start)
-    print("[viber-agent] --- request done ---", flush=True)
+    cached = _cached_lookup(number, only_panel, cache_mode, params["inline"])
+    if cached is not None:
+        _log_step("REQUEST TOTAL", time.monotonic() - request_start, "cache", backend="cache")
+        return jsonify(cached)
+    if cache_mode == "only":
+        return jsonify(error="Number not in cache", number=number), 404
 
-    if only_panel and panel_png is not None:
-        out["panel_base64"] = base64.b64encode(panel_png).decode("ascii")
-    else:
-        out["screenshot_base64"] = base64.b64encode(window_png).decode("ascii")
-        if panel_png is not None:
-            out["contact_panel_base64"] = base64.b64encode(panel_png).decode("ascii")
+    job = _run_job_sync("lookup", params, priority, deadline)
+    if not job.done.is_set() or job.expired:
+        return _job_timeout_response(job)
+    _log_step(
+        "REQUEST TOTAL", time.monotonic() - request_start,
+        outcome="error" if job.error else "ok",
+    )
+    alog.info("--- request done ---")
+    if job.error:
+        return jsonify(error=job.error), 500
+    # The job may be shared with a request that wrote the number differently
+    result = dict(job.result, number=number)
+    if data.get("timings") is True:
+        return jsonify(dict(result, trace_id=g.trace.id, timings=g.trace.timings()))
+    return jsonify(result)
 
-    # Always include captured text so the UI can show it
-    if panel_text:
-        out["panel_text"] = panel_text
-    else:
-        out["panel_text"] = "(no text detected)" if _has_gpt_ocr() else "(set OPENAI_API_KEY for OCR)"
-    if contact_name:
-        out["contact_name"] = contact_name
-    return jsonify(out)
+
+@app.route("/check-numbers", methods=["POST"])
+def check_numbers():
+    """
+    Body (JSON): { "numbers": ["0877...", "+359..."], "only_panel": true, "cache": "prefer" }.
+    Batch lookup: numbers are deduplicated, queued on the desktop worker in order, and streamed back as
+    NDJSON (one /check-number-base64-shaped JSON object per line) as soon as each number finishes.
+    A failed number yields {"number": ..., "error": ...} and the batch continues; numbers still outstanding after
+    BATCH_TIMEOUT yield {"number": ..., "error": "timeout", "job_id": ...} and end the stream.
+    """
+    data = request.get_json(silent=True) or {}
+    numbers = data.get("numbers")
+    if not isinstance(numbers, list) or not numbers:
+        return jsonify(error="Missing 'numbers' (non-empty list) in JSON body"), 400
+    only_panel = data.get("only_panel") is True
+    cache_mode = _cache_mode(data)
+    if cache_mode is None:
+        return jsonify(error="'cache' must be one of: %s" % ", ".join(_CACHE_MODES)), 400
+    batch_params, err = _lookup_params(data, "")
+    if err:
+        return jsonify(error=err), 400
+    priority, deadline, err = _admission_params(data, "bulk")
+    if err:
+        return jsonify(error=err), 400
+
+    unique: OrderedDict[str, str] = OrderedDict()
+    invalid = []
+    for raw in numbers:
+        number = str(raw or "").strip()
+        key = _normalize_number(number)
+        if not key:
+            invalid.append(number)
+            continue
+        unique.setdefault(key, number)
+    if len(unique) > BATCH_MAX_NUMBERS:
+        return jsonify(error="Too many numbers (%d unique, max %d)" % (len(unique), BATCH_MAX_NUMBERS)), 400
+    alog.info("POST /check-numbers: %d numbers (%d unique)", len(numbers), len(unique))
+
+    finished: queue.Queue = queue.Queue()
+    pending = 0
+    submitted: dict[str, _Job] = {}
+    immediate = [{"number": n, "error": "No valid phone number provided"} for n in invalid]
+    misses = []
+    for number in unique.values():
+        cached = _cached_lookup(number, only_panel, cache_mode, batch_params["inline"])
+        if cached is not None:
+            immediate.append(cached)
+        elif cache_mode == "only":
+            immediate.append({"number": number, "error": "Number not in cache"})
+        else:
+            misses.append(number)
+    # Whole batch or nothing: 429 (see _queue_full_response) if the misses don't fit into the queue
+    _worker.admit(priority, len(misses))
+    for number in misses:
+        params, _ = _lookup_params(data, number)
+        try:
+            # A coalesced job may belong to another caller who wrote the number differently: keep ours with it
+            job = _worker.submit("lookup", params, priority, deadline)
+            submitted[number] = job
+            job.add_done_callback(lambda job, number=number: finished.put((number, job)))
+            pending += 1
+        except _QueueFull as e:
+            immediate.append({"number": number, "error": str(e)})
+
+    batch_deadline = time.monotonic() + BATCH_TIMEOUT
+
+    def _stream():
+        for item in immediate:
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+        for _ in range(pending):
+            try:
+                number, job = finished.get(timeout=max(0.0, batch_deadline - time.monotonic()))
+            except queue.Empty:
+                # Jobs keep running; their results stay on GET /jobs/<id> for a while
+                for number, job in submitted.items():
+                    yield json.dumps({"number": number, "error": "timeout", "job_id": job.id}) + "\n"
+                return
+            submitted.pop(number, None)
+            if job.error:
+                item = {"number": number, "error": job.error}
+            else:
+                item = dict(job.result, number=number)
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+
+    return Response(_stream(), mimetype="application/x-ndjson")
 
 
 @app.route("/send-message", methods=["POST"])
@@ -1055,6 +4717,8 @@ def send_message():
     """
     Body (JSON): { "number": "+123...", "message": "Hello" }.
     Opens Viber chat with the number, types the message, sends (Enter), then closes Viber.
+    With an Idempotency-Key header (or "idempotency_key"), a retry with the same key waits for / returns the first
+    request's send instead of sending again (see _DesktopWorker.submit).
     """
     data = request.get_json(silent=True) or {}
     number = (data.get("number") or "").strip()
@@ -1064,10 +4728,283 @@ def send_message():
     if not message:
         return jsonify(error="Missing 'message' in JSON body"), 400
 
-    err = do_viber_send_message(number, message)
+    priority, deadline, err = _admission_params(data, "interactive")
+    if err:
+        return jsonify(error=err), 400
+
+    params = {"number": number, "message": message}
+    job = _worker.submit("send", params, priority, deadline, _idempotency_key(data))
+    if not _same_send(job.params, params):
+        return jsonify(error="Idempotency-Key was already used for another message", job_id=job.id), 409
+    job.done.wait(SYNC_JOB_TIMEOUT)
+    if not job.done.is_set() or job.expired:
+        return _job_timeout_response(job)
+    if job.error:
+        if job.result:
+            # Send may have been pressed: the message may be in the chat, so a blind retry could send it twice
+            return jsonify(dict(job.result, error=job.error)), 500
+        return jsonify(error=job.error), 500
+    return jsonify(job.result)
+
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """
+    Body (JSON): { "type": "lookup", "number": "...", "only_panel": true } or { "type": "send", "number": "...", "message": "..." }.
+    Queues the job for the desktop worker and returns 202 immediately; poll GET /jobs/<job_id> for the result.
+    Queued as "bulk" unless "priority": "interactive"; 429 + Retry-After when that queue is full.
+    """
+    data = request.get_json(silent=True) or {}
+    kind = (data.get("type") or "lookup").strip().lower()
+    if kind not in _PUBLIC_JOB_KINDS:
+        return jsonify(error="'type' must be one of: %s" % ", ".join(_PUBLIC_JOB_KINDS)), 400
+    number = (data.get("number") or "").strip()
+    if not number:
+        return jsonify(error="Missing 'number' in JSON body"), 400
+    priority, deadline, err = _admission_params(data, "bulk")
+    if err:
+        return jsonify(error=err), 400
+    if kind == "send":
+        message = (data.get("message") or "").strip()
+        if not message:
+            return jsonify(error="Missing 'message' in JSON body"), 400
+        params = {"number": number, "message": message}
+    else:
+        params, err = _lookup_params(data, number)
+        if err:
+            return jsonify(error=err), 400
+        cache_mode = _cache_mode(data)
+        if cache_mode is None:
+            return jsonify(error="'cache' must be one of: %s" % ", ".join(_CACHE_MODES)), 400
+        cached = _cached_lookup(number, params["only_panel"], cache_mode, params["inline"])
+        if cached is not None:
+            job = _worker.record_done(kind, params, cached)
+            resp = jsonify(job_id=job.id, status=job.status, status_url="/jobs/%s" % job.id, result=cached)
+            resp.status_code = 200
+            resp.headers["Location"] = "/jobs/%s" % job.id
+            return resp
+        if cache_mode == "only":
+            return jsonify(error="Number not in cache", number=number), 404
+
+    job = _worker.submit(kind, params, priority, deadline, _idempotency_key(data) if kind == "send" else None)
+    if kind == "send" and not _same_send(job.params, params):
+        return jsonify(error="Idempotency-Key was already used for another message", job_id=job.id), 409
+    resp = jsonify(
+        job_id=job.id, status=job.status, status_url="/jobs/%s" % job.id,
+        priority=job.priority, queue_depth=_worker.queue_depth(job.priority),
+    )
+    resp.status_code = 202
+    resp.headers["Location"] = "/jobs/%s" % job.id
+    return resp
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """
+    Job status: queued | running | ocr | done | error. 'result' has the same shape as the sync endpoint's JSON.
+    Only the API key that submitted the job (or shares it through coalescing) can see it; others get 404.
+    """
+    job = _worker.get(job_id)
+    if job is None or job.kind not in _PUBLIC_JOB_KINDS or g.tenant not in job.tenants:
+        return jsonify(error="Unknown job_id (expired or never created)"), 404
+    d = job.to_dict()
+    if job.tenant != g.tenant:
+        # Shared through coalescing: the trace is the submitter's request
+        d["api_key"] = g.tenant
+        d.pop("trace_id", None)
+    elif request.args.get("timings") in ("1", "true") and job.trace is not None:
+        d["timings"] = job.trace.timings()
+    return jsonify(d)
+
+
+def _campaign_messages(data: dict) -> tuple[list[tuple[str, str, str | None]] | None, list[dict] | None]:
+    """
+    (number, rendered message, recipient idempotency key) per recipient of a POST /campaigns body, or
+    (None, errors) with the first problems as [{"index", "error"}]. A recipient is a number or
+    {"number", "vars", "template", "idempotency_key"}; "vars" at the top level are defaults for all of them.
+    """
+    templates = data.get("templates") or {}
+    if not isinstance(templates, dict) or not all(isinstance(t, str) for t in templates.values()):
+        return None, [{"error": "'templates' must be an object of name -> template string"}]
+    if isinstance(data.get("message"), str) and data["message"].strip():
+        templates = dict(templates, default=data["message"])
+    if not templates:
+        return None, [{"error": "Missing 'message' (or 'templates') in JSON body"}]
+    defaults = data.get("vars") or {}
+    recipients = data.get("recipients")
+    if not isinstance(recipients, list) or not recipients:
+        return None, [{"error": "Missing 'recipients' (non-empty list) in JSON body"}]
+    if len(recipients) > CAMPAIGN_MAX_RECIPIENTS:
+        return None, [{"error": "Too many recipients (%d, max %d)" % (len(recipients), CAMPAIGN_MAX_RECIPIENTS)}]
+    if not isinstance(defaults, dict):
+        return None, [{"error": "'vars' must be an object"}]
+    rows, errors = [], []
+    for i, r in enumerate(recipients):
+        r = r if isinstance(r, dict) else {"number": r}
+        number = str(r.get("number") or "").strip()
+        variables = r.get("vars") or {}
+        template_name = str(r.get("template") or ("default" if "default" in templates else next(iter(templates))))
+        key = str(r.get("idempotency_key") or "").strip() or None
+        if not _normalize_number(number):
+            err = "No valid phone number provided"
+        elif not isinstance(variables, dict):
+            err = "'vars' must be an object"
+        elif template_name not in templates:
+            err = "Unknown template %r" % template_name
+        else:
+            variables = {k: "" if v is None else str(v) for k, v in dict(defaults, **variables).items()}
+            message, err = _render_message(templates[template_name], variables)
+            if not err and not message.strip():
+                err = "Message is empty"
+        if err:
+            errors.append({"index": i, "number": number, "error": err})
+            if len(errors) >= 20:
+                break
+            continue
+        rows.append((number, message.strip(), key))
+    return (None, errors) if errors else (rows, None)
+
+
+@app.route("/campaigns", methods=["POST"])
+def create_campaign():
+    """
+    Body (JSON): { "name": "...", "message": "Hi {name}", "recipients": ["0877...", {"number": "...", "vars": {...}}],
+    "rate_per_minute": 6 } (or "templates" + per-recipient "template"). Stores every rendered message in the outbox
+    and returns 201; the messages are sent in the background. The same "idempotency_key" (or Idempotency-Key
+    header) returns the existing campaign with 200 instead of creating a second one.
+    """
+    if not _campaigns.enabled:
+        return jsonify(error="Campaigns are disabled (CAMPAIGN_DB)"), 503
+    data = request.get_json(silent=True) or {}
+    try:
+        rate = float(data.get("rate_per_minute") or CAMPAIGN_RATE_PER_MIN)
+    except (TypeError, ValueError):
+        rate = -1
+    if rate <= 0:
+        return jsonify(error="'rate_per_minute' must be a positive number"), 400
+    idempotency_key = _idempotency_key(data)
+    rows, errors = _campaign_messages(data)
+    if errors:
+        return jsonify(error=errors[0]["error"], errors=errors), 400
+    campaign, created = _campaigns.create(g.tenant, idempotency_key, str(data.get("name") or ""), rate, rows)
+    resp = jsonify(campaign)
+    resp.status_code = 201 if created else 200
+    resp.headers["Location"] = campaign["status_url"]
+    return resp
+
+
+@app.route("/campaigns", methods=["GET"])
+def list_campaigns():
+    """The calling API key's campaigns, newest first (summaries without recipients)."""
+    if not _campaigns.enabled:
+        return jsonify(error="Campaigns are disabled (CAMPAIGN_DB)"), 503
+    return jsonify(campaigns=_campaigns.for_tenant(g.tenant))
+
+
+@app.route("/campaigns/<campaign_id>", methods=["GET"])
+def get_campaign(campaign_id):
+    """
+    Campaign status: counts per recipient status and progress. ?recipients=1 adds per-recipient progress
+    (paged with offset / limit, filter with ?status=failed).
+    """
+    if not _campaigns.enabled:
+        return jsonify(error="Campaigns are disabled (CAMPAIGN_DB)"), 503
+    campaign = _campaigns.get(campaign_id, g.tenant)
+    if campaign is None:
+        return jsonify(error="Unknown campaign_id"), 404
+    if request.args.get("recipients") in ("1", "true"):
+        try:
+            offset = max(0, int(request.args.get("offset") or 0))
+            limit = max(1, min(int(request.args.get("limit") or 100), 1000))
+        except ValueError:
+            return jsonify(error="'offset' and 'limit' must be numbers"), 400
+        status = request.args.get("status") or None
+        campaign["recipients"] = _campaigns.recipients(campaign_id, status, offset, limit)
+        campaign["offset"], campaign["limit"] = offset, limit
+    return jsonify(campaign)
+
+
+@app.route("/campaigns/<campaign_id>/<action>", methods=["POST"])
+def campaign_action(campaign_id, action):
+    """pause | resume | cancel (unsent messages of a cancelled campaign are never sent)."""
+    if not _campaigns.enabled:
+        return jsonify(error="Campaigns are disabled (CAMPAIGN_DB)"), 503
+    if action not in _CAMPAIGN_ACTIONS:
+        return jsonify(error="Action must be one of: %s" % ", ".join(_CAMPAIGN_ACTIONS)), 404
+    campaign, err = _campaigns.act(campaign_id, g.tenant, action)
     if err:
-        return jsonify(error=err), 500
-    return jsonify(ok=True, number=number)
+        return jsonify(error=err), 409
+    if campaign is None:
+        return jsonify(error="Unknown campaign_id"), 404
+    return jsonify(campaign)
+
+
+@app.route("/debug/last-captures", methods=["GET"])
+def debug_last_captures():
+    """The caller's API key's captures among the last LAST_CAPTURES_MAX, newest first, with /images URLs."""
+    out = []
+    for entry in reversed(list(_last_captures)):
+        if entry["tenant"] != g.tenant:
+            continue
+        item = {"number": entry["number"], "time": entry["time"], "trace_id": entry["trace_id"]}
+        for field in ("panel", "window"):
+            data = entry[field]
+            if data is not None:
+                item[field + "_url"] = "/images/%s" % _image_store.put(data)
+                item[field + "_bytes"] = len(data)
+        out.append(item)
+    return jsonify(captures=out, max=_last_captures.maxlen)
+
+
+@app.route("/debug/traces", methods=["GET"])
+def debug_traces():
+    """
+    Recent request traces of the caller's API key, newest first. Query: trace_id (one trace), min_ms (only slower
+    requests), path (substring of "METHOD /path"), limit (default 50).
+    """
+    with _traces_lock:
+        traces = [t for t in _traces if t.tenant == g.tenant]
+    trace_id = request.args.get("trace_id", "").strip()
+    if trace_id:
+        for t in traces:
+            if t.id == trace_id:
+                return jsonify(t.to_dict())
+        return jsonify(error="Unknown trace_id (expired or never recorded)"), 404
+    try:
+        min_ms = float(request.args.get("min_ms") or 0)
+        limit = max(1, min(int(request.args.get("limit") or 50), len(traces) or 1))
+    except ValueError:
+        return jsonify(error="'min_ms' and 'limit' must be numbers"), 400
+    path = request.args.get("path", "")
+    out = [
+        t.to_dict() for t in reversed(traces)
+        if (t.duration_ms or 0) >= min_ms and path in t.name
+    ]
+    return jsonify(traces=out[:limit], kept=len(traces), max=_traces.maxlen)
+
+
+@app.route("/images/<image_id>", methods=["GET"])
+def get_image(image_id):
+    """
+    A captured image by content id (from *_url in lookup results). Immutable, so it carries a strong ETag and a
+    long Cache-Control; conditional (If-None-Match → 304) and Range requests are supported.
+    """
+    data = _image_store.get(image_id)
+    if data is None:
+        return jsonify(error="Unknown image (expired or never created)"), 404
+    mime = _image_mime(data)
+    resp = send_file(
+        io.BytesIO(data),
+        mimetype=mime,
+        download_name="%s.%s" % (image_id, mime.split("/")[1]),
+        conditional=True,
+        etag=image_id,
+        max_age=IMAGE_CACHE_MAX_AGE,
+    )
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    resp.cache_control.immutable = True
+    return resp
 
 
 if __name__ == "__main__":
@@ -1076,12 +5013,17 @@ if __name__ == "__main__":
     parser.add_argument("--host", default="0.0.0.0", help="Listen on this host (0.0.0.0 = all interfaces)")
     parser.add_argument("--port", type=int, default=5050, help="Port to listen on")
     parser.add_argument("--dev", action="store_true", help="Use Flask dev server (default: use Waitress if installed)")
+    parser.add_argument(
+        "--threads", type=int, default=int(os.environ.get("SERVER_THREADS", "6")),
+        help="Waitress worker threads (requests handled at once; desktop jobs still run one at a time)",
+    )
     args = parser.parse_args()
+    _campaigns.start()  # resume campaigns left active by the last run
     try:
         if args.dev:
             raise ImportError("use Flask")
         import waitress
-        print("[viber-agent] Using Waitress WSGI server", flush=True)
-        waitress.serve(app, host=args.host, port=args.port, threads=6)
+        alog.info("Using Waitress WSGI server")
+        waitress.serve(app, host=args.host, port=args.port, threads=args.threads)
     except ImportError:
         app.run(host=args.host, port=args.port, debug=False, threaded=True)
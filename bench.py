@@ -0,0 +1,255 @@
+"""
+Offline benchmark: runs the agent in-process on the simulated desktop driver (VIBER_DRIVER=sim) against the
+fake OpenAI server (fake_openai.py) and reports end-to-end and per-stage latency and throughput as JSON.
+Runs anywhere (Linux, CI); no Viber, Windows or API key needed.
+Usage:
+  python bench.py [--requests 20] [--concurrency 4] [--scenarios lookup,jobs,batch,cached] [--out bench.json]
+  python bench.py --window-delay 1.0 --panel-delay 0.6 --failure-rate 0.05 --openai-latency 0.8
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fake_openai
+
+SCENARIOS = ("lookup", "jobs", "batch", "cached")
+
+
+def _percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = (len(s) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+def _summary(values: list[float]) -> dict:
+    if not values:
+        return {"n": 0}
+    return {
+        "n": len(values),
+        "p50": round(_percentile(values, 50), 1),
+        "p95": round(_percentile(values, 95), 1),
+        "p99": round(_percentile(values, 99), 1),
+        "mean": round(sum(values) / len(values), 1),
+        "max": round(max(values), 1),
+    }
+
+
+class _Run:
+    """Latencies, errors and spans collected by one scenario."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: list[float] = []
+        self.errors: dict[str, int] = {}
+        self.stages: dict[str, list[float]] = {}
+
+    def ok(self, ms: float, spans: list | None = None):
+        with self.lock:
+            self.latencies.append(ms)
+            for span in spans or []:
+                self.stages.setdefault(span["name"], []).append(span["dur_ms"])
+
+    def error(self, msg: str):
+        with self.lock:
+            key = str(msg)[:80]
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def report(self, n: int, wall: float) -> dict:
+        return {
+            "n": n,
+            "ok": len(self.latencies),
+            "errors": sum(self.errors.values()),
+            "error_kinds": self.errors,
+            "wall_s": round(wall, 3),
+            "throughput_per_s": round(len(self.latencies) / wall, 3) if wall > 0 else 0.0,
+            "latency_ms": _summary(self.latencies),
+            "stages_ms": {name: _summary(v) for name, v in sorted(self.stages.items())},
+        }
+
+
+def _numbers(n: int, offset: int) -> list[str]:
+    return ["0877%06d" % (offset + i) for i in range(n)]
+
+
+def _bench_lookup(client_factory, numbers: list[str], concurrency: int, cache: str) -> _Run:
+    run = _Run()
+
+    def one(number):
+        client = client_factory()
+        t0 = time.perf_counter()
+        r = client.post(
+            "/check-number-base64",
+            json={"number": number, "only_panel": True, "cache": cache, "timings": True},
+        )
+        ms = (time.perf_counter() - t0) * 1000
+        data = r.get_json(silent=True) or {}
+        if r.status_code != 200:
+            run.error(data.get("error") or "HTTP %d" % r.status_code)
+        else:
+            run.ok(ms, data.get("timings"))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, numbers))
+    return run
+
+
+def _bench_jobs(client_factory, numbers: list[str], poll: float) -> _Run:
+    run = _Run()
+    client = client_factory()
+    pending = {}
+    for number in numbers:
+        r = client.post("/jobs", json={"type": "lookup", "number": number, "only_panel": True, "cache": "bypass"})
+        data = r.get_json(silent=True) or {}
+        if r.status_code not in (200, 202):
+            run.error(data.get("error") or "HTTP %d" % r.status_code)
+            continue
+        pending[data["job_id"]] = time.perf_counter()
+    while pending:
+        time.sleep(poll)
+        for job_id, t0 in list(pending.items()):
+            data = client.get("/jobs/%s?timings=1" % job_id).get_json(silent=True) or {}
+            if data.get("status") == "done":
+                run.ok((time.perf_counter() - t0) * 1000, data.get("timings"))
+            elif data.get("status") == "error" or "status" not in data:
+                run.error(data.get("error") or "unknown job")
+            else:
+                continue
+            del pending[job_id]
+    return run
+
+
+def _bench_batch(client_factory, numbers: list[str]) -> _Run:
+    """Latency per number = time from sending the batch until its line arrived."""
+    run = _Run()
+    t0 = time.perf_counter()
+    r = client_factory().post("/check-numbers", json={"numbers": numbers, "only_panel": True, "cache": "bypass"},
+                              buffered=False)
+    for line in r.response:
+        for part in line.decode("utf-8").splitlines():
+            if not part.strip():
+                continue
+            item = json.loads(part)
+            if item.get("error"):
+                run.error(item["error"])
+            else:
+                run.ok((time.perf_counter() - t0) * 1000)
+    return run
+
+
+def add_sim_arguments(parser: argparse.ArgumentParser):
+    """Options of the simulated desktop (SIM_*) and the fake OpenAI server; shared with loadtest.py."""
+    parser.add_argument("--window-delay", type=float, default=0.8, help="SIM_WINDOW_DELAY")
+    parser.add_argument("--panel-delay", type=float, default=0.4, help="SIM_PANEL_DELAY")
+    parser.add_argument("--send-delay", type=float, default=0.3, help="SIM_SEND_DELAY")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="SIM_FAILURE_RATE")
+    parser.add_argument("--uia-name", default="", help="SIM_UIA_NAME (name via UIA, OCR skipped)")
+    parser.add_argument("--openai-latency", type=float, default=0.6)
+    parser.add_argument("--openai-jitter", type=float, default=0.2)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--session", action="store_true", help="keep the window open between jobs (VIBER_SESSION=1)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="show agent logs")
+
+
+def start_sim_agent(args):
+    """
+    Start the fake OpenAI server and import agent configured for the simulated driver.
+    Returns (agent module, fake server); exits if the simulated driver is not active.
+    """
+    server = fake_openai.serve(
+        0, args.openai_latency, args.openai_jitter, args.openai_error_rate, seed=args.seed
+    )
+    os.environ.update({
+        "VIBER_DRIVER": "sim",
+        "SIM_WINDOW_DELAY": str(args.window_delay),
+        "SIM_PANEL_DELAY": str(args.panel_delay),
+        "SIM_SEND_DELAY": str(args.send_delay),
+        "SIM_FAILURE_RATE": str(args.failure_rate),
+        "SIM_UIA_NAME": args.uia_name,
+        "SIM_SEED": str(args.seed),
+        "VIBER_SESSION": "1" if args.session else "0",
+        "LOOKUP_CACHE_DB": "off",
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": "http://127.0.0.1:%d/v1" % server.server_address[1],
+        "OCR_CHAIN": "gpt",
+        "SYNC_JOB_TIMEOUT": "3600",
+        "AGENT_API_KEY": "",
+        "AGENT_API_KEYS": "",
+        "CAMPAIGN_DB": "off",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # agent logs go to stderr so stdout is just the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        import agent
+    if not args.verbose:
+        agent.alog.setLevel("WARNING")
+        agent.log.setLevel("WARNING")
+    err = agent._driver.check("lookup")
+    if err or agent._driver.name != "sim":
+        print(err or "simulated driver not active (a .env VIBER_DRIVER?)", file=sys.stderr)
+        sys.exit(1)
+    return agent, server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the agent on the simulated desktop driver")
+    parser.add_argument("--requests", type=int, default=20, help="lookups per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="parallel clients for the lookup scenarios")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    add_sim_arguments(parser)
+    parser.add_argument("--out", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenario(s): %s (choose from %s)" % (", ".join(unknown), ", ".join(SCENARIOS)))
+
+    agent, server = start_sim_agent(args)
+    client_factory = agent.app.test_client
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "verbose")},
+        "scenarios": {},
+    }
+    offset = 0
+    for name in scenarios:
+        numbers = _numbers(args.requests, offset)
+        offset += args.requests
+        t0 = time.perf_counter()
+        if name == "lookup":
+            run = _bench_lookup(client_factory, numbers, args.concurrency, "bypass")
+        elif name == "jobs":
+            run = _bench_jobs(client_factory, numbers, poll=0.05)
+        elif name == "batch":
+            run = _bench_batch(client_factory, numbers)
+        else:
+            # first pass fills the cache, the measured pass is all hits
+            warm = _numbers(args.requests, 0) if "lookup" in scenarios else numbers
+            if "lookup" not in scenarios:
+                _bench_lookup(client_factory, warm, args.concurrency, "bypass")
+            t0 = time.perf_counter()
+            run = _bench_lookup(client_factory, warm, args.concurrency, "prefer")
+        report["scenarios"][name] = run.report(len(numbers), time.perf_counter() - t0)
+    report["openai"] = {"requests": server.state.requests, "errors": server.state.errors}
+    report["driver"] = agent._driver.stats()
+    server.shutdown()
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Local stand-in for the OpenAI Chat Completions endpoint, for running the agent and bench.py without a key or network.
+Vision requests (with an image) get a panel-style answer: name, "-", "Viber Out"; text-only requests (the name-fix
+call) get just the name. Latency, jitter and a 429/503 error rate are configurable.
+Usage:
+  python fake_openai.py [--port 8765] [--latency 0.6] [--jitter 0.2] [--error-rate 0.05] [--name "Иван Петров"]
+Then run the agent with:
+  set OPENAI_BASE_URL=http://127.0.0.1:8765/v1
+  set OPENAI_API_KEY=sk-fake
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _State:
+    def __init__(self, latency: float, jitter: float, error_rate: float, name: str, seed: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.name = name
+        self.rng = random.Random(seed or None)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def delay(self) -> float:
+        with self.lock:
+            return max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+
+    def fail(self) -> int | None:
+        """Status code to fail this request with, or None."""
+        with self.lock:
+            self.requests += 1
+            if self.error_rate > 0 and self.rng.random() < self.error_rate:
+                self.errors += 1
+                return self.rng.choice((429, 503))
+        return None
+
+
+def _has_image(messages: list) -> bool:
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+            return True
+    return False
+
+
+def _make_handler(state: _State):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, status: int, payload: dict, headers: dict | None = None):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                req = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                req = {}
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+                return
+            time.sleep(state.delay())
+            status = state.fail()
+            if status == 429:
+                self._json(
+                    429,
+                    {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}},
+                    {"retry-after": "0.2", "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "200ms"},
+                )
+                return
+            if status == 503:
+                self._json(503, {"error": {"message": "The server is overloaded (fake)", "type": "server_error"}})
+                return
+            messages = req.get("messages") or []
+            vision = _has_image(messages)
+            content = f"{state.name}\n-\nViber Out" if vision else state.name
+            prompt_tokens = 300 if vision else 60
+            completion_tokens = 12
+            self._json(
+                200,
+                {
+                    "id": "chatcmpl-fake-%d" % state.requests,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": req.get("model") or "gpt-4o-mini",
+                    "choices": [
+                        {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                },
+                {
+                    "x-ratelimit-remaining-requests": "499",
+                    "x-ratelimit-remaining-tokens": "199000",
+                    "x-ratelimit-reset-requests": "120ms",
+                    "x-ratelimit-reset-tokens": "300ms",
+                },
+            )
+
+    return Handler
+
+
+def serve(
+    port: int = 0,
+    latency: float = 0.6,
+    jitter: float = 0.2,
+    error_rate: float = 0.0,
+    name: str = "Иван Петров",
+    seed: int = 0,
+    host: str = "127.0.0.1",
+) -> ThreadingHTTPServer:
+    """Start the fake server in a daemon thread; port 0 picks a free port (see server.server_address)."""
+    state = _State(latency, jitter, error_rate, name, seed)
+    server = ThreadingHTTPServer((host, port), _make_handler(state))
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI Chat Completions endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.6, help="seconds per response")
+    parser.add_argument("--jitter", type=float, default=0.2, help="+/- seconds of random latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered 429/503")
+    parser.add_argument("--name", default="Иван Петров", help="contact name to return")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = serve(args.port, args.latency, args.jitter, args.error_rate, args.name, args.seed, args.host)
+    print("Fake OpenAI on http://%s:%d/v1 (Ctrl+C to stop)" % server.server_address)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+HTTP load test for the agent API with a latency/throughput regression gate.
+Replays a number list against /check-number-base64 (lookup), /check-number (image) and /send-message (send) at
+fixed concurrency levels (closed loop) or at a target request rate (open loop), and reports throughput,
+p50/p95/p99 latency and error rates as JSON. Without an agent URL it starts one in-process on the simulated
+desktop driver behind Waitress (same threads=6 as agent.py), so it also runs offline / in CI.
+Usage:
+  python loadtest.py                                             # offline, lookup at 1, 6 and 50 clients
+  python loadtest.py http://127.0.0.1:5050 --numbers numbers.txt --endpoints lookup,image --concurrency 1,6
+  python loadtest.py --rate 0.5,1,2 --duration 30                 # open loop, requests per second
+  python loadtest.py --save-baseline loadtest_baseline.json
+  python loadtest.py --baseline loadtest_baseline.json            # exit 1 if p95/p99, throughput or errors regress
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench import _summary, add_sim_arguments, start_sim_agent
+
+ENDPOINTS = {
+    "lookup": "/check-number-base64",
+    "image": "/check-number",
+    "send": "/send-message",
+}
+
+
+class _Result:
+    """Outcome of every request of one run (endpoint x concurrency level or rate)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: list[float] = []
+        self.statuses: dict[str, int] = {}
+        self.count = 0
+
+    def add(self, status: str, ms: float | None):
+        with self.lock:
+            self.count += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if ms is not None:
+                self.latencies.append(ms)
+
+    def report(self, wall: float) -> dict:
+        ok = len(self.latencies)
+        return {
+            "requests": self.count,
+            "ok": ok,
+            "error_rate": round((self.count - ok) / self.count, 4) if self.count else 0.0,
+            "statuses": dict(sorted(self.statuses.items())),
+            "wall_s": round(wall, 3),
+            "throughput_per_s": round(ok / wall, 3) if wall > 0 else 0.0,
+            "latency_ms": _summary(self.latencies),
+        }
+
+
+class _Target:
+    """Sends one request per call; a requests.Session per thread keeps connections alive."""
+
+    def __init__(self, base_url: str, endpoint: str, api_key: str, cache: str, message: str, timeout: float):
+        self.url = base_url.rstrip("/") + ENDPOINTS[endpoint]
+        self.endpoint = endpoint
+        self.headers = {"X-API-Key": api_key} if api_key else {}
+        self.cache = cache
+        self.message = message
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _body(self, number: str) -> dict:
+        if self.endpoint == "send":
+            return {"number": number, "message": self.message}
+        return {"number": number, "only_panel": True, "cache": self.cache}
+
+    def call(self, number: str, result: _Result, started: float | None = None):
+        """started: when the request was due (open loop) so queueing in the client counts as latency."""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        t0 = started if started is not None else time.perf_counter()
+        try:
+            r = session.post(self.url, json=self._body(number), headers=self.headers, timeout=self.timeout)
+            r.content
+        except requests.Timeout:
+            result.add("timeout", None)
+            return
+        except requests.RequestException:
+            result.add("connection", None)
+            return
+        ms = (time.perf_counter() - t0) * 1000
+        result.add(str(r.status_code), ms if 200 <= r.status_code < 300 else None)
+
+
+def _closed_loop(target: _Target, numbers: list[str], concurrency: int, requests_n: int, duration: float) -> dict:
+    """concurrency clients, each sending its next request as soon as the previous one finished."""
+    result = _Result()
+    lock = threading.Lock()
+    counter = [0]
+    stop_at = time.perf_counter() + duration if duration > 0 else None
+
+    def client():
+        while True:
+            with lock:
+                i = counter[0]
+                if (requests_n and i >= requests_n) or (stop_at and time.perf_counter() >= stop_at):
+                    return
+                counter[0] += 1
+            target.call(numbers[i % len(numbers)], result)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return result.report(time.perf_counter() - t0)
+
+
+def _open_loop(target: _Target, numbers: list[str], rate: float, requests_n: int, duration: float,
+               max_inflight: int) -> dict:
+    """Requests start at a fixed rate whether or not earlier ones finished (up to max_inflight)."""
+    result = _Result()
+    total = requests_n or max(1, int(rate * (duration or 30)))
+    interval = 1.0 / rate
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_inflight) as pool:
+        for i in range(total):
+            due = t0 + i * interval
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(target.call, numbers[i % len(numbers)], result, due)
+    return result.report(time.perf_counter() - t0)
+
+
+def _load_numbers(path: str | None, n: int) -> list[str]:
+    if not path:
+        return ["0877%06d" % i for i in range(max(1, n))]
+    with open(path, encoding="utf-8") as f:
+        numbers = [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    if not numbers:
+        raise SystemExit("no numbers in %s" % path)
+    return numbers
+
+
+def compare(report: dict, baseline: dict, tolerance: float, slack_ms: float, max_error_increase: float) -> list[dict]:
+    """
+    Regressions of report against baseline, per run present in both: p95/p99 latency up by more than tolerance
+    (and more than slack_ms), throughput down by more than tolerance, error rate up by more than max_error_increase.
+    """
+    regressions = []
+    for name, base in baseline.get("runs", {}).items():
+        cur = report["runs"].get(name)
+        if cur is None:
+            continue
+        for pct in ("p95", "p99"):
+            b = base["latency_ms"].get(pct)
+            c = cur["latency_ms"].get(pct)
+            if b is not None and c is not None and c > b * (1 + tolerance) and c - b > slack_ms:
+                regressions.append({"run": name, "metric": "latency_ms." + pct, "baseline": b, "current": c})
+        b, c = base["throughput_per_s"], cur["throughput_per_s"]
+        if c < b * (1 - tolerance):
+            regressions.append({"run": name, "metric": "throughput_per_s", "baseline": b, "current": c})
+        b, c = base["error_rate"], cur["error_rate"]
+        if c > b + max_error_increase:
+            regressions.append({"run": name, "metric": "error_rate", "baseline": b, "current": c})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the agent API")
+    parser.add_argument("url", nargs="?", help="agent URL; omit to start an offline agent on the simulated driver")
+    parser.add_argument("--endpoints", default="lookup", help="comma-separated: %s" % ", ".join(ENDPOINTS))
+    parser.add_argument("--concurrency", default="1,6,50", help="comma-separated client counts (closed loop)")
+    parser.add_argument("--rate", help="comma-separated requests/second (open loop; replaces --concurrency)")
+    parser.add_argument("--requests", type=int, default=30, help="requests per run (0 = use --duration)")
+    parser.add_argument("--duration", type=float, default=0, help="seconds per run when --requests is 0")
+    parser.add_argument("--max-inflight", type=int, default=200, help="open loop: max concurrent requests")
+    parser.add_argument("--numbers", help="file with one phone number per line (default: generated numbers)")
+    parser.add_argument("--cache", default="bypass", help="lookup cache mode sent with each request")
+    parser.add_argument("--message", default="Load test", help="message for the send endpoint")
+    parser.add_argument("--api-key", default="", help="X-API-Key for the agent")
+    parser.add_argument("--timeout", type=float, default=300, help="per-request timeout (s)")
+    parser.add_argument("--server-threads", type=int, default=6, help="offline: Waitress threads")
+    parser.add_argument("--baseline", help="compare against this report; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative p95/p99/throughput change")
+    parser.add_argument("--slack-ms", type=float, default=100, help="latency increases below this never fail")
+    parser.add_argument("--max-error-increase", type=float, default=0.02, help="allowed absolute error-rate increase")
+    parser.add_argument("--save-baseline", help="write this run's report as the new baseline")
+    parser.add_argument("--out", help="also write the JSON report to this file")
+    add_sim_arguments(parser)
+    args = parser.parse_args()
+
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = [e for e in endpoints if e not in ENDPOINTS]
+    if unknown:
+        parser.error("unknown endpoint(s): %s (choose from %s)" % (", ".join(unknown), ", ".join(ENDPOINTS)))
+    if not args.requests and args.duration <= 0:
+        parser.error("--requests 0 needs --duration")
+    try:
+        levels = [float(x) if args.rate else int(x) for x in (args.rate or args.concurrency).split(",") if x.strip()]
+    except ValueError:
+        parser.error("--rate / --concurrency must be comma-separated numbers")
+    if not levels or min(levels) <= 0:
+        parser.error("--rate / --concurrency must be positive")
+
+    base_url = args.url
+    http_server = fake = None
+    if not base_url:
+        import waitress
+        agent, fake = start_sim_agent(args)
+        http_server = waitress.create_server(agent.app, host="127.0.0.1", port=0, threads=args.server_threads)
+        threading.Thread(target=http_server.run, daemon=True).start()
+        base_url = "http://127.0.0.1:%s" % http_server.effective_port
+
+    numbers = _load_numbers(args.numbers, args.requests or 1000)
+    report = {
+        "config": {
+            "url": args.url or "offline (simulated driver)",
+            "endpoints": endpoints,
+            "mode": "rate" if args.rate else "concurrency",
+            "levels": levels,
+            "requests": args.requests,
+            "duration": args.duration,
+            "cache": args.cache,
+        },
+        "runs": {},
+    }
+    if not args.url:
+        report["config"]["sim"] = {
+            k: getattr(args, k) for k in ("window_delay", "panel_delay", "send_delay", "failure_rate",
+                                          "openai_latency", "session", "server_threads")
+        }
+    for endpoint in endpoints:
+        target = _Target(base_url, endpoint, args.api_key, args.cache, args.message, args.timeout)
+        for level in levels:
+            if args.rate:
+                name = "%s@%grps" % (endpoint, level)
+                run = _open_loop(target, numbers, level, args.requests, args.duration, args.max_inflight)
+            else:
+                name = "%s@c%d" % (endpoint, level)
+                run = _closed_loop(target, numbers, level, args.requests, args.duration)
+            report["runs"][name] = run
+            print("%-22s %6.2f req/s  p50 %8.1f ms  p95 %8.1f ms  p99 %8.1f ms  errors %.1f%%" % (
+                name, run["throughput_per_s"], run["latency_ms"].get("p50", 0), run["latency_ms"].get("p95", 0),
+                run["latency_ms"].get("p99", 0), run["error_rate"] * 100,
+            ), file=sys.stderr)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.slack_ms, args.max_error_increase)
+        report["baseline"] = {"path": args.baseline, "tolerance": args.tolerance, "regressions": regressions}
+
+    if http_server is not None:
+        http_server.close()
+        fake.shutdown()
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    for path in (args.out, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+    if regressions:
+        for r in regressions:
+            print("REGRESSION %s %s: %s -> %s" % (r["run"], r["metric"], r["baseline"], r["current"]), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
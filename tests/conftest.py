@@ -0,0 +1,21 @@
+"""
+Tests run against the simulated desktop (VIBER_DRIVER=sim) with no disk caches, campaigns or API keys, so they need
+neither Windows nor Viber. The environment is set before agent.py is imported: its configuration is read at import.
+"""
+
+import os
+import sys
+
+os.environ.update(
+    VIBER_DRIVER="sim",
+    SIM_WINDOW_DELAY="0.05",
+    SIM_PANEL_DELAY="0.05",
+    SIM_SEND_DELAY="0.01",
+    SIM_UIA_NAME="Иван Петров",
+    LOOKUP_CACHE_DB="off",
+    CAMPAIGN_DB="off",
+    AGENT_API_KEY="",
+    AGENT_API_KEYS="",
+    DEFAULT_COUNTRY_CODE="359",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,206 @@
+"""Capture logic on fake backends: panel crop, blank-panel retries and fallbacks, PrintWindow surface cache."""
+
+import ctypes
+import io
+
+import pytest
+from PIL import Image, ImageDraw
+
+import agent
+
+RECT = {"left": 0, "top": 0, "width": 800, "height": 600}
+
+
+def _window(blank_panel: bool = False, rect: dict = RECT) -> Image.Image:
+    """Dark window frame; the panel region gets a stripe pattern, or a flat fill when blank_panel."""
+    im = Image.new("RGB", (rect["width"], rect["height"]), (40, 40, 40))
+    left, top, width, height = agent._panel_box(rect["width"], rect["height"])
+    if not blank_panel:
+        draw = ImageDraw.Draw(im)
+        for i in range(0, width, 8):
+            draw.rectangle((left + i, top, left + i + 3, top + height - 1), fill=(i % 256, 200, 255 - i % 256))
+    else:
+        im.paste((250, 250, 250), (left, top, left + width, top + height))
+    return im
+
+
+def _png(data: bytes) -> Image.Image:
+    return Image.open(io.BytesIO(data)).convert("RGB")
+
+
+def test_raw_frame_crop_and_view_match_pil_crop():
+    im = _window()
+    frame = agent._RawFrame(im.tobytes("raw", "BGRX"), im.width, im.height)
+    box = (500, 120, 200, 90)
+    expected = im.crop((box[0], box[1], box[0] + box[2], box[1] + box[3]))
+
+    cropped = frame.crop(*box)
+    assert (cropped.width, cropped.height) == box[2:]
+    assert cropped.buf.obj is frame.buf.obj  # shares the buffer, no copy
+    assert cropped.image().tobytes() == expected.tobytes()
+    assert frame.view(*box).tobytes() == expected.tobytes()
+
+
+def test_only_panel_grabs_just_the_panel_region():
+    backend = agent._FakeCaptureBackend(_window())
+    window_bytes, panel_bytes = agent._capture_window(backend, None, RECT, only_panel=True)
+    left, top, width, height = agent._panel_box(RECT["width"], RECT["height"])
+    assert window_bytes is None
+    panel = _png(panel_bytes)
+    assert panel.size == (width, height)
+    assert panel.tobytes() == _window().crop((left, top, left + width, top + height)).tobytes()
+
+
+def test_window_and_panel_are_both_encoded():
+    backend = agent._FakeCaptureBackend(_window())
+    window_bytes, panel_bytes = agent._capture_window(backend, None, RECT, fmt="png")
+    assert _png(window_bytes).size == (RECT["width"], RECT["height"])
+    assert _png(panel_bytes).size == agent._panel_box(RECT["width"], RECT["height"])[2:]
+
+
+def test_blank_panel_tries_the_next_variant():
+    frames = iter([_window(blank_panel=True), _window()])
+    backend = agent._FakeCaptureBackend(lambda: next(frames), variants=(None, None))
+    _, panel_bytes = agent._capture_window(backend, None, RECT, only_panel=True)
+    assert backend.grabs == 2
+    assert not agent._panel_is_blank(_png(panel_bytes))
+
+
+def test_blank_panel_is_rejected_unless_allowed():
+    backend = agent._FakeCaptureBackend(_window(blank_panel=True), variants=(None, None))
+    assert agent._capture_window(backend, None, RECT, only_panel=True) == (None, None)
+    assert backend.grabs == 2
+    _, panel_bytes = agent._capture_window(backend, None, RECT, only_panel=True, allow_blank=True)
+    assert agent._panel_is_blank(_png(panel_bytes))
+
+
+def test_failed_grab_yields_nothing():
+    backend = agent._FakeCaptureBackend(lambda: None)
+    assert agent._capture_window(backend, None, RECT) == (None, None)
+
+
+def _named(name: str, blank_panel: bool) -> agent._FakeCaptureBackend:
+    """Fake backend framed like the simulated Viber window, so the panel box lines up."""
+    backend = agent._FakeCaptureBackend(_window(blank_panel, agent._driver._rect()))
+    backend.name = name
+    return backend
+
+
+@pytest.fixture
+def no_waits(monkeypatch):
+    monkeypatch.setattr(agent, "PANEL_READY_DETECT", False)
+    monkeypatch.setattr(agent, "PANEL_LOAD_WAIT", 0.0)
+    monkeypatch.setattr(agent, "INITIAL_WAIT", 0.0)
+
+
+def test_lookup_falls_back_to_the_next_backend_on_a_blank_panel(monkeypatch, no_waits):
+    first = _named("first", blank_panel=True)
+    second = _named("second", blank_panel=False)
+    monkeypatch.setattr(agent._driver, "capture_backends", [first, second])
+    info = {}
+    _, panel_bytes, err = agent.do_viber_search_and_screenshot("0877315132", only_panel=True, info=info)
+    assert err is None
+    assert info["capture_backend"] == "second"
+    assert first.grabs == 1 and second.grabs == 1
+    assert not agent._panel_is_blank(_png(panel_bytes))
+
+
+def test_last_backend_returns_a_blank_panel_rather_than_nothing(monkeypatch, no_waits):
+    first = _named("first", blank_panel=True)
+    second = _named("second", blank_panel=True)
+    monkeypatch.setattr(agent._driver, "capture_backends", [first, second])
+    info = {}
+    _, panel_bytes, err = agent.do_viber_search_and_screenshot("0877315132", only_panel=True, info=info)
+    assert err is None
+    assert info["capture_backend"] == "second"
+    assert agent._panel_is_blank(_png(panel_bytes))
+
+
+class _Header(ctypes.Structure):
+    _fields_ = [
+        ("biSize", ctypes.c_uint32), ("biWidth", ctypes.c_int32), ("biHeight", ctypes.c_int32),
+        ("biPlanes", ctypes.c_uint16), ("biBitCount", ctypes.c_uint16), ("biCompression", ctypes.c_uint32),
+        ("biSizeImage", ctypes.c_uint32), ("biXPelsPerMeter", ctypes.c_int32), ("biYPelsPerMeter", ctypes.c_int32),
+        ("biClrUsed", ctypes.c_uint32), ("biClrImportant", ctypes.c_uint32),
+    ]
+
+
+class _FakeGdi:
+    """Just enough of gdi32 for _GdiCaptureBackend: DIB sections are plain ctypes buffers."""
+
+    def __init__(self):
+        self._handle = 100
+        self.buffers = {}
+        self.deleted_dcs = []
+        self.deleted_bitmaps = []
+
+    def _next(self) -> int:
+        self._handle += 1
+        return self._handle
+
+    def CreateCompatibleDC(self, _):
+        return self._next()
+
+    def CreateDIBSection(self, hdc, header, usage, bits, section, offset):
+        h = header._obj
+        buf = ctypes.create_string_buffer(h.biWidth * -h.biHeight * 4)
+        handle = self._next()
+        self.buffers[handle] = buf  # kept alive for the whole test
+        bits._obj.value = ctypes.addressof(buf)
+        return handle
+
+    def SelectObject(self, hdc, obj):
+        return 1
+
+    def DeleteObject(self, handle):
+        self.deleted_bitmaps.append(handle)
+
+    def DeleteDC(self, handle):
+        self.deleted_dcs.append(handle)
+
+    def GdiFlush(self):
+        pass
+
+
+@pytest.fixture
+def gdi(monkeypatch):
+    fake = _FakeGdi()
+    monkeypatch.setattr(agent, "_gdi32", fake, raising=False)
+    monkeypatch.setattr(agent, "_BITMAPINFOHEADER", _Header, raising=False)
+    monkeypatch.setattr(agent, "_PrintWindow", lambda hwnd, hdc, flags: 1, raising=False)
+    return fake
+
+
+def _grab(backend, width, height, region=None):
+    with backend.grab(1, {"left": 0, "top": 0, "width": width, "height": height}, region) as frame:
+        return None if frame is None else (frame.width, frame.height)
+
+
+def test_gdi_surface_is_reused_while_the_window_size_is_unchanged(gdi):
+    backend = agent._GdiCaptureBackend(max_sizes=2)
+    try:
+        assert _grab(backend, 200, 100) == (200, 100)
+        assert _grab(backend, 200, 100, region=(150, 10, 50, 40)) == (50, 40)
+        stats = backend.stats()
+        assert (stats["grabs"], stats["allocations"], stats["releases"]) == (2, 1, 0)
+        assert stats["sizes"] == ["200x100"]
+    finally:
+        backend.close()
+
+
+def test_gdi_surfaces_are_evicted_and_released_when_the_size_changes(gdi):
+    backend = agent._GdiCaptureBackend(max_sizes=2)
+    try:
+        _grab(backend, 200, 100)
+        _grab(backend, 300, 100)
+        _grab(backend, 200, 100)  # most recently used again
+        _grab(backend, 400, 100)  # evicts 300x100, the least recently used
+        stats = backend.stats()
+        assert (stats["allocations"], stats["releases"]) == (3, 1)
+        assert stats["sizes"] == ["200x100", "400x100"]
+        assert len(gdi.deleted_dcs) == 1 and len(gdi.deleted_bitmaps) == 1
+    finally:
+        backend.close()
+    assert backend.stats()["releases"] == 3
+    assert backend.stats()["sizes"] == []
+    assert len(gdi.deleted_dcs) == 3
@@ -0,0 +1,88 @@
+"""Offline contact-name fixing (_NameNormalizer) against the bundled data/bg_names.txt dictionary."""
+
+import os
+
+import pytest
+
+import agent
+
+DICT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "bg_names.txt")
+
+
+@pytest.fixture(scope="module")
+def names():
+    return agent._NameNormalizer(DICT_PATH)
+
+
+def test_dictionary_is_loaded_with_feminine_surnames(names):
+    assert {"иван", "петров", "георгиев"} <= names.words
+    assert {"петрова", "георгиева"} <= names.words  # derived from the -ов/-ев entries
+    assert "петров" in names.by_initial["п"]
+
+
+def test_missing_dictionary_leaves_it_empty():
+    assert agent._NameNormalizer(DICT_PATH + ".missing").words == set()
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        ("Иваn Петров", "Иван Петров"),  # Latin n is н here...
+        ("Сnас", "Спас"),  # ...and п here
+        ("Колbо", "Кольо"),  # Latin b is ь here...
+        ("Люbомир", "Любомир"),  # ...and б here
+    ],
+)
+def test_ambiguous_latin_letters_take_the_dictionary_spelling(names, raw, expected):
+    assert names.normalize(raw, transliterate=False) == (expected, 1.0)
+    assert names.normalize(raw) == (expected, 1.0)
+
+
+def test_homoglyph_in_a_latin_name_is_unmixed(names):
+    assert names.normalize("Ivаn", transliterate=False) == ("Ivan", 1.0)  # Cyrillic а
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        ("Ivan Petrov", "Иван Петров"),
+        ("Petar Georgiev", "Петър Георгиев"),
+        ("Maria Ivanova", "Мария Иванова"),
+    ],
+)
+def test_latin_names_are_transliterated(names, raw, expected):
+    assert names.normalize(raw) == (expected, 1.0)
+    assert names.normalize(raw, transliterate=False) == (raw, 1.0)
+
+
+@pytest.mark.parametrize(
+    "word, expected",
+    [
+        ("иван", ("иван", 1.0)),  # exact
+        ("георгев", ("георгиев", 0.85)),  # one OCR typo
+        ("хаджиминчев", ("хаджиминчев", 0.8)),  # not listed, but surname-shaped
+        ("хфгщз", (None, 0.5)),  # unknown
+    ],
+)
+def test_dictionary_scoring(names, word, expected):
+    assert names._lookup(word) == expected
+
+
+def test_name_scores_as_its_weakest_word(names):
+    assert names.normalize("Иван Хфгщз")[1] == 0.5
+    assert names.normalize("Иван Хфгщз", transliterate=False) == ("Иван Хфгщз", 1.0)  # untouched words are trusted
+    assert names.normalize("Ивaн Xфгщзy", transliterate=False) == ("Иван Хфгщзу", 0.5)
+
+
+def test_fix_asks_gpt_only_below_the_minimum_score(monkeypatch, names):
+    asked = []
+    monkeypatch.setattr(agent, "SKIP_FIX_NAME", False)
+    monkeypatch.setattr(agent, "gpt_fix_contact_name", lambda raw: asked.append(raw) or "GPT")
+
+    assert names.fix("Иваn Петров") == "Иван Петров"
+    assert names.fix("Petar Georgiev") == "Petar Georgiev"  # clean Latin contact names are kept as saved
+    assert asked == []
+
+    assert names.fix("Ивaн Xфгщзy") == "GPT"
+    assert asked == ["Ивaн Xфгщзy"]
+    assert names.stats()["escalated"] == 1
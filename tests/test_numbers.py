@@ -0,0 +1,91 @@
+"""Number normalization and lookup coalescing across the different ways callers write the same number."""
+
+import json
+import threading
+import time
+
+import pytest
+
+import agent
+
+
+@pytest.mark.parametrize(
+    "number",
+    [
+        "0877315132",
+        "+359877315132",
+        "00359877315132",
+        "359877315132",
+        "+359 87 731 5132",
+        "0877-315-132",
+        "+359 (87) 731-51-32",
+        " 0877 315 132 ",
+    ],
+)
+def test_equivalent_formats_normalize_alike(number):
+    assert agent._normalize_number(number) == "359877315132"
+
+
+def test_foreign_numbers_keep_their_country_code():
+    assert agent._normalize_number("+44 20 7946 0958") == "442079460958"
+    assert agent._normalize_number("0044 20 7946 0958") == "442079460958"
+
+
+def test_flight_key_ignores_how_the_number_is_written():
+    params = {"only_panel": True, "ocr": None, "source": "uia"}
+    keys = {
+        agent._DesktopWorker._flight_key("lookup", dict(params, number=n))
+        for n in ("0877315132", "+359 87 731 5132", "00359877315132")
+    }
+    assert len(keys) == 1
+    assert agent._DesktopWorker._flight_key("lookup", dict(params, number="0877315133")) not in keys
+    assert agent._DesktopWorker._flight_key("send", dict(params, number="0877315132")) is None
+
+
+def _wait_until(predicate, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_coalesced_caller_gets_its_own_number_back(monkeypatch):
+    gate = threading.Event()
+    opened = []
+    open_chat = agent._driver.open_chat
+
+    def gated_open_chat(*args, **kwargs):
+        opened.append(args)
+        gate.wait(5)
+        return open_chat(*args, **kwargs)
+
+    monkeypatch.setattr(agent._driver, "open_chat", gated_open_chat)
+    client = agent.app.test_client()
+    options = {"only_panel": True, "cache": "bypass", "source": "uia"}
+    responses = {}
+
+    def single():
+        responses["single"] = client.post("/check-number-base64", json=dict(options, number="+359877315132"))
+
+    def batch():
+        resp = client.post("/check-numbers", json=dict(options, numbers=["0877315132"]))
+        responses["batch"] = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+
+    coalesced = agent._worker.coalesced
+    threads = [threading.Thread(target=single), threading.Thread(target=batch)]
+    threads[0].start()
+    _wait_until(lambda: agent._worker._inflight)
+    threads[1].start()
+    _wait_until(lambda: agent._worker.coalesced > coalesced)
+    gate.set()
+    for t in threads:
+        t.join(10)
+
+    single_resp = responses["single"]
+    assert single_resp.status_code == 200, single_resp.get_json()
+    assert single_resp.get_json()["number"] == "+359877315132"
+    [line] = responses["batch"]
+    assert "error" not in line, line
+    assert line["number"] == "0877315132"
+    assert line["contact_name"] == single_resp.get_json()["contact_name"]
+    assert len(opened) == 1  # one desktop run served both callers
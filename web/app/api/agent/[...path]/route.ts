@@ -33,6 +33,68 @@ export async function POST(
       body: body || undefined,
     });
 
+    // Batch lookups stream NDJSON line by line; pass the body through unbuffered.
+    const resType = res.headers.get("content-type") || "";
+    if (resType.includes("application/x-ndjson")) {
+      return new Response(res.body, {
+        status: res.status,
+        headers: { "Content-Type": resType },
+      });
+    }
+
+    const data = await res.json().catch(() => ({}));
+    return NextResponse.json(data, { status: res.status });
+  } catch (err) {
+    console.error("[api/agent] proxy error:", err);
+    return NextResponse.json(
+      { error: err instanceof Error ? err.message : "Proxy request failed" },
+      { status: 502 }
+    );
+  }
+}
+
+export async function GET(
+  request: NextRequest,
+  { params }: { params: Promise<{ path: string[] }> }
+) {
+  if (!AGENT_URL) {
+    return NextResponse.json(
+      { error: "AGENT_URL not configured" },
+      { status: 500 }
+    );
+  }
+
+  const { path } = await params;
+  const pathStr = path.join("/");
+  const url = `${AGENT_URL.replace(/\/$/, "")}/${pathStr}${request.nextUrl.search}`;
+
+  try {
+    const headers: Record<string, string> = {};
+    if (AGENT_API_KEY) {
+      headers["X-API-Key"] = AGENT_API_KEY;
+    }
+    // Images are immutable and support conditional/range requests; forward those headers.
+    for (const name of ["range", "if-none-match", "if-range"]) {
+      const value = request.headers.get(name);
+      if (value) headers[name] = value;
+    }
+
+    const res = await fetch(url, { method: "GET", headers });
+
+    // Non-JSON (images from /images/<id>): stream the body through with its caching headers.
+    const resType = res.headers.get("content-type") || "";
+    if (!resType.includes("application/json")) {
+      const passHeaders = new Headers();
+      for (const name of ["content-type", "content-length", "content-range", "accept-ranges", "etag", "cache-control"]) {
+        const value = res.headers.get(name);
+        if (value) passHeaders.set(name, value);
+      }
+      return new Response(res.status === 304 ? null : res.body, {
+        status: res.status,
+        headers: passHeaders,
+      });
+    }
+
     const data = await res.json().catch(() => ({}));
     return NextResponse.json(data, { status: res.status });
   } catch (err) {
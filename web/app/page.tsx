@@ -8,7 +8,9 @@ import type { AnimatedIconHandle } from "@/components/icons/types";
 interface ApiResponse {
   number: string;
   error?: string;
+  panel_url?: string;
   panel_base64?: string;
+  image_mime?: string;
   contact_name?: string;
   panel_text?: string;
 }
@@ -148,7 +150,8 @@ export default function Home() {
       }
 
       const name = (data.contact_name ?? "").trim();
-      if (data.panel_base64) setPanelImage(data.panel_base64);
+      if (data.panel_url) setPanelImage(`${base}${data.panel_url}`);
+      else if (data.panel_base64) setPanelImage(`data:${data.image_mime || "image/png"};base64,${data.panel_base64}`);
       setContactName(name || null);
       setLookedUpNumber((data.number || number).trim());
     } catch (err) {
@@ -344,7 +347,7 @@ export default function Home() {
                     style={{ animationDelay: "0.05s", animationFillMode: "both" }}
                   >
                     <img
-                      src={`data:image/png;base64,${panelImage}`}
+                      src={panelImage}
                       alt=""
                       className="w-full h-full object-cover"
                     />